@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Time umap.utils.merge_features on growing layer sizes.
+
+Usage: python scripts/bench_merge_features.py [--sizes 1000 5000 20000]
+"""
+
+import argparse
+import copy
+import random
+import time
+import uuid
+
+from umap.utils import merge_features
+
+
+def make_feature(with_id=True):
+    feature = {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [random.uniform(-180, 180), random.uniform(-90, 90)],
+        },
+        "properties": {"name": uuid.uuid4().hex[:8]},
+    }
+    if with_id:
+        feature["id"] = uuid.uuid4().hex
+    return feature
+
+
+def scenario(size, with_id):
+    reference = [make_feature(with_id) for i in range(size)]
+    # Another peer edited some features and added some.
+    latest = copy.deepcopy(reference)
+    for feature in latest[: size // 100]:
+        feature["properties"]["name"] = "edited by peer"
+    latest += [make_feature(with_id) for i in range(size // 100)]
+    # Incoming save edited other features, deleted some and added some.
+    start, end = size // 2, size // 2 + size // 100
+    incoming = copy.deepcopy(reference[:start] + reference[end:])
+    for feature in incoming[-(size // 100) :]:
+        feature["properties"]["name"] = "edited by me"
+    incoming += [make_feature(with_id) for i in range(size // 100)]
+    return reference, latest, incoming
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 5_000, 10_000, 20_000]
+    )
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    print(f"{'features':>10} {'with ids (s)':>14} {'without ids (s)':>16}")
+    for size in args.sizes:
+        timings = []
+        for with_id in (True, False):
+            reference, latest, incoming = scenario(size, with_id)
+            best = None
+            for i in range(args.runs):
+                start = time.perf_counter()
+                merge_features(reference, latest, incoming)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+        print(f"{size:>10} {timings[0]:>14.4f} {timings[1]:>16.4f}")
+
+
+if __name__ == "__main__":
+    main()
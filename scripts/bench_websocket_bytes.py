@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Measure the bytes on the wire of a feature drawing session relayed by the
+websocket server, for each compression mode: a peer draws lines (sent
+again as they are edited), drops and drags markers and edits their
+properties, while another peer of the room receives it all.
+
+Bytes are counted from what the sockets receive, frame headers included:
+upstream is what the server receives from the drawing peer, downstream
+what the other peer receives from the server.
+
+Usage: python scripts/bench_websocket_bytes.py [--lines 20 --vertices 100]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "umap.settings")
+django.setup()
+
+from django.core.signing import TimestampSigner  # noqa: E402
+from django.test import override_settings  # noqa: E402
+from websockets.client import WebSocketClientProtocol, connect  # noqa: E402
+from websockets.server import WebSocketServerProtocol, serve  # noqa: E402
+
+from umap import websocket_server  # noqa: E402
+from umap.compact_geojson import encode_coordinates  # noqa: E402
+
+
+class CountingMixin:
+    received = 0
+
+    def data_received(self, data):
+        type(self).received += len(data)
+        super().data_received(data)
+
+
+class CountingServerProtocol(CountingMixin, WebSocketServerProtocol):
+    pass
+
+
+class CountingClientProtocol(CountingMixin, WebSocketClientProtocol):
+    pass
+
+
+def compact(geometry):
+    return {
+        "type": geometry["type"],
+        "compact": encode_coordinates(geometry["coordinates"]),
+    }
+
+
+def session(lines, vertices, edits, markers, drags):
+    """Yield the operations a peer sends while drawing, as the web client does."""
+    rng = random.Random(42)
+
+    def position(lng, lat):
+        # Leaflet rounds the coordinates to 6 decimals when exporting GeoJSON.
+        return [round(lng, 6), round(lat, 6)]
+
+    def operation(verb, metadata, value, key=None):
+        message = {"verb": verb, "subject": "feature", "metadata": metadata}
+        if key:
+            message["key"] = key
+        message["value"] = value
+        return message
+
+    for index in range(lines):
+        metadata = {"id": f"line{index}", "layerId": "layer", "featureType": "polyline"}
+        lng, lat = rng.uniform(2.2, 2.4), rng.uniform(48.8, 48.9)
+        coordinates = []
+        for edit in range(edits):
+            # Each editing session adds vertices, then upserts the whole line.
+            for _ in range(vertices // edits):
+                lng += rng.gauss(0, 0.0005)
+                lat += rng.gauss(0, 0.0005)
+                coordinates.append(position(lng, lat))
+            feature = {
+                "type": "Feature",
+                "properties": {"name": f"Line {index}"},
+                "geometry": {"type": "LineString", "coordinates": list(coordinates)},
+                "id": metadata["id"],
+            }
+            yield operation("upsert", metadata, feature)
+        yield operation(
+            "update", metadata, "#ff0000", key="properties._umap_options.color"
+        )
+    for index in range(markers):
+        metadata = {"id": f"marker{index}", "layerId": "layer", "featureType": "marker"}
+        lng, lat = rng.uniform(2.2, 2.4), rng.uniform(48.8, 48.9)
+        feature = {
+            "type": "Feature",
+            "properties": {},
+            "geometry": {"type": "Point", "coordinates": position(lng, lat)},
+            "id": metadata["id"],
+        }
+        yield operation("upsert", metadata, feature)
+        yield operation("update", metadata, f"Marker {index}", key="properties.name")
+        for _ in range(drags):
+            lng += rng.gauss(0, 0.001)
+            lat += rng.gauss(0, 0.001)
+            geometry = {"type": "Point", "coordinates": position(lng, lat)}
+            yield operation("update", metadata, geometry, key="geometry")
+
+
+def encode(message, compact_coordinates):
+    if compact_coordinates:
+        value = message["value"]
+        if message.get("key") == "geometry":
+            message = {**message, "value": compact(value)}
+        elif isinstance(value, dict) and "geometry" in value:
+            value = {**value, "geometry": compact(value["geometry"])}
+            message = {**message, "value": value}
+    # Same serialization as JSON.stringify.
+    return json.dumps({**message, "kind": "operation"}, separators=(",", ":"))
+
+
+async def measure(room, messages, compression):
+    CountingServerProtocol.received = CountingClientProtocol.received = 0
+    token = TimestampSigner().sign_object(
+        {"user": "bench", "map_id": room, "permissions": ["edit"]}
+    )
+    join = json.dumps({"kind": "join", "token": token})
+    options = {"create_protocol": CountingClientProtocol}
+    if not compression:
+        options["compression"] = None
+    server = await serve(
+        websocket_server.handler,
+        "localhost",
+        0,
+        create_protocol=CountingServerProtocol,
+        **websocket_server.compression_options(),
+    )
+    uri = f"ws://localhost:{server.sockets[0].getsockname()[1]}"
+    async with connect(uri, **options) as sender, connect(uri, **options) as receiver:
+        await sender.send(join)
+        await receiver.send(join)
+        await asyncio.sleep(0.1)
+        CountingServerProtocol.received = CountingClientProtocol.received = 0
+        for message in messages:
+            # One at a time, so each is relayed on its own.
+            await sender.send(message)
+            await asyncio.wait_for(receiver.recv(), 5)
+        upstream = CountingServerProtocol.received
+        downstream = CountingClientProtocol.received
+    server.close()
+    await server.wait_closed()
+    return upstream, downstream
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--vertices", type=int, default=100, help="Per line")
+    parser.add_argument("--edits", type=int, default=5, help="Upserts per line")
+    parser.add_argument("--markers", type=int, default=50)
+    parser.add_argument("--drags", type=int, default=3, help="Per marker")
+    parser.add_argument("--window-bits", type=int, default=None)
+    parser.add_argument("--memory-level", type=int, default=None)
+    args = parser.parse_args()
+
+    operations = list(
+        session(args.lines, args.vertices, args.edits, args.markers, args.drags)
+    )
+    tuned = {"WEBSOCKET_COMPRESSION": "deflate"}
+    if args.window_bits:
+        tuned["WEBSOCKET_DEFLATE_WINDOW_BITS"] = args.window_bits
+    if args.memory_level:
+        tuned["WEBSOCKET_DEFLATE_MEMORY_LEVEL"] = args.memory_level
+    # The websockets library defaults.
+    defaults = {
+        "WEBSOCKET_COMPRESSION": "deflate",
+        "WEBSOCKET_DEFLATE_WINDOW_BITS": 12,
+        "WEBSOCKET_DEFLATE_MEMORY_LEVEL": 5,
+    }
+    modes = [
+        ("none", {"WEBSOCKET_COMPRESSION": ""}, False),
+        ("deflate (library defaults)", defaults, False),
+        ("deflate (settings)", tuned, False),
+        ("compact coordinates", {"WEBSOCKET_COMPRESSION": ""}, True),
+        ("compact + deflate (settings)", tuned, True),
+    ]
+    # Do not hold operations, each one should be relayed as it is sent.
+    websocket_server.COALESCE_DELAY = 0
+    print(f"{len(operations)} operations")
+    reference = None
+    for room, (name, overrides, compact_coordinates) in enumerate(modes, 1):
+        messages = [encode(message, compact_coordinates) for message in operations]
+        with override_settings(**overrides):
+            upstream, downstream = asyncio.run(
+                measure(room, messages, overrides["WEBSOCKET_COMPRESSION"])
+            )
+        reference = reference or downstream
+        print(
+            f"{name:<30} up: {upstream / 1024:8.1f} kB  "
+            f"down: {downstream / 1024:8.1f} kB  "
+            f"({downstream / reference:.0%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Load the websocket server relay: N rooms of M peers, one peer of each room
+sending K messages per second, and report the throughput of the deliveries
+and their fan-out latency (from send to receive by each other peer).
+
+The server runs in a separate process, the peers in this one, so the
+numbers also include the client side cost: keep N * M reasonable.
+
+Usage: python scripts/bench_websocket_relay.py [--rooms 10 --peers 10 --rate 50]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import statistics
+import time
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "umap.settings")
+django.setup()
+
+from django.core.signing import TimestampSigner  # noqa: E402
+from websockets.client import connect  # noqa: E402
+from websockets.server import serve  # noqa: E402
+
+from umap import websocket_server  # noqa: E402
+
+
+def run_server(port):
+    async def _serve():
+        async with serve(websocket_server.handler, "localhost", port):
+            await asyncio.Future()
+
+    asyncio.run(_serve())
+
+
+def message_template(size):
+    """Build the message once, the send time is put in front of it."""
+    coordinates = [[i / 1000, i / 1000] for i in range(size)]
+    body = json.dumps(
+        {
+            "verb": "update",
+            "subject": "feature",
+            "metadata": {"id": "bench", "layerId": "bench"},
+            "key": "geometry",
+            "value": {"type": "LineString", "coordinates": coordinates},
+            "kind": "operation",
+        }
+    )
+    return '{"sent": %r, ' + body[1:]
+
+
+SENT = re.compile(r'\{"sent": ([^,]+),')
+
+
+def sent_at(raw):
+    # Avoid parsing the whole message on the client side. A batch of
+    # coalesced operations only delivers the latest ones.
+    return [float(sent) for sent in SENT.findall(raw)]
+
+
+async def peer(uri, room):
+    token = TimestampSigner().sign_object(
+        {"user": "bench", "map_id": room, "permissions": ["edit"]}
+    )
+    websocket = await connect(uri, max_size=None)
+    await websocket.send(json.dumps({"kind": "join", "token": token}))
+    return websocket
+
+
+async def receive(websocket, latencies):
+    async for raw in websocket:
+        now = time.perf_counter()
+        latencies.extend(now - sent for sent in sent_at(raw))
+
+
+async def send(websocket, rate, duration, size):
+    template = message_template(size)
+    interval = 1 / rate
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        await websocket.send(template % time.perf_counter())
+        count += 1
+        next_at = start + count * interval
+        await asyncio.sleep(max(0, next_at - time.perf_counter()))
+    return count
+
+
+async def bench(uri, rooms, peers, rate, duration, size):
+    latencies = []
+    connections = {
+        room: [await peer(uri, room) for _ in range(peers)]
+        for room in range(1, rooms + 1)
+    }
+    receivers = [
+        asyncio.create_task(receive(websocket, latencies))
+        for websockets in connections.values()
+        for websocket in websockets[1:]
+    ]
+    # Let the server process the joins.
+    await asyncio.sleep(0.5)
+    start = time.perf_counter()
+    counts = await asyncio.gather(
+        *(
+            send(websockets[0], rate, duration, size)
+            for websockets in connections.values()
+        )
+    )
+    elapsed = time.perf_counter() - start
+    # Let the last messages arrive.
+    await asyncio.sleep(1)
+    for task in receivers:
+        task.cancel()
+    for websockets in connections.values():
+        for websocket in websockets:
+            await websocket.close()
+    return sum(counts), latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--peers", type=int, default=10, help="Peers per room")
+    parser.add_argument("--rate", type=int, default=50, help="Messages/s per room")
+    parser.add_argument("--duration", type=float, default=5, help="In seconds")
+    parser.add_argument("--size", type=int, default=100, help="Coordinates/message")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=run_server, args=(args.port,))
+    server.start()
+    time.sleep(1)
+    try:
+        sent, latencies, elapsed = asyncio.run(
+            bench(
+                f"ws://localhost:{args.port}",
+                args.rooms,
+                args.peers,
+                args.rate,
+                args.duration,
+                args.size,
+            )
+        )
+    finally:
+        server.terminate()
+    expected = sent * (args.peers - 1)
+    latencies.sort()
+    print(f"rooms: {args.rooms}, peers/room: {args.peers}, msgs/s/room: {args.rate}")
+    # Coalesced operations are not delivered.
+    print(f"sent: {sent}, delivered: {len(latencies)}/{expected}")
+    print(f"throughput: {len(latencies) / elapsed:.0f} deliveries/s")
+    if latencies:
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(
+            f"fan-out latency: p50 {statistics.median(latencies) * 1000:.2f} ms, "
+            f"p99 {p99 * 1000:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.core.signals import setting_changed
+
+
+def reset_url_templates(setting, **kwargs):
+    if setting in ("ROOT_URLCONF", "UMAP_EXTRA_URLS"):
+        from .utils import clear_url_templates
+
+        clear_url_templates()
 
 
 class UmapConfig(AppConfig):
     name = "umap"
     verbose_name = "uMap"
+
+    def ready(self):
+        setting_changed.connect(reset_url_templates)
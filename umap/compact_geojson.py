@@ -0,0 +1,180 @@
+"""Smaller datalayer files: rounded coordinates, and a compact encoding.
+
+Layers can opt in to have their coordinates rounded when saved, with the
+`coordinatesPrecision` option (a number of decimals).
+
+The compact encoding is served to clients asking for it (see MEDIA_TYPE):
+the coordinates of each geometry are replaced by a `compact` string, as
+for the geometries sent to the websocket peers (see
+js/modules/sync/coordinates.js): the zigzag varints of the differences
+between consecutive positions, base64 encoded. A geometry with a
+`precision` other than the default one was rounded to that many decimals
+instead of 7.
+"""
+
+import base64
+import json
+
+from .utils import atomic_write
+
+MEDIA_TYPE = "application/vnd.umap.compact+json"
+DEFAULT_PRECISION = 7
+MAX_PRECISION = 10
+
+
+def get_precision(settings):
+    """Return the `coordinatesPrecision` of the layer settings, or None."""
+    precision = (settings or {}).get("coordinatesPrecision")
+    if isinstance(precision, str) and precision.isdigit():
+        precision = int(precision)
+    if isinstance(precision, int) and 0 <= precision <= MAX_PRECISION:
+        return precision
+    return None
+
+
+def map_coordinates(geometry, func):
+    """Return a copy of `geometry` with func(coordinates) as coordinates."""
+    if not geometry:
+        return geometry
+    if geometry.get("type") == "GeometryCollection":
+        geometries = [map_coordinates(child, func) for child in geometry["geometries"]]
+        return {**geometry, "geometries": geometries}
+    if not isinstance(geometry.get("coordinates"), list):
+        return geometry
+    return func(geometry)
+
+
+def map_geometries(data, func):
+    features = [
+        {**feature, "geometry": map_coordinates(feature.get("geometry"), func)}
+        for feature in data.get("features") or []
+    ]
+    return {**data, "features": features}
+
+
+def round_coordinates(node, precision):
+    if isinstance(node, list):
+        return [round_coordinates(child, precision) for child in node]
+    if isinstance(node, float):
+        return round(node, precision)
+    return node
+
+
+def quantize(data, precision):
+    """Return a copy of the GeoJSON object with its coordinates rounded."""
+
+    def func(geometry):
+        coordinates = round_coordinates(geometry["coordinates"], precision)
+        return {**geometry, "coordinates": coordinates}
+
+    return map_geometries(data, func)
+
+
+def write_varint(buffer, value):
+    while value >= 128:
+        buffer.append((value & 127) | 128)
+        value >>= 7
+    buffer.append(value)
+
+
+def encode_coordinates(coordinates, precision=DEFAULT_PRECISION):
+    """Python version of encodeCoordinates, see js/modules/sync/coordinates.js.
+
+    Raise ValueError for coordinates of mixed dimensions or invalid values.
+    """
+    factor = 10**precision
+    depth, node = 0, coordinates
+    while isinstance(node, list) and node and isinstance(node[0], list):
+        depth, node = depth + 1, node[0]
+    if not isinstance(node, list):
+        raise ValueError("Unexpected coordinates")
+    dimension = len(node)
+    buffer = bytearray()
+    previous = [0] * dimension
+    write_varint(buffer, depth)
+    write_varint(buffer, dimension)
+
+    def write(node, level):
+        if not isinstance(node, list):
+            raise ValueError("Unexpected coordinates")
+        if not level:
+            if len(node) != dimension:
+                raise ValueError("Unexpected position")
+            for index, value in enumerate(node):
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    raise ValueError("Unexpected position")
+                rounded = round(value * factor)
+                delta = rounded - previous[index]
+                write_varint(buffer, delta * 2 if delta >= 0 else -delta * 2 - 1)
+                previous[index] = rounded
+            return
+        write_varint(buffer, len(node))
+        for child in node:
+            write(child, level - 1)
+
+    try:
+        write(coordinates, depth)
+    except OverflowError:
+        raise ValueError("Unexpected position")
+    return base64.b64encode(buffer).decode()
+
+
+def decode_coordinates(encoded, precision=DEFAULT_PRECISION):
+    data = base64.b64decode(encoded)
+    factor = 10**precision
+    offset = 0
+
+    def read_varint():
+        nonlocal offset
+        value, shift = 0, 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 127) << shift
+            shift += 7
+            if byte < 128:
+                return value
+
+    def read_signed():
+        value = read_varint()
+        return -(value + 1) // 2 if value % 2 else value // 2
+
+    depth = read_varint()
+    previous = [0] * read_varint()
+
+    def read(level):
+        if not level:
+            for index in range(len(previous)):
+                previous[index] += read_signed()
+            return [value / factor for value in previous]
+        return [read(level - 1) for _ in range(read_varint())]
+
+    return read(depth)
+
+
+def encode(data, precision=DEFAULT_PRECISION):
+    """Return a copy of the GeoJSON object with its coordinates encoded."""
+
+    def func(geometry):
+        try:
+            compact = encode_coordinates(geometry["coordinates"], precision)
+        except ValueError:
+            # Keep it as is, the client reads plain coordinates too.
+            return geometry
+        encoded = {
+            key: value for key, value in geometry.items() if key != "coordinates"
+        }
+        encoded["compact"] = compact
+        if precision != DEFAULT_PRECISION:
+            encoded["precision"] = precision
+        return encoded
+
+    return map_geometries(data, func)
+
+
+def compact_file(from_path, to_path, precision=DEFAULT_PRECISION):
+    """Write the compact encoding of the GeoJSON file `from_path` to `to_path`."""
+    with open(from_path, "rb") as f:
+        data = json.loads(f.read())
+    with atomic_write(to_path) as f:
+        f.write(json.dumps(encode(data, precision), separators=(",", ":")).encode())
@@ -1,6 +1,7 @@
 from django.conf import settings as djsettings
 
 from . import VERSION
+from .utils import get_urls_hash
 
 
 def settings(request):
@@ -15,4 +16,4 @@ def settings(request):
 
 
 def version(request):
-    return {"UMAP_VERSION": VERSION}
+    return {"UMAP_VERSION": VERSION, "UMAP_URLS_HASH": get_urls_hash()}
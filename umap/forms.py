@@ -1,12 +1,18 @@
+import json
+from io import BytesIO
+
 from django import forms
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.gis.geos import Point
+from django.core.files.uploadedfile import UploadedFile
 from django.forms.utils import ErrorList
 from django.template.defaultfilters import slugify
 from django.utils.translation import gettext_lazy as _
 
+from .compact_geojson import get_precision, quantize
 from .models import DataLayer, Map
+from .utils import json_dumps
 
 DEFAULT_LATITUDE = (
     settings.LEAFLET_LATITUDE if hasattr(settings, "LEAFLET_LATITUDE") else 51
@@ -57,6 +63,31 @@ class DataLayerForm(forms.ModelForm):
         model = DataLayer
         fields = ("geojson", "name", "display_on_load", "rank", "settings")
 
+    # Whether the stored file differs from the uploaded one, which the
+    # client then has to reload.
+    rounded = False
+
+    def clean(self):
+        cleaned_data = super().clean()
+        geojson = cleaned_data.get("geojson")
+        precision = get_precision(cleaned_data.get("settings"))
+        # Round the coordinates of the uploaded file, if the layer asks for it.
+        if precision is not None and isinstance(geojson, UploadedFile):
+            geojson.seek(0)
+            try:
+                data = json.loads(geojson.read())
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                geojson.seek(0)
+                return cleaned_data
+            content = json_dumps(quantize(data, precision), separators=(",", ":"))
+            content = content.encode("utf-8")
+            geojson.file = BytesIO(content)
+            geojson.size = len(content)
+            self.rounded = True
+        return cleaned_data
+
 
 class DataLayerPermissionsForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from umap import websocket_broker
+
+
+class Command(BaseCommand):
+    help = "Run the broker sharing rooms between websocket server processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            help="Where to listen: unix:///path/to/socket or tcp://host:port.",
+            default=settings.WEBSOCKET_BROKER_URL,
+        )
+
+    def handle(self, *args, **options):
+        if not options["url"]:
+            raise CommandError("Set WEBSOCKET_BROKER_URL or use --url.")
+        websocket_broker.run(options["url"])
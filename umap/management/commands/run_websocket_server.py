@@ -18,6 +18,24 @@ class Command(BaseCommand):
             help="The server port to bind to.",
             default=settings.WEBSOCKET_BACK_PORT,
         )
+        parser.add_argument(
+            "--broker",
+            help=(
+                "URL of the broker shared by all the websocket server processes "
+                "(unix:///path/to/socket or tcp://host:port)."
+            ),
+            default=settings.WEBSOCKET_BROKER_URL,
+        )
+        parser.add_argument(
+            "--metrics",
+            help=(
+                "Where to serve the metrics over HTTP, in the Prometheus format "
+                "(unix:///path/to/socket or tcp://host:port)."
+            ),
+            default=settings.WEBSOCKET_METRICS_URL,
+        )
 
     def handle(self, *args, **options):
-        websocket_server.run(options["host"], options["port"])
+        websocket_server.run(
+            options["host"], options["port"], options["broker"], options["metrics"]
+        )
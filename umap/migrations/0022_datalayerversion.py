@@ -0,0 +1,91 @@
+# Generated by Django 5.0.6 on 2026-10-17 23:37
+
+import os
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def index_versions(apps, schema_editor):
+    DataLayer = apps.get_model("umap", "DataLayer")
+    DataLayerVersion = apps.get_model("umap", "DataLayerVersion")
+    storage = DataLayer._meta.get_field("geojson").storage
+    listings = {}
+
+    def storage_root(map_id):
+        # Same as DataLayer.storage_root.
+        path = ["datalayer", str(map_id)[-1]]
+        if len(str(map_id)) > 1:
+            path.append(str(map_id)[-2])
+        path.append(str(map_id))
+        return os.path.join(*path)
+
+    datalayers = DataLayer.objects.order_by("map_id").only("uuid", "old_id", "map_id")
+    for datalayer in datalayers.iterator():
+        root = storage_root(datalayer.map_id)
+        if root not in listings:
+            listings.clear()  # Datalayers are sorted by map, keep one listing.
+            try:
+                listings[root] = storage.listdir(root)[1]
+            except FileNotFoundError:
+                listings[root] = []
+        prefixes = [f"{datalayer.pk}_"]
+        if datalayer.old_id:
+            prefixes.append(f"{datalayer.old_id}_")
+        versions = []
+        for name in listings[root]:
+            if not name.startswith(tuple(prefixes)) or not name.endswith(".geojson"):
+                continue
+            try:
+                at = int(name.split(".")[0].split("_")[1])
+                size = storage.size(os.path.join(root, name))
+            except (ValueError, IndexError, FileNotFoundError):
+                continue
+            versions.append(
+                DataLayerVersion(datalayer=datalayer, name=name, at=at, size=size)
+            )
+        DataLayerVersion.objects.bulk_create(versions, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("umap", "0021_remove_map_description"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DataLayerVersion",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255)),
+                ("at", models.BigIntegerField()),
+                ("size", models.PositiveBigIntegerField()),
+                (
+                    "datalayer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="version_set",
+                        to="umap.datalayer",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("-at",),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="datalayerversion",
+            constraint=models.UniqueConstraint(
+                fields=("datalayer", "name"), name="unique_datalayer_version"
+            ),
+        ),
+        migrations.RunPython(index_versions, reverse_code=migrations.RunPython.noop),
+    ]
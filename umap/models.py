@@ -1,21 +1,34 @@
-import json
-import operator
 import os
 import time
 import uuid
+from pathlib import Path
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models
+from django.core.cache import cache
 from django.core.files.base import File
 from django.core.signing import Signer
+from django.db.models import prefetch_related_objects
 from django.template.defaultfilters import slugify
 from django.urls import reverse
 from django.utils.functional import classproperty
 from django.utils.translation import gettext_lazy as _
 
 from .managers import PublicManager
-from .utils import _urls_for_js
+from .simplify import build_pyramid, get_pyramid_path, load_pyramid
+from .spatial_index import build_index, load_index
+from .utils import (
+    ENCODINGS,
+    _urls_for_js,
+    atomic_write,
+    compress_file,
+    file_lock,
+    get_encodings,
+    json_dumps,
+    json_object_chunks,
+)
+from .vector_tiles import build_tile
 
 
 # Did not find a clean way to do this in Django
@@ -41,6 +54,35 @@ User.add_to_class("get_url", get_user_url)
 User.add_to_class("get_stars_url", get_user_stars_url)
 
 
+def cache_version_key(map_id=None):
+    return f"umap:cache_version:{map_id or 'global'}"
+
+
+def get_cache_version(map_id=None):
+    """
+    Return a token to be used in cache keys built from map related data.
+
+    The token changes each time `bump_cache_version` is called, so there is no
+    need to track and delete the cached keys themselves.
+    """
+    key = cache_version_key(map_id)
+    version = cache.get(key)
+    if version is None:
+        # Do not start from a constant, so a key evicted from the cache
+        # cannot match anymore entries created with a previous version.
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(map_id=None):
+    """
+    Invalidate cached data for the given map, or for all maps if no map_id
+    is given (eg. a TileLayer or a Licence has changed).
+    """
+    cache.set(cache_version_key(map_id), time.time_ns(), timeout=None)
+
+
 def get_default_share_status():
     return settings.UMAP_DEFAULT_SHARE_STATUS or Map.PUBLIC
 
@@ -63,6 +105,21 @@ class NamedModel(models.Model):
         return self.name
 
 
+class GlobalCacheVersionMixin:
+    """
+    For models exposed in every map properties.
+    """
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_cache_version()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        bump_cache_version()
+        return result
+
+
 def get_default_licence():
     """
     Returns a default Licence, creates it if it doesn't exist.
@@ -75,7 +132,7 @@ def get_default_licence():
     )[0]
 
 
-class Licence(NamedModel):
+class Licence(GlobalCacheVersionMixin, NamedModel):
     """
     The licence one map is published on.
     """
@@ -90,7 +147,7 @@ class Licence(NamedModel):
         return {"name": self.name, "url": self.details}
 
 
-class TileLayer(NamedModel):
+class TileLayer(GlobalCacheVersionMixin, NamedModel):
     url_template = models.CharField(
         max_length=400, help_text=_("URL template using OSM tile format")
     )
@@ -206,6 +263,13 @@ class Map(NamedModel):
 
     @property
     def preview_settings(self):
+        if not hasattr(self, "_preview_settings"):
+            self._preview_settings = self.get_preview_settings(
+                TileLayer.get_default().json
+            )
+        return self._preview_settings
+
+    def get_preview_settings(self, tilelayer):
         layers = self.datalayer_set.all()
         datalayer_data = [c.metadata() for c in layers]
         map_settings = self.settings
@@ -213,7 +277,7 @@ class Map(NamedModel):
             map_settings["properties"] = {}
         map_settings["properties"].update(
             {
-                "tilelayers": [TileLayer.get_default().json],
+                "tilelayers": [tilelayer],
                 "datalayers": datalayer_data,
                 "urls": _urls_for_js(),
                 "STATIC_URL": settings.STATIC_URL,
@@ -228,19 +292,46 @@ class Map(NamedModel):
         )
         return map_settings
 
+    @classmethod
+    def prefetch_preview_settings(cls, maps):
+        """
+        Compute preview_settings for a list of maps in a constant number of
+        queries: one for all the datalayers, one for the owners, and the
+        default tilelayer resolved only once.
+
+        Unlike prefetch_related, this can be used with combined querysets.
+        """
+        if not maps:
+            return
+        prefetch_related_objects(maps, "datalayer_set", "owner")
+        tilelayer = TileLayer.get_default().json
+        for map_inst in maps:
+            map_inst._preview_settings = map_inst.get_preview_settings(tilelayer)
+
     def generate_umapjson(self, request):
-        umapjson = self.settings
+        """
+        Yield the .umap export of the map, as bytes, copying the datalayers
+        files chunk by chunk instead of loading them.
+        """
+        umapjson = dict(self.settings)
         umapjson["type"] = "umap"
         umapjson["uri"] = request.build_absolute_uri(self.get_absolute_url())
-        datalayers = []
-        for datalayer in self.datalayer_set.all():
-            with open(datalayer.geojson.path, "rb") as f:
-                layer = json.loads(f.read())
-            if datalayer.settings:
-                layer["_umap_options"] = datalayer.settings
-            datalayers.append(layer)
-        umapjson["layers"] = datalayers
-        return umapjson
+        umapjson["layers"] = []
+        # Dumped envelope ends with `"layers": []}`, layers go in between.
+        envelope = json_dumps(umapjson)
+        yield envelope[: -len("]}")].encode()
+        for index, datalayer in enumerate(self.datalayer_set.all()):
+            if index:
+                yield b", "
+            extra = (
+                {"_umap_options": datalayer.settings} if datalayer.settings else None
+            )
+            yield from json_object_chunks(datalayer.geojson.path, extra)
+        yield b"]}"
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_cache_version(self.pk)
 
     def get_absolute_url(self):
         return reverse("map", kwargs={"slug": self.slug or "map", "map_id": self.pk})
@@ -376,6 +467,32 @@ def upload_to(instance, filename):
     return os.path.join(instance.storage_root(), name)
 
 
+def get_derived_suffixes():
+    """Extensions of the files derived from a version, but vector tiles."""
+    encoded = list(ENCODINGS.values())
+    compact = [".compact"] + [f".compact{extension}" for extension in encoded]
+    levels = [f".z{zoom}" for zoom in settings.UMAP_SIMPLIFY_ZOOMS]
+    return [
+        *encoded,
+        ".idx",
+        ".pyramid",
+        *levels,
+        *compact,
+        # Compact encodings of the simplified levels.
+        *(f"{level}{suffix}" for level in levels for suffix in compact),
+    ]
+
+
+def delete_tree(storage, path):
+    """Delete the directory at `path` of `storage`, with its content."""
+    dirs, files = storage.listdir(path)
+    for name in files:
+        storage.delete(os.path.join(path, name))
+    for name in dirs:
+        delete_tree(storage, os.path.join(path, name))
+    storage.delete(path)
+
+
 class DataLayer(NamedModel):
     """
     Layer to store Features in.
@@ -428,8 +545,18 @@ class DataLayer(NamedModel):
             self.geojson.storage.delete(old_name)
             self.geojson.name = new_name
             super(DataLayer, self).save(force_insert, force_update, **kwargs)
+        if self.geojson and self.is_valid_version(Path(self.geojson.name).name):
+            self.add_version(Path(self.geojson.name).name)
         self.purge_gzip()
         self.purge_old_versions()
+        if settings.UMAP_GZIP and self.geojson:
+            self.precompress()
+        bump_cache_version(self.map_id)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        bump_cache_version(self.map_id)
+        return result
 
     def upload_to(self):
         root = self.storage_root()
@@ -473,22 +600,28 @@ class DataLayer(NamedModel):
             valid_prefixes.append(name.startswith("%s_" % self.old_id))
         return any(valid_prefixes) and name.endswith(".geojson")
 
-    def version_metadata(self, name):
-        els = name.split(".")[0].split("_")
-        return {
-            "name": name,
-            "at": els[1],
-            "size": self.geojson.storage.size(self.get_version_path(name)),
-        }
+    def add_version(self, name):
+        """Record the file `name` (stored in storage_root) in the versions index."""
+        self.version_set.get_or_create(
+            name=name,
+            defaults={
+                "at": DataLayerVersion.timestamp(name),
+                "size": lambda: self.geojson.storage.size(self.get_version_path(name)),
+            },
+        )
 
     @property
     def versions(self):
-        root = self.storage_root()
-        names = self.geojson.storage.listdir(root)[1]
-        names = [name for name in names if self.is_valid_version(name)]
-        versions = [self.version_metadata(name) for name in names]
-        versions.sort(reverse=True, key=operator.itemgetter("at"))
-        return versions
+        return [version.metadata() for version in self.version_set.all()]
+
+    def get_version_name(self, version):
+        """Return the name of the indexed file for `version`, or None."""
+        # The version is the trailing part of the name, see GZipMixin.read_version.
+        return (
+            self.version_set.filter(name__endswith=f"_{version}.geojson")
+            .values_list("name", flat=True)
+            .first()
+        )
 
     def get_version(self, name):
         path = self.get_version_path(name)
@@ -500,28 +633,102 @@ class DataLayer(NamedModel):
 
     def purge_old_versions(self):
         root = self.storage_root()
-        versions = self.versions[settings.UMAP_KEEP_VERSIONS :]
-        for version in versions:
-            name = version["name"]
+        purged = []
+        for version in self.version_set.all()[settings.UMAP_KEEP_VERSIONS :]:
             # Should not be in the list, but ensure to not delete the file
             # currently used in database
-            if self.geojson.name.endswith(name):
+            if self.geojson.name.endswith(version.name):
                 continue
             try:
-                self.geojson.storage.delete(os.path.join(root, name))
+                self.geojson.storage.delete(os.path.join(root, version.name))
             except FileNotFoundError:
                 pass
+            purged.append(version.pk)
+        if purged:
+            self.version_set.filter(pk__in=purged).delete()
 
     def purge_gzip(self):
+        """Remove the files derived from versions other than the current one.
+
+        Precompressed versions, spatial indexes, vector tiles, simplified
+        levels and compact encodings are all named after their version,
+        followed by an extension (see get_derived_suffixes).
+        """
         root = self.storage_root()
-        names = self.geojson.storage.listdir(root)[1]
-        prefixes = [f"{self.pk}_"]
-        if self.old_id:
-            prefixes.append(f"{self.old_id}_")
-        prefixes = tuple(prefixes)
-        for name in names:
-            if name.startswith(prefixes) and name.endswith(".gz"):
-                self.geojson.storage.delete(os.path.join(root, name))
+        storage = self.geojson.storage
+        suffixes = get_derived_suffixes()
+        for version in self.version_set.all():
+            # The current one, if any, is still valid.
+            if self.geojson.name.endswith(version.name):
+                continue
+            path = os.path.join(root, version.name)
+            for suffix in suffixes:
+                storage.delete(f"{path}{suffix}")
+            tiles = f"{path}.tiles"
+            if storage.exists(tiles):
+                delete_tree(storage, tiles)
+
+    def precompress(self):
+        """Precompress the current file, so it never happens when serving it."""
+        path = Path(self.geojson.path)
+        for encoding in get_encodings():
+            compressed_path = path.with_name(f"{path.name}{ENCODINGS[encoding]}")
+            if compressed_path.exists():
+                continue
+            # Other processes may want to compress it too: only one does.
+            with file_lock(path):
+                if not compressed_path.exists():
+                    compress_file(path, compressed_path, encoding)
+
+    def index(self):
+        """Build the spatial index of the current file, return its path.
+
+        Built on first need (a bbox or a tile request), not when saving.
+        """
+        path = Path(self.geojson.path)
+        index_path = path.with_name(f"{path.name}.idx")
+        if index_path.exists():
+            return index_path
+        with file_lock(path):
+            if not index_path.exists():
+                build_index(path, index_path)
+        return index_path
+
+    def pyramid(self):
+        """Build the simplified levels of the current file, return them.
+
+        Built on the first request with a `zoom`, not when saving.
+        """
+        path = Path(self.geojson.path)
+        pyramid_path = get_pyramid_path(path)
+        if not os.path.exists(pyramid_path):
+            with file_lock(path):
+                if not os.path.exists(pyramid_path):
+                    return build_pyramid(path, settings.UMAP_SIMPLIFY_ZOOMS)
+        return load_pyramid(pyramid_path)
+
+    def get_tile_path(self, z, x, y):
+        path = Path(self.geojson.path)
+        return path.with_name(f"{path.name}.tiles") / str(z) / str(x) / f"{y}.mvt"
+
+    def tile(self, z, x, y):
+        """Build the vector tile z/x/y of the current file, return its content.
+
+        Only tiles with features, up to UMAP_VECTOR_TILES_CACHE_MAX_ZOOM, are
+        written to disk (see get_tile_path): the others are cheap to build
+        again, and unbounded in number.
+        """
+        tile_path = self.get_tile_path(z, x, y)
+        if tile_path.exists():
+            return tile_path.read_bytes()
+        index = load_index(str(self.index()))
+        content = build_tile(index, z, x, y, name=str(self.pk))
+        if content and z <= settings.UMAP_VECTOR_TILES_CACHE_MAX_ZOOM:
+            tile_path.parent.mkdir(parents=True, exist_ok=True)
+            # Concurrent writers of the same tile write the same content.
+            with atomic_write(tile_path) as f:
+                f.write(content)
+        return content
 
     def can_edit(self, user=None, request=None):
         """
@@ -543,6 +750,38 @@ class DataLayer(NamedModel):
         return can
 
 
+class DataLayerVersion(models.Model):
+    """
+    Index of the files stored for each version of a DataLayer, so listing or
+    purging them does not need to scan the map storage directory.
+    """
+
+    datalayer = models.ForeignKey(
+        DataLayer, on_delete=models.CASCADE, related_name="version_set"
+    )
+    name = models.CharField(max_length=255)
+    at = models.BigIntegerField()
+    size = models.PositiveBigIntegerField()
+
+    class Meta:
+        ordering = ("-at",)
+        constraints = [
+            models.UniqueConstraint(
+                fields=["datalayer", "name"], name="unique_datalayer_version"
+            )
+        ]
+
+    def __str__(self):
+        return self.name
+
+    @staticmethod
+    def timestamp(name):
+        return int(name.split(".")[0].split("_")[1])
+
+    def metadata(self):
+        return {"name": self.name, "at": str(self.at), "size": self.size}
+
+
 class Star(models.Model):
     at = models.DateTimeField(auto_now=True)
     map = models.ForeignKey(Map, on_delete=models.CASCADE)
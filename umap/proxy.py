@@ -0,0 +1,337 @@
+"""Outbound requests of the AjaxProxy view, when not delegated to Nginx.
+
+Connections are kept alive and pooled per upstream host, the number of
+concurrent requests to a host is capped (a slow host then only ties up
+that many workers), and the body is streamed to the client instead of
+being read whole in memory.
+
+Responses are cached in memory, for the `ttl` asked by the map if any,
+else for the lifetime given by the upstream Cache-Control header. Stale
+entries with an ETag or a Last-Modified date are revalidated upstream.
+"""
+
+import socket
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .utils import ExpiringCache
+
+# (connect, read) timeouts, in seconds.
+TIMEOUT = (3.05, 10)
+CHUNK_SIZE = 2**16
+# Time to wait for a free slot when the host is already at its cap.
+SLOT_TIMEOUT = 2
+# Lifetime (in seconds) of responses without ttl nor Cache-Control max-age.
+DEFAULT_MAX_AGE = 180
+# Number of hostnames whose DNS answer is kept.
+RESOLVER_MAX_HOSTS = 1024
+
+
+class HostBusy(Exception):
+    """Too many requests in flight to this host."""
+
+
+class Resolver:
+    """Cache DNS answers for `ttl` seconds, failures are not cached.
+
+    Hostnames come from the proxied URLs, so only the `max_hosts` most
+    recently used ones are kept.
+    """
+
+    def __init__(self, ttl, max_hosts=RESOLVER_MAX_HOSTS):
+        self.cache = ExpiringCache(max_hosts, ttl)
+
+    def resolve(self, hostname):
+        address = self.cache.get(hostname)
+        if address is None:
+            address = socket.gethostbyname(hostname)
+            self.cache.set(hostname, address, size=1)
+        return address
+
+
+class Upstream:
+    """Response of the proxied host, which holds a slot until closed."""
+
+    def __init__(self, response, release):
+        self.response = response
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = response.headers
+        self._release = release
+
+    def __iter__(self):
+        try:
+            yield from self.response.iter_content(CHUNK_SIZE)
+        finally:
+            self.close()
+
+    def read(self):
+        try:
+            return self.response.content
+        finally:
+            self.close()
+
+    def close(self):
+        if self._release is None:
+            return
+        self.response.close()
+        self._release()
+        self._release = None
+
+
+class Slot:
+    """Requests in flight to a host, and the ones waiting for their turn."""
+
+    def __init__(self, size):
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.users = 0
+
+
+class Fetcher:
+    def __init__(self, max_per_host, slot_timeout=SLOT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.slot_timeout = slot_timeout
+        # Only hosts with requests in flight or waiting have an entry.
+        self.slots = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        # Only keep as many connections alive per host as can be in use.
+        adapter = HTTPAdapter(pool_maxsize=max_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def take_slot(self, host):
+        with self.lock:
+            slot = self.slots.get(host)
+            if slot is None:
+                slot = self.slots[host] = Slot(self.max_per_host)
+            slot.users += 1
+        if slot.semaphore.acquire(timeout=self.slot_timeout):
+            return slot
+        self.leave_slot(host, slot)
+        return None
+
+    def leave_slot(self, host, slot):
+        with self.lock:
+            slot.users -= 1
+            if not slot.users:
+                del self.slots[host]
+
+    def release_slot(self, host, slot):
+        slot.semaphore.release()
+        self.leave_slot(host, slot)
+
+    def fetch(self, url, headers=None, timeout=TIMEOUT):
+        """Send a GET request to `url`, raise HostBusy if its host is at cap.
+
+        The body is not read yet: iterate over the returned Upstream, or call
+        its `read` method, either of which frees the slot.
+        """
+        host = urlparse(url).netloc
+        slot = self.take_slot(host)
+        if slot is None:
+            raise HostBusy(url)
+
+        def release():
+            self.release_slot(host, slot)
+
+        try:
+            response = self.session.get(
+                url, headers=headers, stream=True, timeout=timeout
+            )
+        except BaseException:
+            release()
+            raise
+        return Upstream(response, release)
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in (value or "").split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+def get_max_age(headers):
+    """Lifetime allowed by the upstream headers, None if it must not be stored."""
+    directives = parse_cache_control(headers.get("Cache-Control"))
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return int(directives[name])
+    return DEFAULT_MAX_AGE
+
+
+class Entry:
+    """A cached response body, with what is needed to revalidate it."""
+
+    def __init__(self, body, headers, max_age):
+        self.body = body
+        self.size = len(body)
+        self.content_type = headers.get("Content-Type")
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        self.refresh(max_age)
+
+    def refresh(self, max_age):
+        self.fetched_at = time.monotonic()
+        self.max_age = max_age
+
+    def lifetime(self, ttl=None):
+        return ttl if ttl else self.max_age
+
+    def expires_in(self, ttl=None):
+        return self.lifetime(ttl) - (time.monotonic() - self.fetched_at)
+
+    def is_fresh(self, ttl=None):
+        return self.expires_in(ttl) > 0
+
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class Recorder:
+    """Iterate over an upstream response, storing its body once complete."""
+
+    def __init__(self, cache, url, upstream, max_age):
+        self.cache = cache
+        self.url = url
+        self.upstream = upstream
+        self.status_code = upstream.status_code
+        self.headers = upstream.headers
+        self.max_age = max_age
+        self.closed = False
+
+    def __iter__(self):
+        chunks, size = [], 0
+        for chunk in self.upstream:
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.cache.max_entry_size:
+                    # Do not keep the others waiting for it.
+                    chunks = None
+                    self.cache.done(self.url)
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            entry = Entry(b"".join(chunks), self.headers, self.max_age)
+            self.cache.store(self.url, entry)
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.upstream.close()
+            self.cache.done(self.url)
+
+
+class ProxyCache:
+    """In memory cache of the proxied responses, bounded in bytes.
+
+    Concurrent misses of the same URL are collapsed: the first request
+    fetches it, the others wait for it to be stored. Least recently used
+    entries are evicted first.
+    """
+
+    def __init__(self, fetcher, max_size):
+        self.fetcher = fetcher
+        self.max_size = max_size
+        # Larger responses are only streamed.
+        self.max_entry_size = max_size // 8
+        self.entries = OrderedDict()
+        self.size = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def store(self, url, entry):
+        with self.lock:
+            self.discard(url)
+            self.entries[url] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def done(self, url):
+        with self.lock:
+            event = self.inflight.pop(url, None)
+        if event is not None:
+            event.set()
+
+    def lookup(self, url, ttl):
+        """Return the entry, if fresh, else wait for or lead its fetching."""
+        while True:
+            with self.lock:
+                entry = self.entries.get(url)
+                if entry is not None:
+                    self.entries.move_to_end(url)
+                    if entry.is_fresh(ttl):
+                        return entry, False
+                event = self.inflight.get(url)
+                if event is None:
+                    self.inflight[url] = threading.Event()
+                    return entry, True
+            if not event.wait(sum(TIMEOUT)):
+                # Stuck upstream: do not pile up behind it.
+                return entry, False
+
+    def get(self, url, ttl=None, headers=None):
+        """Return a fresh Entry, or the upstream response to iterate over.
+
+        The upstream response is a Recorder when it will be stored, which
+        happens once iterated over to the end.
+        """
+        entry, leader = self.lookup(url, ttl)
+        if entry is not None and entry.is_fresh(ttl):
+            return entry
+        request_headers = dict(headers or {})
+        if entry is not None:
+            request_headers.update(entry.validators())
+        try:
+            upstream = self.fetcher.fetch(url, headers=request_headers)
+        except BaseException:
+            if leader:
+                self.done(url)
+            raise
+        max_age = get_max_age(upstream.headers)
+        if upstream.status_code == 304 and entry is not None:
+            upstream.close()
+            entry.refresh(entry.max_age if max_age is None else max_age)
+            if leader:
+                self.done(url)
+            return entry
+        if not leader:
+            return upstream
+        if upstream.status_code != 200 or max_age is None:
+            if max_age is None:
+                with self.lock:
+                    self.discard(url)
+            self.done(url)
+            return upstream
+        return Recorder(self, url, upstream, max_age)
+
+
+RESOLVER = Resolver(settings.UMAP_PROXY_DNS_TTL)
+FETCHER = Fetcher(settings.UMAP_PROXY_MAX_PER_HOST)
+CACHE = ProxyCache(FETCHER, settings.UMAP_PROXY_CACHE_SIZE)
@@ -243,6 +243,12 @@ UMAP_EXTRA_URLS = {
     "edit_in_osm": "https://www.openstreetmap.org/edit#map={zoom}/{lat}/{lng}",
 }
 UMAP_KEEP_VERSIONS = env.int("UMAP_KEEP_VERSIONS", default=10)
+# Used by the ajax proxy when UMAP_XSENDFILE_HEADER is not set: requests in
+# flight to the same host, how long (in seconds) to cache DNS answers, and the
+# max size (in bytes) of the responses cached by each process.
+UMAP_PROXY_MAX_PER_HOST = env.int("UMAP_PROXY_MAX_PER_HOST", default=4)
+UMAP_PROXY_DNS_TTL = env.int("UMAP_PROXY_DNS_TTL", default=60)
+UMAP_PROXY_CACHE_SIZE = env.int("UMAP_PROXY_CACHE_SIZE", default=2**25)
 SITE_URL = env("SITE_URL", default="http://umap.org")
 SHORT_SITE_URL = env("SHORT_SITE_URL", default=None)
 SITE_NAME = "uMap"
@@ -262,6 +268,27 @@ UMAP_HOME_FEED = "latest"
 
 UMAP_READONLY = env("UMAP_READONLY", default=False)
 UMAP_GZIP = True
+# Precompressed versions of the layers (when UMAP_GZIP is set), by content
+# coding, with their compression level. Brotli ("br") and Zstandard ("zstd")
+# need the "compression" extra, they are skipped without it.
+# They are all written while saving the layer, so higher levels make saves
+# slower: for a 14 MB layer, gzip 6 takes about 0.8 s (gzip 9 3 s), br 4 0.5 s
+# (br 9 4 s) and zstd 9 0.6 s (zstd 15 7 s), for files a few percent smaller
+# at most.
+UMAP_PRECOMPRESS = env.dict(
+    "UMAP_PRECOMPRESS",
+    cast={"value": int},
+    default={"gzip": 6, "br": 4, "zstd": 9},
+)
+# Vector tiles of the layers with features are cached on disk up to this zoom.
+UMAP_VECTOR_TILES_CACHE_MAX_ZOOM = env.int(
+    "UMAP_VECTOR_TILES_CACHE_MAX_ZOOM", default=11
+)
+# Zooms of the simplified levels of the layers, served for a `zoom` query
+# parameter, and built on its first request.
+UMAP_SIMPLIFY_ZOOMS = env.list("UMAP_SIMPLIFY_ZOOMS", cast=int, default=[5, 8, 11])
+# Let the browsers ask for the compact encoding of the layers coordinates.
+UMAP_COMPACT_GEOJSON = env.bool("UMAP_COMPACT_GEOJSON", default=False)
 LOCALE_PATHS = [os.path.join(PROJECT_DIR, "locale")]
 
 LEAFLET_LONGITUDE = env.int("LEAFLET_LONGITUDE", default=2)
@@ -314,3 +341,22 @@ WEBSOCKET_ENABLED = env.bool("WEBSOCKET_ENABLED", default=False)
 WEBSOCKET_BACK_HOST = env("WEBSOCKET_BACK_HOST", default="localhost")
 WEBSOCKET_BACK_PORT = env.int("WEBSOCKET_BACK_PORT", default=8001)
 WEBSOCKET_FRONT_URI = env("WEBSOCKET_FRONT_URI", default="ws://localhost:8001")
+# Needed to run more than one websocket server process, see run_websocket_broker.
+WEBSOCKET_BROKER_URL = env("WEBSOCKET_BROKER_URL", default="")
+# Where to serve the metrics of the websocket server (GET /metrics), e.g.
+# tcp://127.0.0.1:8002 or unix:///run/umap/metrics.sock. Disabled when empty.
+WEBSOCKET_METRICS_URL = env("WEBSOCKET_METRICS_URL", default="")
+# Messages queued for a slow peer: past the high water mark, updates of the same
+# key are coalesced, past the max size the peer is disconnected.
+WEBSOCKET_QUEUE_HIGH_WATER = env.int("WEBSOCKET_QUEUE_HIGH_WATER", default=100)
+WEBSOCKET_QUEUE_MAX_SIZE = env.int("WEBSOCKET_QUEUE_MAX_SIZE", default=1000)
+# Max size (in bytes) of the unsaved operations kept per room for late joiners.
+WEBSOCKET_ROOM_LOG_SIZE = env.int("WEBSOCKET_ROOM_LOG_SIZE", default=2**23)
+# Compression of the websocket messages: "deflate" (permessage-deflate) or "".
+WEBSOCKET_COMPRESSION = env("WEBSOCKET_COMPRESSION", default="deflate")
+# Compression window (9 to 15, as a power of 2) and memory level (1 to 9): each
+# connection keeps about 2**(bits + 2) + 2**(level + 9) bytes of zlib state.
+WEBSOCKET_DEFLATE_WINDOW_BITS = env.int("WEBSOCKET_DEFLATE_WINDOW_BITS", default=14)
+WEBSOCKET_DEFLATE_MEMORY_LEVEL = env.int("WEBSOCKET_DEFLATE_MEMORY_LEVEL", default=5)
+# Let the browsers send geometries with a compact encoding of their coordinates.
+WEBSOCKET_COMPACT_COORDINATES = env.bool("WEBSOCKET_COMPACT_COORDINATES", default=False)
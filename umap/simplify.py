@@ -0,0 +1,271 @@
+"""Simplified versions of a datalayer file, for the lower zooms.
+
+Each level of the pyramid is the layer with its lines and rings simplified
+(Douglas-Peucker) to a tolerance of a pixel at a given zoom, and its
+coordinates rounded accordingly. Points are left as is.
+
+To keep the topology of shared borders (adjacent administrative areas, for
+instance), paths are first cut into arcs at their junctions, as TopoJSON
+does: an arc shared by two features is simplified once, so both keep the
+same border and no gap nor overlap opens between them.
+
+Levels are written next to the GeoJSON file, as `<name>.geojson.z<zoom>`,
+and the list of levels as `<name>.geojson.pyramid`. Levels which would
+not make the file noticeably smaller are not written, the original file
+is served instead.
+"""
+
+import json
+import math
+from functools import lru_cache
+
+from .utils import atomic_write
+
+# Tile size used by Leaflet, to compute the size of a pixel at a given zoom.
+TILE_SIZE = 256
+MAX_LATITUDE = 85.0511287798066
+# Only keep levels at least this much smaller than the original file.
+MIN_GAIN = 0.1
+
+
+def get_tolerance(zoom):
+    """Size of a pixel at `zoom`, in degrees of longitude."""
+    return 360 / (TILE_SIZE * 2**zoom)
+
+
+def project(position):
+    """Web Mercator, scaled so that distances compare to get_tolerance."""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, position[1]))
+    return position[0], math.degrees(math.asinh(math.tan(math.radians(lat))))
+
+
+def douglas_peucker(points, tolerance):
+    """Return the points of the polyline to keep, ends included."""
+    if len(points) < 3:
+        return points
+    projected = [project(point) for point in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    limit = tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        (ax, ay), (bx, by) = projected[first], projected[last]
+        dx, dy = bx - ax, by - ay
+        length = dx * dx + dy * dy
+        farthest, index = -1, None
+        for current in range(first + 1, last):
+            px, py = projected[current]
+            if length:
+                t = max(0, min(1, ((px - ax) * dx + (py - ay) * dy) / length))
+                qx, qy = ax + t * dx, ay + t * dy
+            else:
+                qx, qy = ax, ay
+            distance = (px - qx) ** 2 + (py - qy) ** 2
+            if distance > farthest:
+                farthest, index = distance, current
+        if index is not None and farthest > limit:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def iter_paths(geometry):
+    """Yield (kind, coordinates) of the lines and rings of `geometry`."""
+    if not geometry:
+        return
+    kind = geometry.get("type")
+    coordinates = geometry.get("coordinates") or []
+    if kind == "GeometryCollection":
+        for child in geometry.get("geometries") or []:
+            yield from iter_paths(child)
+    elif kind == "LineString":
+        yield "line", coordinates
+    elif kind == "MultiLineString":
+        for line in coordinates:
+            yield "line", line
+    elif kind == "Polygon":
+        for ring in coordinates:
+            yield "ring", ring
+    elif kind == "MultiPolygon":
+        for polygon in coordinates:
+            for ring in polygon:
+                yield "ring", ring
+
+
+def as_points(coordinates):
+    return [tuple(position) for position in coordinates]
+
+
+def find_junctions(features):
+    """Return the points where shared paths meet or part, and line ends."""
+    neighbours, junctions = {}, set()
+    for feature in features:
+        for kind, coordinates in iter_paths(feature.get("geometry")):
+            points = as_points(coordinates)
+            if kind == "ring":
+                # Do not count the closing point twice.
+                points = points[:-1] if points and points[0] == points[-1] else points
+                cyclic = True
+            else:
+                cyclic = False
+                if points:
+                    junctions.update((points[0], points[-1]))
+            for index, point in enumerate(points):
+                if not cyclic and index in (0, len(points) - 1):
+                    continue
+                around = frozenset(
+                    (points[index - 1], points[(index + 1) % len(points)])
+                )
+                seen = neighbours.setdefault(point, around)
+                if seen != around:
+                    junctions.add(point)
+    return junctions
+
+
+class Simplifier:
+    def __init__(self, junctions, tolerance, precision):
+        self.junctions = junctions
+        self.tolerance = tolerance
+        self.precision = precision
+        self.arcs = {}
+
+    def arc(self, points):
+        # Shared arcs are run along either way: simplify them one way only.
+        reverse = points[::-1] < points
+        key = tuple(points[::-1] if reverse else points)
+        if key not in self.arcs:
+            self.arcs[key] = douglas_peucker(list(key), self.tolerance)
+        simplified = self.arcs[key]
+        return simplified[::-1] if reverse else simplified
+
+    def path(self, points, closed):
+        if closed:
+            if points and points[0] == points[-1]:
+                points = points[:-1]
+            if not points:
+                return []
+            cuts = [i for i, point in enumerate(points) if point in self.junctions]
+            # Without junction, start from the same point whatever the
+            # original start, so a ring shared with another one (an enclave)
+            # gets the same simplification.
+            start = cuts[0] if cuts else points.index(min(points))
+            points = points[start:] + points[:start] + [points[start]]
+        out = []
+        first = 0
+        for index in range(1, len(points)):
+            if index == len(points) - 1 or points[index] in self.junctions:
+                arc = self.arc(points[first : index + 1])
+                out.extend(arc if not out else arc[1:])
+                first = index
+        if len(points) == 1:
+            out = points
+        return [self.round(point) for point in out]
+
+    def round(self, point):
+        return [round(value, self.precision) for value in point]
+
+    def ring(self, coordinates):
+        ring = self.path(as_points(coordinates), closed=True)
+        # A valid ring has at least 4 positions, ends included.
+        return ring if len(ring) >= 4 else None
+
+    def polygon(self, rings):
+        if not rings:
+            return None
+        exterior = self.ring(rings[0])
+        if exterior is None:
+            return None
+        holes = [self.ring(ring) for ring in rings[1:]]
+        return [exterior] + [hole for hole in holes if hole is not None]
+
+    def geometry(self, geometry):
+        """Return the simplified geometry, or None if it collapsed."""
+        if not geometry:
+            return geometry
+        kind = geometry.get("type")
+        coordinates = geometry.get("coordinates") or []
+        if kind == "LineString":
+            coordinates = self.path(as_points(coordinates), closed=False)
+        elif kind == "MultiLineString":
+            coordinates = [
+                self.path(as_points(line), closed=False) for line in coordinates
+            ]
+        elif kind == "Polygon":
+            coordinates = self.polygon(coordinates)
+        elif kind == "MultiPolygon":
+            polygons = [self.polygon(polygon) for polygon in coordinates]
+            coordinates = [polygon for polygon in polygons if polygon] or None
+        elif kind == "GeometryCollection":
+            children = [self.geometry(child) for child in geometry["geometries"]]
+            children = [child for child in children if child]
+            return {**geometry, "geometries": children} if children else None
+        else:
+            return geometry
+        if coordinates is None:
+            return None
+        return {**geometry, "coordinates": coordinates}
+
+
+def simplify(data, zoom):
+    """Return a copy of the GeoJSON object `data` simplified for `zoom`.
+
+    Features whose polygons collapse (smaller than a pixel) are left out.
+    """
+    features = data.get("features") or []
+    tolerance = get_tolerance(zoom)
+    # Round to a tenth of the tolerance.
+    precision = max(0, math.ceil(math.log10(10 / tolerance)))
+    simplifier = Simplifier(find_junctions(features), tolerance, precision)
+    simplified = []
+    for feature in features:
+        geometry = feature.get("geometry")
+        if geometry:
+            geometry = simplifier.geometry(geometry)
+            if geometry is None:
+                continue
+        simplified.append({**feature, "geometry": geometry})
+    return {**data, "features": simplified}
+
+
+def get_level_path(path, zoom):
+    return f"{path}.z{zoom}"
+
+
+def get_pyramid_path(path):
+    return f"{path}.pyramid"
+
+
+def build_pyramid(geojson_path, zooms):
+    """Write the levels of the GeoJSON file at `geojson_path` for `zooms`."""
+    with open(geojson_path, "rb") as f:
+        original = f.read()
+    data = json.loads(original)
+    levels = []
+    for zoom in sorted(zooms):
+        content = json.dumps(simplify(data, zoom), separators=(",", ":")).encode()
+        if len(content) > len(original) * (1 - MIN_GAIN):
+            continue
+        with atomic_write(get_level_path(geojson_path, zoom)) as f:
+            f.write(content)
+        levels.append(zoom)
+    # Written last, as the mark of a complete pyramid.
+    with atomic_write(get_pyramid_path(geojson_path)) as f:
+        f.write(json.dumps(levels).encode())
+    return levels
+
+
+@lru_cache(maxsize=128)
+def load_pyramid(path):
+    """Pyramids are never modified, so keep the last ones used in memory."""
+    with open(path, "rb") as f:
+        return json.loads(f.read())
+
+
+def pick_level(levels, zoom):
+    """Return the coarsest level detailed enough for `zoom`, or None."""
+    for level in sorted(levels):
+        if level >= zoom:
+            return level
+    return None
@@ -0,0 +1,201 @@
+"""Spatial index of a datalayer file, to serve only the features in a bbox.
+
+The index is written next to the GeoJSON file, as `<name>.geojson.idx`:
+a first line with a JSON header, then each feature serialized on its own
+line. The header holds the other members of the GeoJSON object, the
+bbox, byte offset and length of each feature, and a grid over the bbox
+of the layer, listing the features touching each cell. As versions are
+never modified, neither is their index.
+"""
+
+import json
+import math
+from functools import lru_cache
+
+from .utils import atomic_write
+
+FORMAT = 1
+# Target number of features per grid cell, and max number of cells per axis.
+FEATURES_PER_CELL = 16
+MAX_CELLS = 256
+# Features spanning more than this share of the cells are always checked.
+LARGE_SHARE = 0.25
+# Tile size used by Leaflet, to compute the size of a pixel at a given zoom.
+TILE_SIZE = 256
+
+
+def iter_positions(geometry):
+    if not geometry:
+        return
+    if geometry.get("type") == "GeometryCollection":
+        for child in geometry.get("geometries") or []:
+            yield from iter_positions(child)
+        return
+    stack = [geometry.get("coordinates")]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, list) or not node:
+            continue
+        if isinstance(node[0], (int, float)):
+            yield node
+        else:
+            stack.extend(node)
+
+
+def get_bbox(geometry):
+    """Return [west, south, east, north] of the geometry, or None if empty."""
+    xs, ys = [], []
+    for position in iter_positions(geometry):
+        if len(position) >= 2:
+            xs.append(position[0])
+            ys.append(position[1])
+    if not xs:
+        return None
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class Grid:
+    def __init__(self, bbox, cols, rows):
+        self.bbox = bbox
+        self.cols = cols
+        self.rows = rows
+        # Avoid zero sized cells for layers with a single point.
+        self.width = max(bbox[2] - bbox[0], 1e-9) / cols
+        self.height = max(bbox[3] - bbox[1], 1e-9) / rows
+
+    @classmethod
+    def for_features(cls, bbox, count):
+        side = max(1, min(MAX_CELLS, round(math.sqrt(count / FEATURES_PER_CELL))))
+        return cls(bbox, side, side)
+
+    def span(self, bbox):
+        """Return the (col, row) ranges of the cells intersecting `bbox`."""
+
+        def clamp(value, size):
+            return max(0, min(size - 1, int(math.floor(value))))
+
+        x0, y0 = self.bbox[0], self.bbox[1]
+        cols = range(
+            clamp((bbox[0] - x0) / self.width, self.cols),
+            clamp((bbox[2] - x0) / self.width, self.cols) + 1,
+        )
+        rows = range(
+            clamp((bbox[1] - y0) / self.height, self.rows),
+            clamp((bbox[3] - y0) / self.height, self.rows) + 1,
+        )
+        return cols, rows
+
+
+def build_index(geojson_path, index_path):
+    """Write the index of the GeoJSON file at `geojson_path`."""
+    with open(geojson_path, "rb") as f:
+        data = json.load(f)
+    features = data.pop("features", None) or []
+    lines, entries, offset = [], [], 0
+    for feature in features:
+        line = json.dumps(feature, separators=(",", ":")).encode() + b"\n"
+        bbox = get_bbox(feature.get("geometry"))
+        entries.append([*(bbox or [None] * 4), offset, len(line) - 1])
+        lines.append(line)
+        offset += len(line)
+    bboxes = [entry[:4] for entry in entries if entry[0] is not None]
+    header = {"format": FORMAT, "members": data, "features": entries}
+    if bboxes:
+        layer_bbox = [
+            min(bbox[0] for bbox in bboxes),
+            min(bbox[1] for bbox in bboxes),
+            max(bbox[2] for bbox in bboxes),
+            max(bbox[3] for bbox in bboxes),
+        ]
+        grid = Grid.for_features(layer_bbox, len(bboxes))
+        cells, large = {}, []
+        for index, entry in enumerate(entries):
+            if entry[0] is None:
+                continue
+            cols, rows = grid.span(entry[:4])
+            if len(cols) * len(rows) > LARGE_SHARE * grid.cols * grid.rows > 1:
+                large.append(index)
+                continue
+            for col in cols:
+                for row in rows:
+                    cells.setdefault(f"{col},{row}", []).append(index)
+        header.update(
+            bbox=layer_bbox, grid=[grid.cols, grid.rows], cells=cells, large=large
+        )
+    with atomic_write(index_path) as f:
+        f.write(json.dumps(header, separators=(",", ":")).encode() + b"\n")
+        f.writelines(lines)
+
+
+class SpatialIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            self.start = f.tell()
+        if header.get("format") != FORMAT:
+            raise ValueError(f"Unknown spatial index format in {path}")
+        self.members = header["members"]
+        self.features = header["features"]
+        self.grid = None
+        if "grid" in header:
+            self.grid = Grid(header["bbox"], *header["grid"])
+            self.cells = header["cells"]
+            self.large = header["large"]
+
+    def search(self, bbox, zoom=None):
+        """Return the indexes of the features intersecting `bbox`, in order.
+
+        With a `zoom`, features smaller than a pixel at this zoom are left
+        out, except points.
+        """
+        if self.grid is None or not intersects(bbox, self.grid.bbox):
+            return []
+        candidates = set(self.large)
+        cols, rows = self.grid.span(bbox)
+        for col in cols:
+            for row in rows:
+                candidates.update(self.cells.get(f"{col},{row}", ()))
+        pixel = None
+        if zoom is not None:
+            pixel = 360 / (TILE_SIZE * 2**zoom)
+        found = []
+        for index in sorted(candidates):
+            west, south, east, north = self.features[index][:4]
+            if not intersects(bbox, (west, south, east, north)):
+                continue
+            if pixel is not None:
+                width, height = east - west, north - south
+                if (width or height) and width < pixel and height < pixel:
+                    continue
+            found.append(index)
+        return found
+
+    def read_features(self, indexes):
+        """Yield the serialized features at `indexes`."""
+        with open(self.path, "rb") as f:
+            for index in indexes:
+                offset, length = self.features[index][4:]
+                f.seek(self.start + offset)
+                yield f.read(length)
+
+    def read(self, indexes):
+        """Return the GeoJSON object with the features at `indexes`, as bytes."""
+        chunks = list(self.read_features(indexes))
+        members = dict(self.members, type=self.members.get("type", "FeatureCollection"))
+        head = json.dumps(members, separators=(",", ":")).encode()
+        # Put the features before the closing brace of the other members.
+        return b"".join(
+            [head[:-1], b"," if len(head) > 2 else b"", b'"features":[']
+            + [b",".join(chunks), b"]}"]
+        )
+
+
+@lru_cache(maxsize=8)
+def load_index(path):
+    """Indexes are never modified, so keep the last ones used in memory."""
+    return SpatialIndex(path)
@@ -14,6 +14,7 @@ import Orderable from './orderable.js'
 import Importer from './importer.js'
 import Help from './help.js'
 import { SyncEngine } from './sync/engine.js'
+import * as Coordinates from './sync/coordinates.js'
 import {
   uMapAlert as Alert,
   uMapAlertCreation as AlertCreation,
@@ -32,6 +33,7 @@ window.U = {
   AjaxAutocompleteMultiple,
   Browser,
   Caption,
+  Coordinates,
   Dialog,
   EditPanel,
   Facets,
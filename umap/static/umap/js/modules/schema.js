@@ -61,6 +61,14 @@ export const SCHEMA = {
     type: String,
     impacts: ['data'],
   },
+  coordinatesPrecision: {
+    type: Number,
+    impacts: [],
+    label: translate('Coordinates precision'),
+    helpText: translate(
+      'Optional. Number of decimals kept when saving the coordinates, 6 is about 10 cm.'
+    ),
+  },
   dashArray: {
     type: String,
     impacts: ['data'],
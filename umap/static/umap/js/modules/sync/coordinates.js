@@ -0,0 +1,180 @@
+/**
+ * Compact encoding of the coordinates of the geometries sent to the peers.
+ *
+ * Coordinates are rounded to 1e-7 degree (about 1 cm, Leaflet rounds
+ * them to 1e-6 when exporting GeoJSON), and each value is stored as the
+ * zigzag varint of its difference with the same value of the previous
+ * position. The bytes are then base64 encoded, as the rest of the
+ * message is JSON.
+ *
+ * The structure is kept in the bytes: first the depth of the nesting
+ * (0 for a Point, 3 for a MultiPolygon) and the dimension of the
+ * positions, then for each array its length followed by its items.
+ *
+ * An encoded geometry has a `compact` string instead of `coordinates`, and
+ * a `precision` if it was rounded to another number of decimals than 7.
+ *
+ * Datalayers are served with this encoding too, when asked for with the
+ * COMPACT_GEOJSON media type.
+ */
+
+const FACTOR = 1e7
+
+export const COMPACT_GEOJSON = 'application/vnd.umap.compact+json'
+
+// Bitwise operators work on 32 bits integers, which is too short for
+// longitudes, so use plain arithmetic.
+function writeVarint(bytes, value) {
+  while (value >= 128) {
+    bytes.push((value % 128) + 128)
+    value = Math.floor(value / 128)
+  }
+  bytes.push(value)
+}
+
+function writeSigned(bytes, value) {
+  writeVarint(bytes, value >= 0 ? value * 2 : -value * 2 - 1)
+}
+
+function getShape(coordinates) {
+  let depth = 0
+  let node = coordinates
+  while (Array.isArray(node[0])) {
+    node = node[0]
+    depth++
+  }
+  return [depth, node.length]
+}
+
+function isPosition(node, dimension) {
+  return (
+    Array.isArray(node) &&
+    node.length === dimension &&
+    node.every((value) => Number.isFinite(value))
+  )
+}
+
+export function encodeCoordinates(coordinates) {
+  const [depth, dimension] = getShape(coordinates)
+  const bytes = []
+  const previous = new Array(dimension).fill(0)
+  writeVarint(bytes, depth)
+  writeVarint(bytes, dimension)
+  const write = (node, level) => {
+    if (level === 0) {
+      if (!isPosition(node, dimension)) throw new Error('Unexpected position')
+      node.forEach((value, index) => {
+        const rounded = Math.round(value * FACTOR)
+        writeSigned(bytes, rounded - previous[index])
+        previous[index] = rounded
+      })
+      return
+    }
+    if (!Array.isArray(node)) throw new Error('Unexpected coordinates')
+    writeVarint(bytes, node.length)
+    for (const child of node) write(child, level - 1)
+  }
+  write(coordinates, depth)
+  // String.fromCharCode(...bytes) would overflow the stack for long lines.
+  let binary = ''
+  for (let index = 0; index < bytes.length; index += 8192) {
+    binary += String.fromCharCode(...bytes.slice(index, index + 8192))
+  }
+  return btoa(binary)
+}
+
+export function decodeCoordinates(encoded, factor = FACTOR) {
+  const binary = atob(encoded)
+  let offset = 0
+  const readVarint = () => {
+    let value = 0
+    let scale = 1
+    let byte
+    do {
+      byte = binary.charCodeAt(offset++)
+      value += (byte % 128) * scale
+      scale *= 128
+    } while (byte >= 128)
+    return value
+  }
+  const readSigned = () => {
+    const value = readVarint()
+    return value % 2 ? -(value + 1) / 2 : value / 2
+  }
+  const depth = readVarint()
+  const dimension = readVarint()
+  const previous = new Array(dimension).fill(0)
+  const read = (level) => {
+    if (level === 0) {
+      return previous.map((value, index) => {
+        previous[index] = value + readSigned()
+        return previous[index] / factor
+      })
+    }
+    const length = readVarint()
+    const node = []
+    for (let index = 0; index < length; index++) node.push(read(level - 1))
+    return node
+  }
+  return read(depth)
+}
+
+function encodeGeometry(geometry) {
+  if (!geometry || !Array.isArray(geometry.coordinates)) return geometry
+  let compact
+  try {
+    compact = encodeCoordinates(geometry.coordinates)
+  } catch (error) {
+    // Mixed dimensions or invalid values: keep it as is.
+    return geometry
+  }
+  const { coordinates, ...encoded } = geometry
+  encoded.compact = compact
+  return encoded
+}
+
+function decodeGeometry(geometry) {
+  if (geometry && Array.isArray(geometry.geometries)) {
+    return { ...geometry, geometries: geometry.geometries.map(decodeGeometry) }
+  }
+  if (!geometry || typeof geometry.compact !== 'string') return geometry
+  const { compact, precision, ...decoded } = geometry
+  const factor = Number.isInteger(precision) ? 10 ** precision : FACTOR
+  decoded.coordinates = decodeCoordinates(compact, factor)
+  return decoded
+}
+
+/**
+ * Decode in place the geometries of a FeatureCollection served with the
+ * COMPACT_GEOJSON media type.
+ */
+export function decodeGeoJSON(geojson) {
+  for (const feature of geojson.features || []) {
+    feature.geometry = decodeGeometry(feature.geometry)
+  }
+  return geojson
+}
+
+/**
+ * Return a copy of the operation with the geometry it carries encoded:
+ * either the value of a feature upsert, or the value of a geometry update.
+ */
+export function encodeOperation(operation) {
+  const { subject, key, value } = operation
+  if (subject !== 'feature' || !value) return operation
+  if (key === 'geometry') return { ...operation, value: encodeGeometry(value) }
+  if (value.geometry) {
+    return { ...operation, value: { ...value, geometry: encodeGeometry(value.geometry) } }
+  }
+  return operation
+}
+
+export function decodeOperation(operation) {
+  const { subject, key, value } = operation
+  if (subject !== 'feature' || !value) return operation
+  if (key === 'geometry') return { ...operation, value: decodeGeometry(value) }
+  if (value.geometry) {
+    return { ...operation, value: { ...value, geometry: decodeGeometry(value.geometry) } }
+  }
+  return operation
+}
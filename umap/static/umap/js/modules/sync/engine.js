@@ -1,8 +1,10 @@
 import { WebSocketTransport } from './websocket.js'
 import { MapUpdater, DataLayerUpdater, FeatureUpdater } from './updaters.js'
+import { encodeOperation, decodeOperation } from './coordinates.js'
 
 export class SyncEngine {
   constructor(map) {
+    this.map = map
     this.updaters = {
       map: new MapUpdater(map),
       feature: new FeatureUpdater(map),
@@ -12,12 +14,20 @@ export class SyncEngine {
   }
 
   async authenticate(tokenURI, webSocketURI, server) {
+    this._authentication = [tokenURI, webSocketURI, server]
     const [response, _, error] = await server.get(tokenURI)
     if (!error) {
       this.start(webSocketURI, response.token)
     }
   }
 
+  // Called by the transport layer when some messages have been lost.
+  async resync() {
+    console.warn('Some real-time updates were lost, reconnecting')
+    this.stop()
+    if (this._authentication) await this.authenticate(...this._authentication)
+  }
+
   start(webSocketURI, authToken) {
     this.transport = new WebSocketTransport(webSocketURI, authToken, this)
   }
@@ -38,7 +48,22 @@ export class SyncEngine {
   receive({ kind, ...payload }) {
     if (kind == 'operation') {
       let updater = this._getUpdater(payload.subject, payload.metadata)
-      updater.applyMessage(payload)
+      updater.applyMessage(decodeOperation(payload))
+    } else if (kind == 'batch') {
+      // Operations coalesced by the server, to apply in order.
+      for (const operation of payload.operations) {
+        this.receive(operation)
+      }
+    } else if (kind == 'snapshot') {
+      // Operations made in the room before we joined: some may already
+      // be in the saved data, or target data we do not have.
+      for (const operation of payload.operations) {
+        try {
+          this.receive(operation)
+        } catch (error) {
+          console.error('Unable to apply operation from snapshot', operation, error)
+        }
+      }
     } else {
       throw new Error(`Unknown dispatch kind: ${kind}`)
     }
@@ -46,6 +71,10 @@ export class SyncEngine {
 
   _send(message) {
     if (this.transport) {
+      // Peers can always decode it, see coordinates.js.
+      if (this.map.options?.websocketCompactCoordinates) {
+        message = encodeOperation(message)
+      }
       this.transport.send('operation', message)
     }
   }
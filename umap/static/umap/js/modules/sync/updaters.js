@@ -48,9 +48,15 @@ export class MapUpdater extends BaseUpdater {
 }
 
 export class DataLayerUpdater extends BaseUpdater {
-  upsert({ value }) {
+  upsert({ value, metadata }) {
     // Inserts does not happen (we use multiple updates instead).
-    this.map.createDataLayer(value, false)
+    // A layer we already have (loaded from the server) is only updated.
+    const datalayer = metadata?.id && this.map.getDataLayerByUmapId(metadata.id)
+    if (datalayer) {
+      datalayer.updateOptions(value)
+    } else {
+      this.map.createDataLayer(value, false)
+    }
     this.map.render([])
   }
 
@@ -1,3 +1,6 @@
+// Close code used by the server when messages could not be delivered.
+const RESYNC = 4001
+
 export class WebSocketTransport {
   constructor(webSocketURI, authToken, messagesReceiver) {
     this.websocket = new WebSocket(webSocketURI)
@@ -5,11 +8,25 @@ export class WebSocketTransport {
       this.send('join', { token: authToken })
     }
     this.websocket.addEventListener('message', this.onMessage.bind(this))
+    this.websocket.addEventListener('close', this.onClose.bind(this))
     this.receiver = messagesReceiver
   }
 
+  onClose(event) {
+    // The server could not keep up sending us messages, some have been lost.
+    if (event.code === RESYNC) this.receiver.resync()
+  }
+
   onMessage(wsMessage) {
-    this.receiver.receive(JSON.parse(wsMessage.data))
+    // The server only does a cheap check of the messages it relays.
+    let message
+    try {
+      message = JSON.parse(wsMessage.data)
+    } catch (error) {
+      console.error('Invalid message received', error)
+      return
+    }
+    this.receiver.receive(message)
   }
 
   send(kind, payload) {
@@ -725,8 +725,19 @@ U.DataLayer = L.Evented.extend({
     if (!this.umap_id) return
     if (this._loading) return
     this._loading = true
-    const [geojson, response, error] = await this.map.server.get(this._dataUrl())
+    // Ask for the compact encoding, but any server may answer plain GeoJSON.
+    const headers = this.map.options.compactGeoJSON
+      ? { Accept: `${U.Coordinates.COMPACT_GEOJSON}, application/geo+json;q=0.9` }
+      : undefined
+    const [geojson, response, error] = await this.map.server.get(
+      this._dataUrl(),
+      headers
+    )
     if (!error) {
+      const contentType = response.headers.get('Content-Type') || ''
+      if (contentType.startsWith(U.Coordinates.COMPACT_GEOJSON)) {
+        U.Coordinates.decodeGeoJSON(geojson)
+      }
       this._reference_version = response.headers.get('X-Datalayer-Version')
       // FIXME: for now this property is set dynamically from backend
       // And thus it's not in the geojson file in the server
@@ -1344,6 +1355,7 @@ U.DataLayer = L.Evented.extend({
       'options.fromZoom',
       'options.toZoom',
       'options.labelKey',
+      'options.coordinatesPrecision',
     ]
 
     builder = new U.FormBuilder(this, optionsFields, {
@@ -4,8 +4,15 @@ import sinon from 'sinon'
 import pkg from 'chai'
 const { expect } = pkg
 
-import { MapUpdater } from '../js/modules/sync/updaters.js'
+import { MapUpdater, DataLayerUpdater } from '../js/modules/sync/updaters.js'
 import { SyncEngine } from '../js/modules/sync/engine.js'
+import {
+  encodeCoordinates,
+  decodeCoordinates,
+  encodeOperation,
+  decodeOperation,
+  decodeGeoJSON,
+} from '../js/modules/sync/coordinates.js'
 
 describe('SyncEngine', () => {
   it('should initialize methods even before start', function () {
@@ -102,4 +109,104 @@ describe('Updaters', () => {
       expect(obj).deep.equal({ foo: {} })
     })
   })
+
+  describe('DataLayerUpdater', function () {
+    it('should update a layer it already has instead of creating it', function () {
+      const datalayer = { updateOptions: sinon.spy() }
+      const map = {
+        getDataLayerByUmapId: sinon.fake.returns(datalayer),
+        createDataLayer: sinon.spy(),
+        render: sinon.spy(),
+      }
+      const updater = new DataLayerUpdater(map)
+      updater.upsert({ metadata: { id: 12 }, value: { name: 'layer' } })
+      expect(datalayer.updateOptions.calledWith({ name: 'layer' })).to.be.true
+      expect(map.createDataLayer.called).to.be.false
+    })
+
+    it('should create a layer it does not have', function () {
+      const map = {
+        getDataLayerByUmapId: sinon.fake.returns(undefined),
+        createDataLayer: sinon.spy(),
+        render: sinon.spy(),
+      }
+      const updater = new DataLayerUpdater(map)
+      updater.upsert({ metadata: { id: null }, value: { name: 'layer' } })
+      expect(map.createDataLayer.calledWith({ name: 'layer' }, false)).to.be.true
+    })
+  })
+})
+
+describe('Compact coordinates', function () {
+  it('should round trip all geometry shapes', function () {
+    const shapes = [
+      [2.351499, 48.85661],
+      [
+        [-0.000001, 0.5],
+        [179.999999, -89.999999],
+      ],
+      [[[1, 2, 3], [4, 5, 6]]],
+      [[[[1, 2], [3, 4]]], [[[5, 6]]]],
+      [],
+    ]
+    for (const coordinates of shapes) {
+      expect(decodeCoordinates(encodeCoordinates(coordinates))).to.deep.equal(coordinates)
+    }
+  })
+
+  it('should encode the geometry of a feature upsert', function () {
+    const operation = {
+      verb: 'upsert',
+      subject: 'feature',
+      metadata: { id: 'foo' },
+      value: { type: 'Feature', geometry: { type: 'Point', coordinates: [1, 2] } },
+    }
+    const encoded = encodeOperation(operation)
+    expect(encoded.value.geometry.coordinates).to.be.undefined
+    expect(encoded.value.geometry.compact).to.be.a('string')
+    expect(decodeOperation(encoded)).to.deep.equal(operation)
+  })
+
+  it('should leave other operations untouched', function () {
+    const operation = { verb: 'update', subject: 'map', key: 'name', value: 'foo' }
+    expect(encodeOperation(operation)).to.equal(operation)
+  })
+
+  it('should decode a compact datalayer', function () {
+    // As served by the server, rounded to 6 decimals.
+    const geojson = {
+      type: 'FeatureCollection',
+      features: [
+        {
+          type: 'Feature',
+          geometry: {
+            type: 'Polygon',
+            compact: 'AgIBA4CbgwLAyu8tv7G0BMCaDMCxtAS/mgw=',
+            precision: 6,
+          },
+        },
+        {
+          type: 'Feature',
+          geometry: {
+            type: 'GeometryCollection',
+            geometries: [{ type: 'Point', compact: 'AALAjbcBn92MAw==', precision: 6 }],
+          },
+        },
+      ],
+    }
+    decodeGeoJSON(geojson)
+    expect(geojson.features[0].geometry).to.deep.equal({
+      type: 'Polygon',
+      coordinates: [
+        [
+          [2.123456, 48.1],
+          [-2.5, 48.2],
+          [2.123456, 48.1],
+        ],
+      ],
+    })
+    expect(geojson.features[1].geometry.geometries[0].coordinates).to.deep.equal([
+      1.5, -3.25,
+    ])
+  })
 })
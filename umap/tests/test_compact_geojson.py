@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from umap import compact_geojson
+
+
+def collection(*geometries):
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "geometry": geometry, "properties": {"name": "foo"}}
+            for geometry in geometries
+        ],
+        "_umap_options": {"name": "layer"},
+    }
+
+
+def test_get_precision():
+    assert compact_geojson.get_precision({"coordinatesPrecision": 5}) == 5
+    assert compact_geojson.get_precision({"coordinatesPrecision": "5"}) == 5
+    assert compact_geojson.get_precision({"coordinatesPrecision": 0}) == 0
+    assert compact_geojson.get_precision({"coordinatesPrecision": -1}) is None
+    assert compact_geojson.get_precision({"coordinatesPrecision": "foo"}) is None
+    assert compact_geojson.get_precision({}) is None
+    assert compact_geojson.get_precision(None) is None
+
+
+def test_quantize():
+    data = collection(
+        {"type": "LineString", "coordinates": [[1.123456789, 2], [3.987654321, 4.5]]},
+        {
+            "type": "GeometryCollection",
+            "geometries": [{"type": "Point", "coordinates": [1.00000049, 2]}],
+        },
+        None,
+    )
+    quantized = compact_geojson.quantize(data, 6)
+    assert quantized["features"][0]["geometry"]["coordinates"] == [
+        [1.123457, 2],
+        [3.987654, 4.5],
+    ]
+    geometry = quantized["features"][1]["geometry"]["geometries"][0]
+    assert geometry["coordinates"] == [1.0, 2]
+    assert quantized["features"][2]["geometry"] is None
+    assert quantized["_umap_options"] == {"name": "layer"}
+    # The original is left untouched.
+    assert data["features"][0]["geometry"]["coordinates"][0][0] == 1.123456789
+
+
+@pytest.mark.parametrize(
+    "coordinates",
+    [
+        [2.351499, 48.85661],
+        [[-0.000001, 0.5], [179.999999, -89.999999]],
+        [[[1, 2, 3], [4, 5, 6]]],
+        [[[[1, 2], [3, 4]]], [[[5, 6]]]],
+        [],
+    ],
+)
+def test_encode_coordinates_round_trip(coordinates):
+    encoded = compact_geojson.encode_coordinates(coordinates)
+    assert compact_geojson.decode_coordinates(encoded) == coordinates
+
+
+def test_encode_coordinates_rejects_mixed_dimensions():
+    with pytest.raises(ValueError):
+        compact_geojson.encode_coordinates([[1, 2], [1, 2, 3]])
+    with pytest.raises(ValueError):
+        compact_geojson.encode_coordinates([[1, 2], [1, "2"]])
+
+
+def test_encode():
+    data = collection(
+        {"type": "Point", "coordinates": [1.5, -3.25]},
+        {"type": "LineString", "coordinates": [[1, 2], [3]]},
+    )
+    encoded = compact_geojson.encode(data, precision=6)
+    point = encoded["features"][0]["geometry"]
+    assert point == {"type": "Point", "compact": "AALAjbcBn92MAw==", "precision": 6}
+    assert compact_geojson.decode_coordinates(point["compact"], 6) == [1.5, -3.25]
+    # Invalid coordinates are kept as is.
+    assert encoded["features"][1]["geometry"] == data["features"][1]["geometry"]
+    point = compact_geojson.encode(data)["features"][0]["geometry"]
+    assert "precision" not in point
+
+
+def test_compact_is_smaller(tmp_path):
+    line = [[2 + i / 1000, 48 + (i % 7) / 1000] for i in range(1000)]
+    data = collection({"type": "LineString", "coordinates": line})
+    path = tmp_path / "1_1.geojson"
+    path.write_text(json.dumps(data))
+    compact_geojson.compact_file(path, tmp_path / "1_1.geojson.compact", 6)
+    compact = (tmp_path / "1_1.geojson.compact").read_bytes()
+    assert len(compact) < path.stat().st_size / 3
+    assert json.loads(compact)["_umap_options"] == {"name": "layer"}
@@ -64,6 +64,8 @@ def test_clone_should_clone_geojson_too(datalayer):
 def test_should_remove_old_versions_on_save(map, settings):
     datalayer = DataLayerFactory(uuid="0f1161c0-c07f-4ba4-86c5-8d8981d8a813", old_id=17)
     settings.UMAP_KEEP_VERSIONS = 3
+    # Only count the gzip files.
+    settings.UMAP_PRECOMPRESS = {"gzip": 6}
     root = Path(datalayer.storage_root())
     before = len(datalayer.geojson.storage.listdir(root)[1])
     newer = f"{datalayer.pk}_1440924889.geojson"
@@ -74,6 +76,8 @@ def test_should_remove_old_versions_on_save(map, settings):
     for path in [medium, newer, older, with_old_id, other]:
         datalayer.geojson.storage.save(root / path, ContentFile("{}"))
         datalayer.geojson.storage.save(root / f"{path}.gz", ContentFile("{}"))
+    for path in [medium, newer, older, with_old_id]:
+        datalayer.add_version(path)
     assert len(datalayer.geojson.storage.listdir(root)[1]) == 10 + before
     files = datalayer.geojson.storage.listdir(root)[1]
     # Those files should be present before save, which will purge them
@@ -83,12 +87,14 @@ def test_should_remove_old_versions_on_save(map, settings):
     assert with_old_id + ".gz" in files
     datalayer.save()
     files = datalayer.geojson.storage.listdir(root)[1]
-    # Flat + gz files, but not latest gz, which is created at first datalayer read.
+    # Flat + gz files, but only the latest gz, which is created at save.
     # older and with_old_id should have been removed
-    assert len(files) == 5
+    assert len(files) == 6
     assert newer in files
     assert medium in files
     assert Path(datalayer.geojson.path).name in files
+    assert Path(datalayer.geojson.path).name + ".gz" in files
+    assert newer + ".gz" not in files
     # File from another datalayer, purge should have impacted it.
     assert other in files
     assert other + ".gz" in files
@@ -214,3 +220,36 @@ def test_anonymous_can_edit_in_inherit_mode_and_map_in_public_mode(datalayer):
     map.edit_status = Map.ANONYMOUS
     map.save()
     assert datalayer.can_edit()
+
+
+def test_versions_are_indexed_on_save(map):
+    datalayer = DataLayerFactory(map=map)
+    first = Path(datalayer.geojson.name).name
+    datalayer.geojson = ContentFile('{"type": "FeatureCollection"}', "foo.json")
+    datalayer.save()
+    second = Path(datalayer.geojson.name).name
+    assert first != second
+    versions = {v["name"]: v for v in datalayer.versions}
+    assert set(versions) == {first, second}
+    assert versions[second]["size"] == datalayer.geojson.size
+    # Files unknown to the index are not listed.
+    root = Path(datalayer.storage_root())
+    datalayer.geojson.storage.save(
+        root / f"{datalayer.pk}_1440924889.geojson", ContentFile("{}")
+    )
+    assert len(datalayer.versions) == 2
+
+
+def test_get_version_name(map):
+    datalayer = DataLayerFactory(map=map, old_id=17)
+    name = Path(datalayer.geojson.name).name
+    version = name.split(".")[0].split("_")[-1]
+    assert datalayer.get_version_name(version) == name
+    old = "17_1440918637.geojson"
+    datalayer.geojson.storage.save(
+        Path(datalayer.storage_root()) / old, ContentFile("{}")
+    )
+    datalayer.add_version(old)
+    assert datalayer.get_version_name("1440918637") == old
+    assert datalayer.get_version_name("1440918") is None
+    assert datalayer.get_version_name("../../foo") is None
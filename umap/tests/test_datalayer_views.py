@@ -1,3 +1,4 @@
+import gzip
 import json
 from copy import deepcopy
 from pathlib import Path
@@ -9,7 +10,7 @@ from django.urls import reverse
 
 from umap.models import DataLayer, Map
 
-from .base import MapFactory
+from .base import DataLayerFactory, MapFactory
 
 pytestmark = pytest.mark.django_db
 
@@ -105,6 +106,34 @@ def test_gzip_should_be_created_if_accepted(client, datalayer, map, post_data):
     assert Path(flat).stat().st_mtime_ns == Path(gzipped).stat().st_mtime_ns
 
 
+def test_gzip_is_not_created_when_reading(client, datalayer, map):
+    map.share_status = Map.PUBLIC
+    map.save()
+    gzipped = Path(datalayer.geojson.path + ".gz")
+    # Created at save time.
+    assert gzipped.exists()
+    gzipped.unlink()
+    url = reverse("datalayer_view", args=(map.pk, datalayer.pk))
+    response = client.get(url, headers={"ACCEPT_ENCODING": "gzip"})
+    assert response.status_code == 200
+    assert json.loads(response.content)["type"] == "FeatureCollection"
+    assert not gzipped.exists()
+
+
+def test_missing_gzip_is_created_once_with_xsendfile(client, datalayer, map, settings):
+    settings.UMAP_XSENDFILE_HEADER = "X-Accel-Redirect"
+    map.share_status = Map.PUBLIC
+    map.save()
+    # As for a layer saved before gzip versions were created at save time.
+    gzipped = Path(datalayer.geojson.path + ".gz")
+    gzipped.unlink()
+    url = reverse("datalayer_view", args=(map.pk, datalayer.pk))
+    response = client.get(url, headers={"ACCEPT_ENCODING": "gzip"})
+    assert response.status_code == 200
+    assert response["X-Accel-Redirect"].startswith("/internal/")
+    assert gzipped.exists()
+
+
 def test_update(client, datalayer, map, post_data):
     url = reverse("datalayer_update", args=(map.pk, datalayer.pk))
     client.login(username=map.owner.username, password="123123")
@@ -219,12 +248,15 @@ def test_versions_should_return_versions(client, datalayer, map, settings):
     datalayer.geojson.storage.save(
         "%s/%s_1440924889.geojson" % (root, datalayer.pk), ContentFile("{}")
     )
+    datalayer.add_version("%s_1440924889.geojson" % datalayer.pk)
     datalayer.geojson.storage.save(
         "%s/%s_1440923687.geojson" % (root, datalayer.pk), ContentFile("{}")
     )
+    datalayer.add_version("%s_1440923687.geojson" % datalayer.pk)
     datalayer.geojson.storage.save(
         "%s/%s_1440918637.geojson" % (root, datalayer.pk), ContentFile("{}")
     )
+    datalayer.add_version("%s_1440918637.geojson" % datalayer.pk)
     url = reverse("datalayer_versions", args=(map.pk, datalayer.pk))
     versions = json.loads(client.get(url).content.decode())
     assert len(versions["versions"]) == 4
@@ -246,15 +278,18 @@ def test_versions_can_return_old_format(client, datalayer, map, settings):
     datalayer.geojson.storage.save(
         "%s/%s_1440924889.geojson" % (root, datalayer.pk), ContentFile("{}")
     )
+    datalayer.add_version("%s_1440924889.geojson" % datalayer.pk)
     datalayer.geojson.storage.save(
         "%s/%s_1440923687.geojson" % (root, datalayer.pk), ContentFile("{}")
     )
+    datalayer.add_version("%s_1440923687.geojson" % datalayer.pk)
 
     # store with the id prefix (rather than the uuid)
     old_format_version = "%s_1440918637.geojson" % datalayer.old_id
     datalayer.geojson.storage.save(
         ("%s/" % root) + old_format_version, ContentFile("{}")
     )
+    datalayer.add_version(old_format_version)
 
     url = reverse("datalayer_versions", args=(map.pk, datalayer.pk))
     versions = json.loads(client.get(url).content.decode())
@@ -281,6 +316,25 @@ def test_version_should_return_one_version_geojson(client, datalayer, map):
     assert client.get(url).content.decode() == "{}"
 
 
+def test_compact_version_keeps_its_coordinates(client, datalayer, map):
+    map.share_status = Map.PUBLIC
+    map.save()
+    root = datalayer.storage_root()
+    name = "%s_1440924889.geojson" % datalayer.pk
+    point = {"type": "Point", "coordinates": [0.6374562, 51.1522376]}
+    data = {"type": "FeatureCollection", "features": [{"geometry": point}]}
+    content = ContentFile(json.dumps(data))
+    datalayer.geojson.storage.save("%s/%s" % (root, name), content)
+    # The layer now rounds coordinates, but this version was saved before.
+    datalayer.settings["coordinatesPrecision"] = 2
+    datalayer.save()
+    url = reverse("datalayer_version", args=(map.pk, datalayer.pk, name))
+    response = client.get(url, headers={"Accept": "application/vnd.umap.compact+json"})
+    geometry = json.loads(response.content)["features"][0]["geometry"]
+    assert geometry["compact"]
+    assert "precision" not in geometry
+
+
 def test_version_should_return_403_if_not_allowed(client, datalayer, map):
     map.share_status = Map.PRIVATE
     map.save()
@@ -603,3 +657,289 @@ def test_optimistic_merge_conflicting_change_raises(
     modified_datalayer = DataLayer.objects.get(pk=datalayer.pk)
     merged_features = json.load(modified_datalayer.geojson)["features"]
     assert merged_features == client1_data["features"]
+
+
+def test_optimistic_merge_by_feature_id(client, datalayer, map, reference_data):
+    url = reverse("datalayer_update", args=(map.pk, datalayer.pk))
+    client.login(username=map.owner.username, password="123123")
+    for index, feature in enumerate(reference_data["features"]):
+        feature["id"] = f"feature{index}"
+
+    post_data = {
+        "name": "name",
+        "display_on_load": True,
+        "rank": 0,
+        "geojson": SimpleUploadedFile(
+            "foo.json", json.dumps(reference_data).encode("utf-8")
+        ),
+    }
+    response = client.post(url, post_data, follow=True)
+    assert response.status_code == 200
+    reference_version = response.headers.get("X-Datalayer-Version")
+
+    def post(data):
+        post_data["geojson"] = SimpleUploadedFile(
+            "foo.json", json.dumps(data).encode("utf-8")
+        )
+        return client.post(
+            url,
+            post_data,
+            follow=True,
+            headers={"X-Datalayer-Reference": reference_version},
+        )
+
+    # First client changes the first feature.
+    client1_data = deepcopy(reference_data)
+    client1_data["features"][0]["geometry"] = {"type": "Point", "coordinates": [5, 6]}
+    assert post(client1_data).status_code == 200
+
+    # Second client changes the second one: no conflict.
+    client2_data = deepcopy(reference_data)
+    client2_data["features"][1]["properties"]["name"] = "baz"
+    assert post(client2_data).status_code == 200
+    modified_datalayer = DataLayer.objects.get(pk=datalayer.pk)
+    merged_features = json.load(modified_datalayer.geojson)["features"]
+    assert merged_features == [
+        client1_data["features"][0],
+        client2_data["features"][1],
+        reference_data["features"][2],
+    ]
+
+    # Third client changes the first one again: conflict.
+    client3_data = deepcopy(reference_data)
+    client3_data["features"][0]["properties"]["name"] = "qux"
+    response = post(client3_data)
+    assert response.status_code == 412
+    assert json.loads(response.content) == {"conflicts": ["feature0"]}
+
+
+def test_get_features_in_bbox(client, datalayer, map):
+    map.share_status = Map.PUBLIC
+    map.save()
+    # Small layers are indexed on first request.
+    index_path = Path(datalayer.geojson.path + ".idx")
+    assert not index_path.exists()
+    url = reverse("datalayer_bbox", args=(map.pk, datalayer.pk))
+    response = client.get(url, {"bbox": "14,48,15,49", "zoom": "10"})
+    assert response.status_code == 200
+    assert response["X-Datalayer-Version"] is not None
+    assert index_path.exists()
+    data = json.loads(response.content.decode())
+    assert data["type"] == "FeatureCollection"
+    assert data["_umap_options"]["name"] == "test datalayer"
+    assert [f["properties"]["name"] for f in data["features"]] == ["Here"]
+    response = client.get(url, {"bbox": "0,0,1,1"})
+    assert json.loads(response.content.decode())["features"] == []
+
+
+@pytest.mark.parametrize(
+    "params",
+    [{}, {"bbox": "1,2,3"}, {"bbox": "3,0,1,1"}, {"bbox": "0,0,1,1", "zoom": "x"}],
+)
+def test_get_features_in_bbox_needs_valid_params(client, datalayer, map, params):
+    map.share_status = Map.PUBLIC
+    map.save()
+    url = reverse("datalayer_bbox", args=(map.pk, datalayer.pk))
+    assert client.get(url, params).status_code == 400
+
+
+def test_layers_are_indexed_on_first_bbox_request(client, datalayer, map):
+    map.share_status = Map.PUBLIC
+    map.save()
+    url = reverse("datalayer_bbox", args=(map.pk, datalayer.pk))
+    first = Path(datalayer.geojson.path)
+    # Not when saving.
+    assert not Path(f"{first}.idx").exists()
+    client.get(url, {"bbox": "-180,-90,180,90"})
+    assert Path(f"{first}.idx").exists()
+    datalayer.geojson.save("foo.json", ContentFile(first.read_bytes()))
+    second = Path(datalayer.geojson.path)
+    assert first != second
+    # Only the current version has an index.
+    assert not Path(f"{first}.idx").exists()
+    assert not Path(f"{second}.idx").exists()
+    client.get(url, {"bbox": "-180,-90,180,90"})
+    assert Path(f"{second}.idx").exists()
+
+
+def test_get_vector_tile(client, datalayer, map):
+    map.share_status = Map.PUBLIC
+    map.save()
+    # The point of the layer is in this tile.
+    url = reverse("datalayer_tile", args=(map.pk, datalayer.pk, 4, 8, 5))
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/vnd.mapbox-vector-tile"
+    assert response["X-Datalayer-Version"] is not None
+    assert b"Here" in response.content
+    tile = Path(f"{datalayer.geojson.path}.tiles/4/8/5.mvt")
+    assert tile.read_bytes() == response.content
+    url = reverse("datalayer_tile", args=(map.pk, datalayer.pk, 4, 0, 0))
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == b""
+    # Empty tiles are not written.
+    assert not Path(f"{datalayer.geojson.path}.tiles/4/0").exists()
+    url = reverse("datalayer_tile", args=(map.pk, datalayer.pk, 4, 16, 0))
+    assert client.get(url).status_code == 404
+
+
+def test_vector_tiles_are_only_cached_up_to_a_zoom(client, datalayer, map, settings):
+    settings.UMAP_VECTOR_TILES_CACHE_MAX_ZOOM = 3
+    map.share_status = Map.PUBLIC
+    map.save()
+    url = reverse("datalayer_tile", args=(map.pk, datalayer.pk, 3, 4, 2))
+    response = client.get(url)
+    assert b"Here" in response.content
+    assert Path(f"{datalayer.geojson.path}.tiles/3/4/2.mvt").exists()
+    url = reverse("datalayer_tile", args=(map.pk, datalayer.pk, 4, 8, 5))
+    response = client.get(url)
+    assert b"Here" in response.content
+    assert not Path(f"{datalayer.geojson.path}.tiles/4").exists()
+
+
+def test_vector_tiles_of_old_versions_are_purged(client, datalayer, map):
+    map.share_status = Map.PUBLIC
+    map.save()
+    client.get(reverse("datalayer_tile", args=(map.pk, datalayer.pk, 4, 8, 5)))
+    tiles = Path(f"{datalayer.geojson.path}.tiles")
+    assert tiles.is_dir()
+    datalayer.geojson.save(
+        "foo.json", ContentFile(Path(datalayer.geojson.path).read_bytes())
+    )
+    assert not tiles.exists()
+
+
+def test_get_simplified_level_for_zoom(client, map, settings):
+    settings.UMAP_SIMPLIFY_ZOOMS = [5, 8]
+    map.share_status = Map.PUBLIC
+    map.save()
+    ring = [[round(i / 1000, 6), round((i % 2) / 100000, 6)] for i in range(1000)]
+    ring += [[1, 1], [0, 1], ring[0]]
+    data = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [ring]},
+                "properties": {"name": "detailed"},
+            }
+        ],
+    }
+    datalayer = DataLayerFactory(map=map, data=data)
+    url = reverse("datalayer_view", args=(map.pk, datalayer.pk))
+    full = client.get(url)
+    # Not when saving, nor for requests without zoom.
+    assert not Path(f"{datalayer.geojson.path}.pyramid").exists()
+    simplified = client.get(url, {"zoom": 4})
+    assert simplified.status_code == 200
+    assert simplified["X-Datalayer-Version"] == full["X-Datalayer-Version"]
+    coordinates = json.loads(simplified.content)["features"][0]["geometry"]
+    assert len(coordinates["coordinates"][0]) < 10
+    assert Path(f"{datalayer.geojson.path}.z5").exists()
+    # No level is detailed enough for this zoom.
+    assert client.get(url, {"zoom": 12}).content == full.content
+    assert client.get(url, {"zoom": "foo"}).content == full.content
+
+
+def test_update_rounds_coordinates_if_asked(client, datalayer, map, post_data):
+    url = reverse("datalayer_update", args=(map.pk, datalayer.pk))
+    client.login(username=map.owner.username, password="123123")
+    post_data["settings"] = '{"name": "name", "coordinatesPrecision": 3}'
+    response = client.post(url, post_data, follow=True)
+    assert response.status_code == 200
+    modified_datalayer = DataLayer.objects.get(pk=datalayer.pk)
+    data = json.loads(Path(modified_datalayer.geojson.path).read_text())
+    assert data["features"][2]["geometry"]["coordinates"] == [0.637, 51.152]
+    assert data["features"][2]["properties"]["name"] == "marker he"
+    # Sent back, for the client to replace its unrounded features.
+    assert json.loads(response.content)["geojson"] == data
+
+
+def test_optimistic_merge_rounds_incoming_features(
+    client, datalayer, map, reference_data
+):
+    url = reverse("datalayer_update", args=(map.pk, datalayer.pk))
+    client.login(username=map.owner.username, password="123123")
+    reference_data["features"][0]["geometry"]["coordinates"] = [-1.23456, 2.34567]
+    post_data = {
+        "name": "name",
+        "display_on_load": True,
+        "rank": 0,
+        "settings": '{"name": "name", "coordinatesPrecision": 2}',
+        "geojson": SimpleUploadedFile(
+            "foo.json", json.dumps(reference_data).encode("utf-8")
+        ),
+    }
+    response = client.post(url, post_data, follow=True)
+    assert response.status_code == 200
+    reference_version = response.headers.get("X-Datalayer-Version")
+
+    def post(data):
+        post_data["geojson"] = SimpleUploadedFile(
+            "foo.json", json.dumps(data).encode("utf-8")
+        )
+        return client.post(
+            url,
+            post_data,
+            follow=True,
+            headers={"X-Datalayer-Reference": reference_version},
+        )
+
+    # First client changes the first feature.
+    client1_data = deepcopy(reference_data)
+    client1_data["features"][0]["properties"]["name"] = "baz"
+    assert post(client1_data).status_code == 200
+
+    # Second client still has the unrounded first feature, and changes the
+    # second one: no conflict.
+    client2_data = deepcopy(reference_data)
+    client2_data["features"][1]["properties"]["name"] = "qux"
+    assert post(client2_data).status_code == 200
+    modified_datalayer = DataLayer.objects.get(pk=datalayer.pk)
+    merged_features = json.load(modified_datalayer.geojson)["features"]
+    assert merged_features[0]["properties"]["name"] == "baz"
+    assert merged_features[0]["geometry"]["coordinates"] == [-1.23, 2.35]
+    assert merged_features[1]["properties"]["name"] == "qux"
+
+
+def test_get_compact_encoding(client, datalayer, map):
+    map.share_status = Map.PUBLIC
+    map.save()
+    url = reverse("datalayer_view", args=(map.pk, datalayer.pk))
+    plain = client.get(url)
+    assert plain["Content-Type"] == "application/geo+json"
+    assert "Accept" in plain["Vary"]
+    response = client.get(
+        url,
+        headers={"Accept": "application/vnd.umap.compact+json, */*;q=0.8"},
+    )
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/vnd.umap.compact+json"
+    assert response["X-Datalayer-Version"] == plain["X-Datalayer-Version"]
+    assert "Accept" in response["Vary"]
+    geometry = json.loads(response.content)["features"][0]["geometry"]
+    assert "coordinates" not in geometry
+    assert geometry["compact"]
+    # Refused explicitly.
+    response = client.get(
+        url, headers={"Accept": "application/vnd.umap.compact+json;q=0"}
+    )
+    assert response.content == plain.content
+
+
+def test_get_precompressed_version(client, datalayer, map):
+    map.share_status = Map.PUBLIC
+    map.save()
+    url = reverse("datalayer_view", args=(map.pk, datalayer.pk))
+    plain = client.get(url)
+    assert "Content-Encoding" not in plain
+    assert "Accept-Encoding" in plain["Vary"]
+    response = client.get(url, headers={"ACCEPT_ENCODING": "gzip, deflate"})
+    assert response.status_code == 200
+    assert response["Content-Encoding"] == "gzip"
+    assert response["Content-Type"] == "application/geo+json"
+    assert response["X-Datalayer-Version"] == plain["X-Datalayer-Version"]
+    assert gzip.decompress(response.content) == plain.content
+    response = client.get(url, headers={"ACCEPT_ENCODING": "gzip;q=0"})
+    assert "Content-Encoding" not in response
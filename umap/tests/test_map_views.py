@@ -318,6 +318,60 @@ def test_map_geojson_view(client, map):
     assert "type" in j
 
 
+def test_map_geojson_view_is_invalidated_on_datalayer_save(client, map, datalayer):
+    url = reverse("map_geojson", args=(map.pk,))
+    response = client.get(url)
+    j = json.loads(response.content.decode())
+    assert j["properties"]["datalayers"][0]["name"] == datalayer.name
+    datalayer.settings["name"] = "new name"
+    datalayer.save()
+    response = client.get(url)
+    j = json.loads(response.content.decode())
+    assert j["properties"]["datalayers"][0]["name"] == "new name"
+
+
+def test_map_geojson_view_is_invalidated_on_map_save(client, map):
+    url = reverse("map_geojson", args=(map.pk,))
+    response = client.get(url)
+    j = json.loads(response.content.decode())
+    assert j["properties"]["name"] == map.settings["properties"]["name"]
+    map.settings["properties"]["name"] = "new map name"
+    map.save()
+    response = client.get(url)
+    j = json.loads(response.content.decode())
+    assert j["properties"]["name"] == "new map name"
+
+
+def test_map_geojson_view_is_invalidated_on_tilelayer_save(client, map, tilelayer):
+    url = reverse("map_geojson", args=(map.pk,))
+    response = client.get(url)
+    j = json.loads(response.content.decode())
+    assert j["properties"]["tilelayers"][0]["name"] == tilelayer.name
+    tilelayer.name = "new tilelayer name"
+    tilelayer.save()
+    response = client.get(url)
+    j = json.loads(response.content.decode())
+    assert j["properties"]["tilelayers"][0]["name"] == "new tilelayer name"
+
+
+def test_map_geojson_view_keeps_request_properties_out_of_cache(
+    client, map, datalayer, user
+):
+    url = reverse("map_geojson", args=(map.pk,))
+    client.login(username=map.owner.username, password="123123")
+    response = client.get(url)
+    j = json.loads(response.content.decode())
+    assert j["properties"]["editMode"] == "advanced"
+    assert j["properties"]["datalayers"][0]["editMode"] == "advanced"
+    assert j["properties"]["user"]["id"] == map.owner.pk
+    client.logout()
+    response = client.get(url)
+    j = json.loads(response.content.decode())
+    assert j["properties"]["editMode"] == "disabled"
+    assert j["properties"]["datalayers"][0]["editMode"] == "disabled"
+    assert "user" not in j["properties"]
+
+
 def test_only_owner_can_delete(client, map, user):
     map.editors.add(user)
     url = reverse("map_delete", kwargs={"map_id": map.pk})
@@ -637,7 +691,7 @@ def test_download(client, map, datalayer):
     response = client.get(url)
     assert response.status_code == 200
     # Test response is a json
-    j = json.loads(response.content.decode())
+    j = json.loads(b"".join(response.streaming_content).decode())
     assert j["type"] == "umap"
     assert j["uri"] == f"http://testserver/en/map/test-map_{map.pk}"
     assert j["geometry"] == {
@@ -699,7 +753,8 @@ def test_download_multiple_maps(client, map, datalayer):
     url = reverse("user_download")
     response = client.get(f"{url}?map_id={map.id}&map_id={another_map.id}")
     assert response.status_code == 200
-    with zipfile.ZipFile(file=BytesIO(response.content), mode="r") as f:
+    content = b"".join(response.streaming_content)
+    with zipfile.ZipFile(file=BytesIO(content), mode="r") as f:
         assert len(f.infolist()) == 2
         assert f.infolist()[0].filename == f"umap_backup_test-map_{another_map.id}.umap"
         assert f.infolist()[1].filename == f"umap_backup_test-map_{map.id}.umap"
@@ -714,6 +769,9 @@ def test_download_multiple_maps(client, map, datalayer):
             ]
             assert umapjson["type"] == "umap"
             assert umapjson["uri"] == f"http://testserver/en/map/test-map_{map.id}"
+            assert len(umapjson["layers"]) == 1
+            assert umapjson["layers"][0]["_umap_options"] == datalayer.settings
+            assert umapjson["layers"][0]["features"][0]["properties"]["name"] == "Here"
 
 
 def test_download_multiple_maps_unauthorized(client, map, datalayer):
@@ -725,7 +783,8 @@ def test_download_multiple_maps_unauthorized(client, map, datalayer):
     url = reverse("user_download")
     response = client.get(f"{url}?map_id={map.id}&map_id={another_map.id}")
     assert response.status_code == 200
-    with zipfile.ZipFile(file=BytesIO(response.content), mode="r") as f:
+    content = b"".join(response.streaming_content)
+    with zipfile.ZipFile(file=BytesIO(content), mode="r") as f:
         assert len(f.infolist()) == 1
         assert f.infolist()[0].filename == f"umap_backup_test-map_{map.id}.umap"
 
@@ -741,7 +800,8 @@ def test_download_multiple_maps_editor(client, map, datalayer):
     url = reverse("user_download")
     response = client.get(f"{url}?map_id={map.id}&map_id={another_map.id}")
     assert response.status_code == 200
-    with zipfile.ZipFile(file=BytesIO(response.content), mode="r") as f:
+    content = b"".join(response.streaming_content)
+    with zipfile.ZipFile(file=BytesIO(content), mode="r") as f:
         assert len(f.infolist()) == 2
         assert f.infolist()[0].filename == f"umap_backup_test-map_{another_map.id}.umap"
         assert f.infolist()[1].filename == f"umap_backup_test-map_{map.id}.umap"
@@ -764,7 +824,7 @@ def test_download_my_map(client, map, datalayer):
     response = client.get(url)
     assert response.status_code == 200
     # Test response is a json
-    j = json.loads(response.content.decode())
+    j = json.loads(b"".join(response.streaming_content).decode())
     assert j["type"] == "umap"
 
 
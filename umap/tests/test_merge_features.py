@@ -85,3 +85,79 @@ def test_merge_with_ids_raises():
 
     with pytest.raises(ConflictError):
         merge_features(reference, latest, incoming)
+
+
+def test_merge_features_with_ids_and_duplicates():
+    reference = [
+        {"id": "a", "geometry": "A"},
+        {"id": "b", "geometry": "B"},
+        {"geometry": "X"},
+        {"geometry": "X"},
+    ]
+    latest = [
+        {"id": "a", "geometry": "A2"},
+        {"id": "b", "geometry": "B"},
+        {"geometry": "X"},
+        {"geometry": "X"},
+    ]
+    incoming = [
+        {"id": "a", "geometry": "A"},
+        {"id": "c", "geometry": "C"},
+        {"geometry": "X"},
+    ]
+    assert merge_features(reference, latest, incoming) == [
+        {"id": "a", "geometry": "A2"},
+        {"geometry": "X"},
+        {"geometry": "X"},
+        {"id": "c", "geometry": "C"},
+    ]
+
+
+def test_merge_by_id_different_features_changed():
+    reference = [{"id": "a", "name": "A"}, {"id": "b", "name": "B"}]
+    latest = [{"id": "a", "name": "A2"}, {"id": "b", "name": "B"}]
+    incoming = [{"id": "a", "name": "A"}, {"id": "b", "name": "B2"}]
+    assert merge_features(reference, latest, incoming) == [
+        {"id": "a", "name": "A2"},
+        {"id": "b", "name": "B2"},
+    ]
+
+
+def test_merge_by_id_deleted_and_added():
+    reference = [{"id": "a", "name": "A"}, {"id": "b", "name": "B"}]
+    latest = [{"id": "a", "name": "A"}, {"id": "b", "name": "B"}, {"id": "c"}]
+    incoming = [{"id": "b", "name": "B"}, {"id": "d"}]
+    assert merge_features(reference, latest, incoming) == [
+        {"id": "b", "name": "B"},
+        {"id": "c"},
+        {"id": "d"},
+    ]
+
+
+def test_merge_by_id_same_change_does_not_conflict():
+    reference = [{"id": "a", "name": "A"}]
+    latest = [{"id": "a", "name": "A2"}, {"id": "b"}]
+    incoming = [{"id": "a", "name": "A2"}]
+    assert merge_features(reference, latest, incoming) == [
+        {"id": "a", "name": "A2"},
+        {"id": "b"},
+    ]
+
+
+def test_merge_by_id_returns_conflicting_ids():
+    reference = [{"id": "a", "name": "A"}, {"id": "b"}, {"id": "c", "name": "C"}]
+    latest = [{"id": "a", "name": "A2"}, {"id": "b"}]
+    incoming = [{"id": "a", "name": "A3"}, {"id": "b"}, {"id": "c", "name": "C2"}]
+    with pytest.raises(ConflictError) as error:
+        merge_features(reference, latest, incoming)
+    assert error.value.conflicts == ["a", "c"]
+
+
+def test_merge_by_id_duplicated_ids_fallback_to_content():
+    reference = [{"id": "a", "name": "A"}]
+    latest = [{"id": "a", "name": "A2"}]
+    incoming = [{"id": "a", "name": "A"}, {"id": "a", "name": "A3"}]
+    assert merge_features(reference, latest, incoming) == [
+        {"id": "a", "name": "A2"},
+        {"id": "a", "name": "A3"},
+    ]
@@ -0,0 +1,287 @@
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from django.conf import settings
+from django.urls import reverse
+
+from umap import proxy
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Local stand-in for the proxied hosts."""
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    hits = Counter()
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_GET(self):
+        self.hits[self.path] += 1
+        if self.path.startswith("/slow"):
+            self.release.wait(5)
+        if self.path.startswith("/etag"):
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Cache-Control", "max-age=0")
+                self.end_headers()
+                return
+        if self.path.startswith("/sized"):
+            body = b"x" * int(self.path.split("?")[1])
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith("/missing"):
+            self.send_response(404, "Nothing here")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path.startswith("/stream"):
+            # No Content-Length, chunked as a dynamic API would do.
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in [b'{"type": ', b'"FeatureCollection", ', b'"features": []}']:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        body = b'{"type": "FeatureCollection", "features": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.path.startswith("/etag"):
+            self.send_header("ETag", '"v1"')
+            self.send_header("Cache-Control", "max-age=0")
+        elif self.path.startswith("/private"):
+            self.send_header("Cache-Control", "private, max-age=600")
+        elif self.path.startswith("/fresh"):
+            self.send_header("Cache-Control", "public, max-age=600")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in():
+    StandIn.connections = 0
+    StandIn.hits.clear()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.daemon_threads = True
+    StandIn.release = threading.Event()
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    StandIn.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_connections_are_kept_alive(stand_in):
+    fetcher = proxy.Fetcher(max_per_host=2)
+    for _ in range(3):
+        assert b"FeatureCollection" in fetcher.fetch(f"{stand_in}/data").read()
+    assert StandIn.connections == 1
+
+
+def test_body_is_streamed(stand_in):
+    fetcher = proxy.Fetcher(max_per_host=2)
+    upstream = fetcher.fetch(f"{stand_in}/stream")
+    assert "Content-Length" not in upstream.headers
+    assert b"".join(upstream) == b'{"type": "FeatureCollection", "features": []}'
+    # The slot is free again, and dropped as the host is idle.
+    assert not fetcher.slots
+
+
+def test_concurrency_is_capped_per_host(stand_in):
+    fetcher = proxy.Fetcher(max_per_host=1, slot_timeout=0.1)
+    upstream = fetcher.fetch(f"{stand_in}/data")
+    with pytest.raises(proxy.HostBusy):
+        fetcher.fetch(f"{stand_in}/data")
+    assert fetcher.slots[stand_in[7:]].users == 1
+    upstream.read()
+    assert not fetcher.slots
+    assert fetcher.fetch(f"{stand_in}/data").read()
+
+
+def test_slot_is_freed_on_error(stand_in):
+    fetcher = proxy.Fetcher(max_per_host=1, slot_timeout=0.1)
+    with pytest.raises(proxy.requests.Timeout):
+        fetcher.fetch(f"{stand_in}/slow", timeout=(1, 0.1))
+    assert not fetcher.slots
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(proxy.time, "monotonic", lambda: now[0])
+    return now
+
+
+def read(proxied):
+    if isinstance(proxied, proxy.Entry):
+        return proxied.body
+    return b"".join(proxied)
+
+
+def test_cache_honours_ttl(stand_in, clock):
+    cache = proxy.ProxyCache(proxy.Fetcher(max_per_host=2), max_size=2**20)
+    url = f"{stand_in}/data"
+    assert b"FeatureCollection" in read(cache.get(url, ttl=600))
+    assert isinstance(cache.get(url, ttl=600), proxy.Entry)
+    clock[0] += 300
+    assert isinstance(cache.get(url, ttl=600), proxy.Entry)
+    # Another map asking for a shorter ttl.
+    assert not isinstance(cache.get(url, ttl=60), proxy.Entry)
+    assert StandIn.hits["/data"] == 2
+
+
+def test_cache_honours_cache_control(stand_in, clock):
+    cache = proxy.ProxyCache(proxy.Fetcher(max_per_host=2), max_size=2**20)
+    for path in ["/fresh", "/private", "/fresh", "/private"]:
+        read(cache.get(f"{stand_in}{path}"))
+    assert StandIn.hits == {"/fresh": 1, "/private": 2}
+    clock[0] += 601
+    read(cache.get(f"{stand_in}/fresh"))
+    assert StandIn.hits["/fresh"] == 2
+
+
+def test_cache_revalidates_stale_entries(stand_in, clock):
+    cache = proxy.ProxyCache(proxy.Fetcher(max_per_host=2), max_size=2**20)
+    url = f"{stand_in}/etag"
+    body = read(cache.get(url))
+    # Stale right away (max-age=0), but not modified upstream.
+    entry = cache.get(url)
+    assert isinstance(entry, proxy.Entry)
+    assert entry.body == body
+    assert StandIn.hits["/etag"] == 2
+
+
+def test_cache_collapses_concurrent_misses(stand_in):
+    cache = proxy.ProxyCache(proxy.Fetcher(max_per_host=8), max_size=2**20)
+    url = f"{stand_in}/slow"
+    bodies = []
+
+    def get():
+        bodies.append(read(cache.get(url, ttl=60)))
+
+    threads = [threading.Thread(target=get) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    # Let them all miss before the upstream answers.
+    time.sleep(0.2)
+    StandIn.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(bodies) == 5
+    assert len(set(bodies)) == 1
+    assert StandIn.hits["/slow"] == 1
+
+
+def test_cache_evicts_least_recently_used(stand_in):
+    cache = proxy.ProxyCache(proxy.Fetcher(max_per_host=2), max_size=800)
+    urls = [f"{stand_in}/sized?100#{index}" for index in range(9)]
+    for url in urls[:8]:
+        read(cache.get(url, ttl=60))
+    assert cache.size == 800
+    # Used recently, so the second one is evicted instead.
+    cache.get(urls[0], ttl=60)
+    read(cache.get(urls[8], ttl=60))
+    assert cache.size == 800
+    assert urls[0] in cache.entries
+    assert urls[1] not in cache.entries
+    # Too large for this cache, only streamed.
+    read(cache.get(f"{stand_in}/sized?101", ttl=60))
+    assert f"{stand_in}/sized?101" not in cache.entries
+
+
+def test_resolver_caches_until_ttl(monkeypatch):
+    calls = []
+    now = [1000]
+
+    def gethostbyname(hostname):
+        calls.append(hostname)
+        return "93.184.216.34"
+
+    monkeypatch.setattr(proxy.socket, "gethostbyname", gethostbyname)
+    monkeypatch.setattr(proxy.time, "monotonic", lambda: now[0])
+    resolver = proxy.Resolver(ttl=60)
+    assert resolver.resolve("example.org") == "93.184.216.34"
+    assert resolver.resolve("example.org") == "93.184.216.34"
+    assert calls == ["example.org"]
+    now[0] += 61
+    resolver.resolve("example.org")
+    assert calls == ["example.org", "example.org"]
+
+
+def test_resolver_keeps_recent_hosts_only(monkeypatch):
+    calls = []
+
+    def gethostbyname(hostname):
+        calls.append(hostname)
+        return "93.184.216.34"
+
+    monkeypatch.setattr(proxy.socket, "gethostbyname", gethostbyname)
+    resolver = proxy.Resolver(ttl=60, max_hosts=2)
+    for hostname in ["a.org", "b.org", "a.org", "c.org"]:
+        resolver.resolve(hostname)
+    assert len(resolver.cache.entries) == 2
+    resolver.resolve("a.org")
+    resolver.resolve("b.org")
+    assert calls == ["a.org", "b.org", "c.org", "b.org"]
+
+
+@pytest.fixture
+def public_resolver(monkeypatch):
+    # The stand-in listens on a private address, which the proxy refuses.
+    monkeypatch.setattr(proxy.RESOLVER, "resolve", lambda hostname: "93.184.216.34")
+
+
+def proxy_get(client, url):
+    return client.get(
+        reverse("ajax-proxy"),
+        {"url": url},
+        HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        HTTP_REFERER=settings.SITE_URL,
+    )
+
+
+def test_proxy_serves_from_cache(client, stand_in, public_resolver):
+    url = f"{stand_in}/fresh?view"
+    response = proxy_get(client, url)
+    assert response.status_code == 200
+    assert response.streaming
+    assert b"FeatureCollection" in b"".join(response.streaming_content)
+    response = proxy_get(client, url)
+    assert response.status_code == 200
+    assert not response.streaming
+    assert response["Content-Type"] == "application/json"
+    assert b"FeatureCollection" in response.content
+    assert "max-age=" in response["Cache-Control"]
+    assert "Cookie" not in response.get("Vary", "")
+    assert StandIn.hits["/fresh?view"] == 1
+
+
+def test_proxy_streams_responses_without_length(client, stand_in, public_resolver):
+    response = proxy_get(client, f"{stand_in}/stream?streamed")
+    assert response.status_code == 200
+    assert response.streaming
+    assert b"".join(response.streaming_content).endswith(b'"features": []}')
+
+
+def test_proxy_forwards_upstream_errors(client, stand_in, public_resolver):
+    response = proxy_get(client, f"{stand_in}/missing")
+    assert response.status_code == 404
+    assert response.content == b"Nothing here"
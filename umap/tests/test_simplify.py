@@ -0,0 +1,108 @@
+import json
+import math
+
+from umap import simplify
+
+
+def wiggly(start, end, count, amplitude):
+    """Points from start to end, slightly off the straight line."""
+    points = []
+    for index in range(count + 1):
+        t = index / count
+        offset = amplitude * math.sin(index * 1.7)
+        points.append(
+            [
+                round(start[0] + t * (end[0] - start[0]) + offset, 6),
+                round(start[1] + t * (end[1] - start[1]) + offset, 6),
+            ]
+        )
+    return points
+
+
+def polygon(ring, **properties):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [ring]},
+        "properties": properties,
+    }
+
+
+def test_douglas_peucker():
+    line = [(0, 0), (1, 0.001), (2, -0.001), (3, 5), (4, 6), (5, 7.001), (6, 8)]
+    assert simplify.douglas_peucker(line, 0.1) == [(0, 0), (2, -0.001), (3, 5), (6, 8)]
+    assert simplify.douglas_peucker(line, 100) == [(0, 0), (6, 8)]
+    assert simplify.douglas_peucker(line[:2], 100) == line[:2]
+
+
+def test_shared_borders_stay_shared():
+    border = wiggly([0, 0], [0, 10], 500, 0.05)
+    west = border + [[-10, 10], [-10, 0], [0, 0]]
+    # Same border, run the other way, and from another start.
+    east = [[10, 0], [10, 10]] + border[::-1] + [[10, 0]]
+    data = {
+        "type": "FeatureCollection",
+        "features": [polygon(west, name="west"), polygon(east, name="east")],
+    }
+    simplified = simplify.simplify(data, zoom=5)
+    west, east = [f["geometry"]["coordinates"][0] for f in simplified["features"]]
+    assert len(west) < len(border) / 2
+    assert west[0] == west[-1]
+    assert east[0] == east[-1]
+    west_border = {tuple(point) for point in west if abs(point[0]) < 1}
+    east_border = {tuple(point) for point in east if abs(point[0]) < 1}
+    assert west_border == east_border
+    assert len(west_border) > 2
+
+
+def test_collapsed_polygons_are_left_out():
+    tiny = [[0, 0], [0.0001, 0], [0.0001, 0.0001], [0, 0.0001], [0, 0]]
+    point = {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [1.123456789, 2.987654321]},
+        "properties": {"name": "point"},
+    }
+    data = {"type": "FeatureCollection", "features": [polygon(tiny), point]}
+    simplified = simplify.simplify(data, zoom=5)
+    assert simplified["features"] == [point]
+    # Rounded to the tenth of a pixel at zoom 18.
+    simplified = simplify.simplify(data, zoom=18)
+    assert len(simplified["features"]) == 2
+    assert simplified["features"][0]["geometry"]["coordinates"][0] == tiny
+
+
+def test_lines_keep_their_ends():
+    line = {
+        "type": "Feature",
+        "geometry": {
+            "type": "MultiLineString",
+            "coordinates": [wiggly([0, 0], [1, 1], 100, 0.00001)],
+        },
+        "properties": {},
+    }
+    data = {"type": "FeatureCollection", "features": [line]}
+    (simplified,) = simplify.simplify(data, zoom=5)["features"]
+    assert simplified["geometry"]["coordinates"] == [[[0, 0], [1, 1]]]
+
+
+def test_build_pyramid(tmp_path):
+    path = tmp_path / "1_1.geojson"
+    border = wiggly([0, 0], [0, 10], 2000, 0.0001)
+    data = {
+        "type": "FeatureCollection",
+        "features": [polygon(border + [[-10, 10], [-10, 0], [0, 0]])],
+        "_umap_options": {"name": "borders"},
+    }
+    path.write_text(json.dumps(data, separators=(",", ":")))
+    assert simplify.build_pyramid(path, [5, 11, 20]) == [5, 11]
+    assert simplify.load_pyramid(simplify.get_pyramid_path(path)) == [5, 11]
+    level = json.loads(open(simplify.get_level_path(path, 5)).read())
+    assert level["_umap_options"] == {"name": "borders"}
+    assert path.stat().st_size > 10 * len(json.dumps(level))
+
+
+def test_pick_level():
+    assert simplify.pick_level([5, 8, 11], 3) == 5
+    assert simplify.pick_level([5, 8, 11], 8) == 8
+    assert simplify.pick_level([5, 8, 11], 9) == 11
+    assert simplify.pick_level([5, 8, 11], 12) is None
+    assert simplify.pick_level([], 3) is None
@@ -0,0 +1,117 @@
+import json
+import random
+
+from umap import spatial_index
+
+
+def point(lng, lat, name):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lng, lat]},
+        "properties": {"name": name},
+    }
+
+
+def line(coordinates, name):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "LineString", "coordinates": coordinates},
+        "properties": {"name": name},
+    }
+
+
+def build(tmp_path, features, **members):
+    path = tmp_path / "1_1.geojson"
+    data = {"type": "FeatureCollection", "features": features, **members}
+    path.write_text(json.dumps(data))
+    index_path = tmp_path / "1_1.geojson.idx"
+    spatial_index.build_index(path, index_path)
+    return spatial_index.SpatialIndex(index_path)
+
+
+def names(index, bbox, zoom=None):
+    data = json.loads(index.read(index.search(bbox, zoom)))
+    return [feature["properties"]["name"] for feature in data["features"]]
+
+
+def test_get_bbox():
+    assert spatial_index.get_bbox({"type": "Point", "coordinates": [1, 2]}) == [
+        1,
+        2,
+        1,
+        2,
+    ]
+    polygon = {"type": "Polygon", "coordinates": [[[0, 0], [2, 1], [1, 3], [0, 0]]]}
+    assert spatial_index.get_bbox(polygon) == [0, 0, 2, 3]
+    collection = {
+        "type": "GeometryCollection",
+        "geometries": [{"type": "Point", "coordinates": [-1, 5]}, polygon],
+    }
+    assert spatial_index.get_bbox(collection) == [-1, 0, 2, 5]
+    assert spatial_index.get_bbox(None) is None
+    assert spatial_index.get_bbox({"type": "Point", "coordinates": []}) is None
+
+
+def test_search_returns_intersecting_features_in_order(tmp_path):
+    index = build(
+        tmp_path,
+        [
+            point(2.35, 48.85, "paris"),
+            point(-0.12, 51.5, "london"),
+            line([[2, 48], [3, 49]], "around paris"),
+            {"type": "Feature", "geometry": None, "properties": {"name": "nowhere"}},
+            line([[-10, 40], [20, 60]], "across"),
+        ],
+        _umap_options={"name": "capitals"},
+    )
+    assert names(index, [2, 48, 3, 49]) == ["paris", "around paris", "across"]
+    assert names(index, [-1, 51, 0, 52]) == ["london", "across"]
+    assert names(index, [100, 10, 110, 20]) == []
+    data = json.loads(index.read([0]))
+    assert data["type"] == "FeatureCollection"
+    assert data["_umap_options"] == {"name": "capitals"}
+
+
+def test_search_matches_a_full_scan(tmp_path):
+    rng = random.Random(1)
+    features = []
+    for index in range(2000):
+        lng, lat = rng.uniform(-10, 10), rng.uniform(40, 50)
+        if index % 3:
+            features.append(point(lng, lat, str(index)))
+        else:
+            size = rng.expovariate(2)
+            features.append(line([[lng, lat], [lng + size, lat + size]], str(index)))
+    index = build(tmp_path, features)
+    assert index.grid.cols > 1
+    for _ in range(20):
+        west, south = rng.uniform(-12, 10), rng.uniform(38, 50)
+        bbox = [west, south, west + rng.uniform(0, 5), south + rng.uniform(0, 5)]
+        expected = [
+            feature["properties"]["name"]
+            for feature in features
+            if spatial_index.intersects(
+                bbox, spatial_index.get_bbox(feature["geometry"])
+            )
+        ]
+        assert names(index, bbox) == expected
+
+
+def test_search_leaves_out_features_smaller_than_a_pixel(tmp_path):
+    index = build(
+        tmp_path,
+        [
+            point(2.35, 48.85, "point"),
+            line([[2.3, 48.8], [2.30001, 48.80001]], "tiny"),
+            line([[2, 48], [3, 49]], "large"),
+        ],
+    )
+    assert names(index, [2, 48, 3, 49]) == ["point", "tiny", "large"]
+    assert names(index, [2, 48, 3, 49], zoom=18) == ["point", "tiny", "large"]
+    assert names(index, [2, 48, 3, 49], zoom=5) == ["point", "large"]
+
+
+def test_index_of_an_empty_layer(tmp_path):
+    index = build(tmp_path, [])
+    assert index.search([-180, -90, 180, 90]) == []
+    assert json.loads(index.read([])) == {"type": "FeatureCollection", "features": []}
@@ -1,6 +1,27 @@
+import gzip
+import json
+import threading
+import time
 from pathlib import Path
 
-from umap.utils import gzip_file
+import pytest
+from django.utils import translation
+
+from umap import utils
+from umap.utils import (
+    ExpiringCache,
+    SingleFlight,
+    _urls_for_js,
+    clear_url_templates,
+    compress_file,
+    file_lock,
+    get_encodings,
+    get_url_templates,
+    get_urls_hash,
+    gzip_file,
+    json_object_chunks,
+    negotiate_encoding,
+)
 
 
 def test_gzip_file():
@@ -12,3 +33,248 @@ def test_gzip_file():
     dest_stat = dest.stat()
     dest.unlink()
     assert src_stat.st_mtime == dest_stat.st_mtime
+
+
+def test_gzip_file_replaces_destination_atomically(tmp_path):
+    src = tmp_path / "foo.geojson"
+    src.write_text('{"type": "FeatureCollection"}')
+    dest = tmp_path / "foo.geojson.gz"
+    dest.write_bytes(b"stale")
+    gzip_file(src, dest)
+    assert gzip.decompress(dest.read_bytes()) == src.read_bytes()
+    assert dest.stat().st_mode & 0o777 == 0o644
+    # No temporary file left behind.
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "foo.geojson",
+        "foo.geojson.gz",
+    ]
+
+
+def test_url_templates_are_computed_once(monkeypatch):
+    clear_url_templates()
+    calls = []
+    get_uri_template = utils.get_uri_template
+
+    def counting_get_uri_template(name):
+        calls.append(name)
+        return get_uri_template(name)
+
+    monkeypatch.setattr(utils, "get_uri_template", counting_get_uri_template)
+    with translation.override("en"):
+        urls = _urls_for_js()
+        count = len(calls)
+        assert count
+        assert urls["map_update"] == "/en/map/{map_id}/update/settings/"
+        assert _urls_for_js() == urls
+        assert get_urls_hash() == get_urls_hash()
+        assert len(calls) == count
+
+
+def test_url_templates_are_computed_by_language():
+    clear_url_templates()
+    with translation.override("en"):
+        en = get_url_templates()
+    with translation.override("fr"):
+        fr = get_url_templates()
+    assert en["urls"]["map_update"] == "/en/map/{map_id}/update/settings/"
+    assert fr["urls"]["map_update"] == "/fr/map/{map_id}/update/settings/"
+    assert en["hash"] != fr["hash"]
+
+
+def test_urls_for_js_returns_a_copy():
+    urls = _urls_for_js()
+    urls["map_update"] = "changed"
+    assert _urls_for_js()["map_update"] != "changed"
+
+
+def test_json_object_chunks_without_extra_returns_the_file(tmp_path):
+    path = tmp_path / "layer.geojson"
+    path.write_bytes(b'{"type": "FeatureCollection", "features": []}')
+    chunks = list(json_object_chunks(path, chunk_size=8))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == path.read_bytes()
+
+
+def test_json_object_chunks_overrides_existing_members(tmp_path):
+    path = tmp_path / "layer.geojson"
+    path.write_bytes(
+        b'{"features": [{"properties": {"name": "}"}}], "_umap_options": {"a": 1}}\n'
+    )
+    content = b"".join(json_object_chunks(path, {"_umap_options": {"b": 2}}, 8))
+    assert json.loads(content) == {
+        "features": [{"properties": {"name": "}"}}],
+        "_umap_options": {"b": 2},
+    }
+
+
+def test_json_object_chunks_with_empty_object(tmp_path):
+    path = tmp_path / "layer.geojson"
+    path.write_bytes(b"{ }")
+    content = b"".join(json_object_chunks(path, {"_umap_options": {"b": 2}}))
+    assert json.loads(content) == {"_umap_options": {"b": 2}}
+
+
+def test_json_object_chunks_replaces_trailing_member(tmp_path):
+    path = tmp_path / "layer.geojson"
+    path.write_bytes(
+        b'{"type": "FeatureCollection", "features": [{"properties": '
+        b'{"_umap_options": {"c": 1}}}], "_umap_options": {"a": "}"}}'
+    )
+    content = b"".join(json_object_chunks(path, {"_umap_options": {"b": 2}}, 8))
+    assert content.count(b'"_umap_options"') == 2
+    assert json.loads(content) == {
+        "type": "FeatureCollection",
+        "features": [{"properties": {"_umap_options": {"c": 1}}}],
+        "_umap_options": {"b": 2},
+    }
+
+
+def test_single_flight_runs_concurrent_calls_once():
+    flights = SingleFlight()
+    started = threading.Event()
+    calls = []
+    results = []
+
+    def prepare():
+        calls.append(1)
+        started.set()
+        # Leave time for the others to come.
+        time.sleep(0.1)
+        return "prepared"
+
+    def read():
+        results.append(flights.run("layer", prepare))
+
+    leader = threading.Thread(target=read)
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(target=read) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader, *followers]:
+        thread.join(1)
+    assert results == ["prepared"] * 5
+    assert len(calls) == 1
+    # Once done, the next call runs it again.
+    flights.run("layer", prepare)
+    assert len(calls) == 2
+    assert not flights.calls
+
+
+def test_single_flight_shares_errors():
+    flights = SingleFlight()
+    with pytest.raises(ValueError):
+        flights.run("layer", int, "not an int")
+    assert not flights.calls
+
+
+def test_expiring_cache_is_bounded_in_size():
+    cache = ExpiringCache(max_size=10, ttl=60)
+    cache.set("a", "A", 4)
+    cache.set("b", "B", 4)
+    assert cache.get("a") == "A"
+    # Least recently used goes first.
+    cache.set("c", "C", 4)
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.size == 8
+    # Too large to be cached at all.
+    cache.set("d", "D", 11)
+    assert cache.get("d") is None
+    assert cache.get("c") == "C"
+
+
+def test_expiring_cache_entries_expire(monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(utils.time, "monotonic", lambda: now[0])
+    cache = ExpiringCache(max_size=10, ttl=60)
+    cache.set("a", "A", 4)
+    now[0] += 59
+    assert cache.get("a") == "A"
+    now[0] += 1
+    assert cache.get("a") is None
+    assert cache.size == 0
+    cache.set("b", "B", 4)
+    now[0] += 60
+    # Expired entries are dropped when setting others.
+    cache.set("c", "C", 4)
+    assert list(cache.entries) == ["c"]
+    assert cache.size == 4
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    path = tmp_path / "layer.geojson"
+    path.write_text("{}")
+    events = []
+
+    def hold():
+        with file_lock(path):
+            events.append("start")
+            time.sleep(0.05)
+            events.append("end")
+
+    # Each thread opens the file, as another process would.
+    threads = [threading.Thread(target=hold) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(1)
+    assert events == ["start", "end"] * 3
+    assert path.read_text() == "{}"
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        ("", None),
+        ("identity", None),
+        ("gzip, deflate", "gzip"),
+        ("gzip, deflate, br, zstd", "zstd"),
+        ("gzip;q=1.0, br;q=0.5", "gzip"),
+        ("br;q=0, gzip", "gzip"),
+        ("*", "zstd"),
+        ("*, zstd;q=0", "br"),
+        ("GZIP", "gzip"),
+        ("gzip;q=foo", None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected):
+    encodings = ["zstd", "br", "gzip"]
+    assert negotiate_encoding(accept_encoding, encodings) == expected
+
+
+def test_get_encodings(settings, monkeypatch):
+    settings.UMAP_PRECOMPRESS = {"gzip": 9, "br": 9, "zstd": 15}
+    monkeypatch.setattr(utils, "brotli", None)
+    monkeypatch.setattr(utils, "zstandard", object())
+    assert get_encodings() == ["zstd", "gzip"]
+    settings.UMAP_PRECOMPRESS = {"gzip": 6}
+    assert get_encodings() == ["gzip"]
+    settings.UMAP_GZIP = False
+    assert get_encodings() == []
+
+
+def test_compress_file_with_level(tmp_path):
+    src = tmp_path / "foo.geojson"
+    src.write_bytes(b'{"type": "Feature"}' * 10_000)
+    fast, best = tmp_path / "fast.gz", tmp_path / "best.gz"
+    compress_file(src, fast, "gzip", level=1)
+    compress_file(src, best, "gzip", level=9)
+    assert gzip.decompress(fast.read_bytes()) == src.read_bytes()
+    assert best.stat().st_size < fast.stat().st_size
+    assert best.stat().st_mtime_ns == src.stat().st_mtime_ns
+
+
+@pytest.mark.parametrize("encoding,module", [("br", "brotli"), ("zstd", "zstandard")])
+def test_compress_file_with_optional_encodings(tmp_path, encoding, module):
+    library = pytest.importorskip(module)
+    src = tmp_path / "foo.geojson"
+    src.write_bytes(b'{"type": "Feature"}' * 10_000)
+    dest = tmp_path / f"foo.geojson{utils.ENCODINGS[encoding]}"
+    compress_file(src, dest, encoding, level=5)
+    if encoding == "br":
+        assert library.decompress(dest.read_bytes()) == src.read_bytes()
+    else:
+        decompressor = library.ZstdDecompressor()
+        assert decompressor.decompress(dest.read_bytes()) == src.read_bytes()
+    assert dest.stat().st_size < src.stat().st_size / 100
@@ -0,0 +1,205 @@
+import json
+import struct
+
+from umap import spatial_index, vector_tiles
+
+
+def read_varint(data, position):
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def decode_message(data):
+    """Return {field number: [values]} of a protobuf message."""
+    fields, position = {}, 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        number, wire = key >> 3, key & 0x7
+        if wire == 0:
+            value, position = read_varint(data, position)
+        elif wire == 1:
+            value = struct.unpack("<d", data[position : position + 8])[0]
+            position += 8
+        elif wire == 2:
+            length, position = read_varint(data, position)
+            value = data[position : position + length]
+            position += length
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def decode_packed(data):
+    values, position = [], 0
+    while position < len(data):
+        value, position = read_varint(data, position)
+        values.append(value)
+    return values
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_geometry(commands):
+    """Return the list of (command, points) of the geometry commands."""
+    out, x, y, index = [], 0, 0, 0
+    while index < len(commands):
+        command, count = commands[index] & 0x7, commands[index] >> 3
+        index += 1
+        if command == vector_tiles.CLOSE_PATH:
+            out.append((command, []))
+            continue
+        points = []
+        for _ in range(count):
+            x += unzigzag(commands[index])
+            y += unzigzag(commands[index + 1])
+            index += 2
+            points.append((x, y))
+        out.append((command, points))
+    return out
+
+
+def decode_tile(data):
+    (layer,) = decode_message(data)[3]
+    layer = decode_message(layer)
+    keys = [key.decode() for key in layer.get(3, [])]
+    values = []
+    for value in layer.get(4, []):
+        ((number, (value,)),) = decode_message(value).items()
+        if number == 1:
+            value = value.decode()
+        elif number == 6:
+            value = unzigzag(value)
+        elif number == 7:
+            value = bool(value)
+        values.append(value)
+    features = []
+    for feature in layer.get(2, []):
+        feature = decode_message(feature)
+        tags = decode_packed(feature[2][0]) if 2 in feature else []
+        features.append(
+            {
+                "id": feature[1][0],
+                "type": feature[3][0],
+                "properties": {
+                    keys[key]: values[value]
+                    for key, value in zip(tags[::2], tags[1::2])
+                },
+                "geometry": decode_geometry(decode_packed(feature[4][0])),
+            }
+        )
+    return {
+        "version": layer[15][0],
+        "name": layer[1][0].decode(),
+        "extent": layer[5][0],
+        "features": features,
+    }
+
+
+def build(tmp_path, features):
+    path = tmp_path / "1_1.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+    spatial_index.build_index(path, tmp_path / "1_1.geojson.idx")
+    return spatial_index.SpatialIndex(tmp_path / "1_1.geojson.idx")
+
+
+def feature(geometry, **properties):
+    return {"type": "Feature", "geometry": geometry, "properties": properties}
+
+
+def test_points_and_properties(tmp_path):
+    index = build(
+        tmp_path,
+        [
+            feature(
+                {"type": "Point", "coordinates": [0, 0]},
+                name="null island",
+                count=-3,
+                ratio=0.5,
+                visible=True,
+                _umap_options={"color": "red"},
+            ),
+            feature({"type": "Point", "coordinates": [-90, 45]}, name="elsewhere"),
+        ],
+    )
+    tile = decode_tile(vector_tiles.build_tile(index, 1, 1, 1, name="layer"))
+    assert tile["version"] == 2
+    assert tile["name"] == "layer"
+    assert tile["extent"] == 4096
+    (point,) = tile["features"]
+    assert point["id"] == 1
+    assert point["type"] == vector_tiles.POINT
+    assert point["geometry"] == [(vector_tiles.MOVE_TO, [(0, 0)])]
+    assert point["properties"] == {
+        "name": "null island",
+        "count": -3,
+        "ratio": 0.5,
+        "visible": True,
+    }
+
+
+def test_lines_are_clipped(tmp_path):
+    index = build(
+        tmp_path, [feature({"type": "LineString", "coordinates": [[-10, 0], [10, 0]]})]
+    )
+    tile = decode_tile(vector_tiles.build_tile(index, 1, 1, 1, name="layer"))
+    (line,) = tile["features"]
+    assert line["type"] == vector_tiles.LINESTRING
+    move, to = line["geometry"]
+    # Clipped to the buffer on the left.
+    assert move == (vector_tiles.MOVE_TO, [(-64, 0)])
+    assert to[0] == vector_tiles.LINE_TO
+    assert to[1][0][1] == 0
+    assert 0 < to[1][0][0] < 4096
+
+
+def test_clip_line_splits_parts():
+    parts = vector_tiles.clip_line([(-5, 5), (5, 5), (15, 5), (5, 6)], 0, 10)
+    assert parts == [[(0, 5), (5, 5), (10, 5)], [(10, 5.5), (5, 6)]]
+    assert vector_tiles.clip_line([(-5, -5), (-5, 15)], 0, 10) == []
+
+
+def test_polygons_are_clipped_and_oriented(tmp_path):
+    # Counter clockwise on the map, covering the whole tile 1/0/0.
+    exterior = [[-170, 10], [-10, 10], [-10, 80], [-170, 80], [-170, 10]]
+    hole = [[-100, 30], [-80, 30], [-80, 40], [-100, 40], [-100, 30]]
+    index = build(
+        tmp_path, [feature({"type": "Polygon", "coordinates": [exterior, hole]})]
+    )
+    tile = decode_tile(vector_tiles.build_tile(index, 1, 0, 0, name="layer"))
+    (polygon,) = tile["features"]
+    assert polygon["type"] == vector_tiles.POLYGON
+    rings, ring = [], []
+    for command, points in polygon["geometry"]:
+        if command == vector_tiles.CLOSE_PATH:
+            rings.append(ring)
+            ring = []
+        else:
+            ring.extend(points)
+    assert len(rings) == 2
+    assert vector_tiles.ring_area(rings[0]) > 0
+    assert vector_tiles.ring_area(rings[1]) < 0
+    xs = [x for x, _ in rings[0]]
+    assert max(xs) <= 4096 + 64
+
+
+def test_empty_tile(tmp_path):
+    index = build(tmp_path, [feature({"type": "Point", "coordinates": [0, 0]})])
+    assert vector_tiles.build_tile(index, 5, 0, 0, name="layer") == b""
+
+
+def test_tile_bbox():
+    assert vector_tiles.tile_bbox(0, 0, 0) == [
+        -180,
+        -85.0511287798066,
+        180,
+        85.0511287798066,
+    ]
+    west, south, east, north = vector_tiles.tile_bbox(1, 1, 0)
+    assert (west, south, east) == (0, 0, 180)
@@ -6,7 +6,9 @@ import pytest
 from django.conf import settings
 from django.contrib.auth import get_user, get_user_model
 from django.core.signing import TimestampSigner
+from django.db import connection
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.timezone import make_aware
 
@@ -14,7 +16,7 @@ from umap import VERSION
 from umap.models import Map, Star
 from umap.views import validate_url
 
-from .base import MapFactory, UserFactory
+from .base import DataLayerFactory, MapFactory, UserFactory
 
 User = get_user_model()
 
@@ -433,6 +435,38 @@ def test_home_feed(client, settings, user, tilelayer):
     assert "A reserved map starred by staff" not in content
 
 
+@pytest.mark.django_db
+def test_home_queries_do_not_depend_on_the_number_of_maps(client, user, tilelayer):
+    map_inst = MapFactory(owner=user)
+    DataLayerFactory(map=map_inst)
+    with CaptureQueriesContext(connection) as few:
+        response = client.get(reverse("home"))
+    assert response.status_code == 200
+    for i in range(3):
+        map_inst = MapFactory(owner=user)
+        DataLayerFactory(map=map_inst)
+    with CaptureQueriesContext(connection) as many:
+        response = client.get(reverse("home"))
+    assert response.status_code == 200
+    assert len(few) == len(many)
+
+
+@pytest.mark.django_db
+def test_dashboard_queries_do_not_depend_on_the_number_of_maps(client, user, tilelayer):
+    MapFactory(owner=user)
+    client.login(username=user.username, password="123123")
+    with CaptureQueriesContext(connection) as few:
+        response = client.get(reverse("user_dashboard"))
+    assert response.status_code == 200
+    for i in range(3):
+        map_inst = MapFactory(owner=user)
+        DataLayerFactory(map=map_inst)
+    with CaptureQueriesContext(connection) as many:
+        response = client.get(reverse("user_dashboard"))
+    assert response.status_code == 200
+    assert len(few) == len(many)
+
+
 @pytest.mark.django_db
 def test_websocket_token_returns_login_required_if_not_connected(client, user, map):
     token_url = reverse("map_websocket_auth_token", kwargs={"map_id": map.id})
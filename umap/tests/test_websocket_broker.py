@@ -0,0 +1,329 @@
+import asyncio
+import json
+
+import pytest
+from websockets.client import connect
+from websockets.server import serve
+
+from umap.websocket_broker import (
+    Backbone,
+    Broker,
+    BrokerBackbone,
+    Outbox,
+    RoomLog,
+    parse_url,
+)
+
+
+async def serve_backbone(backbone, room=1):
+    """Websocket server relaying every message to its room through `backbone`."""
+
+    async def handler(websocket):
+        await backbone.join(room, websocket)
+        try:
+            async for message in websocket:
+                await backbone.publish(room, message, sender=websocket)
+        finally:
+            await backbone.leave(room, websocket)
+
+    server = await serve(handler, "localhost", 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, f"ws://localhost:{port}"
+
+
+async def wait_for_subscription(broker, room, count):
+    for _ in range(100):
+        if len(broker.rooms.get(room, ())) == count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Subscription did not reach the broker")
+
+
+def test_parse_url():
+    assert parse_url("unix:///tmp/umap.sock") == {"path": "/tmp/umap.sock"}
+    assert parse_url("tcp://localhost:8002") == {"host": "localhost", "port": 8002}
+    with pytest.raises(ValueError):
+        parse_url("localhost:8002")
+
+
+def test_local_backbone_does_not_echo_to_sender():
+    async def scenario():
+        backbone = Backbone()
+        server, uri = await serve_backbone(backbone)
+        async with connect(uri) as peer1, connect(uri) as peer2:
+            await asyncio.sleep(0.05)
+            await peer1.send("hello")
+            assert await asyncio.wait_for(peer2.recv(), 1) == "hello"
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(peer1.recv(), 0.1)
+        server.close()
+        await server.wait_closed()
+        # Empty rooms are removed.
+        assert not backbone.rooms
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("scheme", ["unix", "tcp"])
+def test_broker_relays_between_processes(tmp_path, scheme):
+    async def scenario():
+        broker = Broker()
+        if scheme == "unix":
+            url = f"unix://{tmp_path / 'broker.sock'}"
+            broker_server = await broker.serve(url)
+        else:
+            broker_server = await broker.serve("tcp://127.0.0.1:0")
+            port = broker_server.sockets[0].getsockname()[1]
+            url = f"tcp://127.0.0.1:{port}"
+        # Two backbones, as if they were in two websocket server processes.
+        backbone1, backbone2 = BrokerBackbone(url), BrokerBackbone(url)
+        await backbone1.start()
+        await backbone2.start()
+        await backbone1.connected.wait()
+        await backbone2.connected.wait()
+        server1, uri1 = await serve_backbone(backbone1)
+        server2, uri2 = await serve_backbone(backbone2)
+        async with connect(uri1) as peer1, connect(uri2) as peer2:
+            await wait_for_subscription(broker, 1, 2)
+            await peer1.send('{"kind": "operation"}')
+            assert await asyncio.wait_for(peer2.recv(), 1) == '{"kind": "operation"}'
+            await peer2.send(b"\x00binary")
+            assert await asyncio.wait_for(peer1.recv(), 1) == b"\x00binary"
+        await wait_for_subscription(broker, 1, 0)
+        for server in (server1, server2):
+            server.close()
+            await server.wait_closed()
+        await backbone1.stop()
+        await backbone2.stop()
+        broker_server.close()
+        await broker_server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_backbone_resubscribes_after_broker_restart(tmp_path):
+    async def scenario():
+        url = f"unix://{tmp_path / 'broker.sock'}"
+        broker = Broker()
+        broker_server = await broker.serve(url)
+        backbone = BrokerBackbone(url)
+        backbone.RETRY_DELAY = 0.05
+        await backbone.start()
+        await backbone.connected.wait()
+        server, uri = await serve_backbone(backbone)
+        async with connect(uri):
+            await wait_for_subscription(broker, 1, 1)
+            broker_server.close()
+            for writer in list(broker.rooms[1]):
+                writer.close()
+            await broker_server.wait_closed()
+            broker = Broker()
+            broker_server = await broker.serve(url)
+            await wait_for_subscription(broker, 1, 1)
+        server.close()
+        await server.wait_closed()
+        await backbone.stop()
+        broker_server.close()
+        await broker_server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+class SlowWebSocket:
+    """Peer which only reads messages when `reading` is set."""
+
+    def __init__(self):
+        self.reading = asyncio.Event()
+        self.received = []
+        self.closed = None
+
+    async def send(self, message):
+        await self.reading.wait()
+        self.received.append(message)
+
+    async def close(self, code, reason):
+        self.closed = (code, reason)
+
+
+def update(value, key="geometry"):
+    return json.dumps(
+        {
+            "verb": "update",
+            "subject": "feature",
+            "metadata": {"id": "A"},
+            "key": key,
+            "value": value,
+            "kind": "operation",
+        }
+    )
+
+
+def test_outbox_coalesces_updates_past_high_water():
+    async def scenario():
+        websocket = SlowWebSocket()
+        outbox = Outbox(websocket, high_water=2, max_size=10)
+        for message in [update(1), update(2), update(3, key="name"), update(4)]:
+            outbox.put(message)
+            await asyncio.sleep(0)
+        # The first one is being sent, the last one replaced nothing.
+        assert len(outbox) == 3
+        outbox.put(update(5))
+        assert len(outbox) == 3
+        assert outbox.coalesced == 1
+        websocket.reading.set()
+        await asyncio.sleep(0.01)
+        values = [json.loads(message)["value"] for message in websocket.received]
+        assert values == [1, 2, 3, 5]
+        assert not len(outbox)
+        await outbox.close()
+
+    asyncio.run(scenario())
+
+
+def test_outbox_disconnects_peer_too_far_behind():
+    async def scenario():
+        websocket = SlowWebSocket()
+        outbox = Outbox(websocket, high_water=2, max_size=4)
+        for index in range(6):
+            outbox.put(json.dumps({"verb": "upsert", "value": index}))
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.01)
+        assert websocket.closed == (Outbox.RESYNC, "resync")
+        assert outbox.overflowed
+        assert not len(outbox)
+        await outbox.close()
+
+    asyncio.run(scenario())
+
+
+def test_backbone_stats():
+    async def scenario():
+        backbone = Backbone()
+        server, uri = await serve_backbone(backbone)
+        async with connect(uri) as peer1, connect(uri):
+            await asyncio.sleep(0.05)
+            await peer1.send("hello")
+            await asyncio.sleep(0.05)
+            stats = backbone.stats()
+            assert stats["rooms"] == 1
+            assert stats["connections"] == 2
+            assert stats["queued_messages"] == 0
+        server.close()
+        await server.wait_closed()
+        assert backbone.stats()["connections"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_room_log_compacts_to_last_value_per_key():
+    log = RoomLog(max_bytes=2**20)
+    upsert = json.dumps(
+        {
+            "verb": "upsert",
+            "subject": "feature",
+            "metadata": {"id": "B"},
+            "value": {},
+            "kind": "operation",
+        }
+    )
+    log.append(update(1))
+    log.append(upsert)
+    log.append('{"kind": "batch", "operations": [%s, %s]}' % (update(2), update(3)))
+    log.append(update("foo", key="name"))
+    snapshot = json.loads(log.snapshot())
+    assert snapshot["kind"] == "snapshot"
+    operations = [
+        (op["verb"], op.get("key"), op["value"]) for op in snapshot["operations"]
+    ]
+    assert operations == [
+        ("upsert", None, {}),
+        ("update", "geometry", 3),
+        ("update", "name", "foo"),
+    ]
+
+
+def test_room_log_uses_the_given_operation_keys(monkeypatch):
+    log = RoomLog(max_bytes=2**20)
+    first, second = update(1), update(2)
+    key = ("update", "feature", "{}", "geometry")
+    monkeypatch.setattr(
+        "umap.websocket_broker.operation_key", lambda raw: pytest.fail("Parsed")
+    )
+    log.append(first, [(key, first)])
+    log.append(second, [(key, second)])
+    assert json.loads(log.snapshot())["operations"] == [json.loads(second)]
+
+
+def layer_operation(verb, layer_id, key=None, value=None):
+    return json.dumps(
+        {
+            "verb": verb,
+            "subject": "datalayer",
+            "metadata": {"id": layer_id},
+            "key": key,
+            "value": value,
+            "kind": "operation",
+        }
+    )
+
+
+def feature_update(layer_id, value):
+    return json.dumps(
+        {
+            "verb": "update",
+            "subject": "feature",
+            "metadata": {"id": "F", "layerId": layer_id},
+            "key": "geometry",
+            "value": value,
+            "kind": "operation",
+        }
+    )
+
+
+def test_room_log_forgets_saved_layers():
+    log = RoomLog(max_bytes=2**20)
+    # Joiners may have loaded the layer already.
+    log.append(layer_operation("upsert", "L1", value={"name": "L1"}))
+    log.append(layer_operation("update", "L1", key="options.name", value="new"))
+    log.append(feature_update("L1", 1))
+    log.append(feature_update("L2", 2))
+    log.compact()
+    assert len(log.operations) == 3
+    log.append(layer_operation("update", "L1", key="_reference_version", value="1"))
+    snapshot = json.loads(log.snapshot())
+    assert snapshot["operations"] == [json.loads(feature_update("L2", 2))]
+    assert log.size == len(feature_update("L2", 2))
+
+
+def test_room_log_overflow():
+    log = RoomLog(max_bytes=200)
+    for index in range(10):
+        log.append(update(index, key=f"key{index}"))
+    assert log.snapshot() is None
+    assert log.overflowed
+    assert log.size == 0
+
+
+def test_late_joiner_gets_a_snapshot():
+    async def scenario():
+        backbone = Backbone()
+        server, uri = await serve_backbone(backbone)
+        async with connect(uri) as peer1:
+            await asyncio.sleep(0.05)
+            await peer1.send(update(1))
+            await peer1.send(update(2))
+            await asyncio.sleep(0.05)
+            async with connect(uri) as peer2:
+                snapshot = json.loads(await asyncio.wait_for(peer2.recv(), 1))
+                assert snapshot["kind"] == "snapshot"
+                assert [op["value"] for op in snapshot["operations"]] == [2]
+                await peer1.send(update(3))
+                message = json.loads(await asyncio.wait_for(peer2.recv(), 1))
+                assert message["value"] == 3
+        await asyncio.sleep(0.05)
+        # The room is gone with its last peer, and so is its log.
+        assert not backbone.logs
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
@@ -0,0 +1,65 @@
+import asyncio
+
+from umap.websocket_metrics import Counter, Gauge, Histogram, MetricsEndpoint, render
+
+
+def test_render_counter_and_gauge():
+    counter = Counter("umap_messages_total", "Messages.")
+    counter.inc(kind="join")
+    counter.inc(2, kind="join")
+    counter.inc(kind='"quoted"')
+    gauge = Gauge("umap_rooms", "Rooms.")
+    gauge.set(3)
+    assert render([counter, gauge]) == (
+        "# HELP umap_messages_total Messages.\n"
+        "# TYPE umap_messages_total counter\n"
+        'umap_messages_total{kind="join"} 3\n'
+        'umap_messages_total{kind="\\"quoted\\""} 1\n'
+        "# HELP umap_rooms Rooms.\n"
+        "# TYPE umap_rooms gauge\n"
+        "umap_rooms 3\n"
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("umap_latency_seconds", "Latency.", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.1, count=2)
+    histogram.observe(5)
+    lines = render([histogram]).splitlines()
+    assert lines[2:] == [
+        'umap_latency_seconds_bucket{le="0.1"} 3',
+        'umap_latency_seconds_bucket{le="1"} 3',
+        'umap_latency_seconds_bucket{le="+Inf"} 4',
+        "umap_latency_seconds_sum 5.25",
+        "umap_latency_seconds_count 4",
+    ]
+
+
+async def http_get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    response = await reader.read()
+    writer.close()
+    head, body = response.decode().split("\r\n\r\n", 1)
+    return head.splitlines(), body
+
+
+def test_metrics_endpoint():
+    gauge = Gauge("umap_rooms", "Rooms.")
+    gauge.set(1)
+
+    async def scenario():
+        endpoint = MetricsEndpoint(lambda: [gauge])
+        server = await asyncio.start_server(endpoint.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        head, body = await http_get(port, "/metrics")
+        assert head[0] == "HTTP/1.1 200 OK"
+        assert "Content-Type: text/plain; version=0.0.4; charset=utf-8" in head
+        assert body.endswith("umap_rooms 1\n")
+        head, _ = await http_get(port, "/")
+        assert head[0] == "HTTP/1.1 404 Not Found"
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
@@ -0,0 +1,196 @@
+import asyncio
+import json
+
+import pytest
+from django.core.signing import TimestampSigner
+from websockets.client import connect
+from websockets.server import serve
+
+from umap.websocket_broker import coalescing_key, operation_key
+from umap.websocket_metrics import render
+from umap.websocket_server import (
+    BatchMessage,
+    Coalescer,
+    batch_message,
+    collect_metrics,
+    compression_options,
+    get_operation_key,
+    handler,
+    parse_operation,
+)
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        {"verb": "update", "subject": "map", "key": "name", "kind": "operation"},
+        {"kind": "operation", "verb": "delete", "subject": "feature"},
+        # A nested "kind" after the top level one.
+        {"kind": "operation", "value": {"properties": {"kind": "other"}}},
+    ],
+)
+def test_parse_operation(message):
+    assert parse_operation(json.dumps(message)).kind == "operation"
+    assert parse_operation(json.dumps(message, separators=(",", ":")))
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        json.dumps({"kind": "join", "token": "xxx"}),
+        json.dumps({"verb": "update", "subject": "map"}),
+        json.dumps([{"kind": "operation"}]),
+        # Only the top level kind counts.
+        json.dumps({"kind": "join", "value": {"kind": "operation"}}),
+        json.dumps({"value": {"kind": "operation"}}),
+        '{"kind": "operation", "value": ',
+        '"kind": "operation"',
+        json.dumps({"kind": "operation"}).encode(),
+    ],
+)
+def test_parse_operation_rejects_other_messages(raw):
+    assert parse_operation(raw) is None
+
+
+def operation(verb="update", key="geometry", value=None, id="A"):
+    return json.dumps(
+        {
+            "verb": verb,
+            "subject": "feature",
+            "metadata": {"id": id, "layerId": "L"},
+            "key": key,
+            "value": value,
+            "kind": "operation",
+        }
+    )
+
+
+def test_coalescing_key():
+    assert coalescing_key(operation(value=1)) == coalescing_key(operation(value=2))
+    assert coalescing_key(operation()) != coalescing_key(operation(id="B"))
+    assert coalescing_key(operation()) != coalescing_key(operation(key="name"))
+    assert coalescing_key(operation(verb="upsert")) is None
+    assert coalescing_key('{"verb": "update", "kind": "operation"') is None
+
+
+def test_operation_key_of_parsed_message_is_the_same():
+    for raw in [operation(), operation(verb="upsert"), operation(key=None)]:
+        assert get_operation_key(parse_operation(raw)) == operation_key(raw)
+
+
+def test_batch_message_is_valid():
+    raw = batch_message([operation(value=1), operation(verb="delete")])
+    batch = BatchMessage.model_validate_json(raw)
+    assert [op.verb for op in batch.operations] == ["update", "delete"]
+
+
+def operations_of(raw_batch):
+    return [json.dumps(op) for op in json.loads(raw_batch)["operations"]]
+
+
+def test_coalescer_throttles_and_keeps_last_values():
+    published = []
+
+    async def publish(raw_message, operations):
+        assert [raw for _, raw in operations] == (
+            [raw_message] if len(operations) == 1 else operations_of(raw_message)
+        )
+        published.append(json.loads(raw_message))
+
+    async def push(coalescer, raw_message):
+        await coalescer.push(raw_message, operation_key(raw_message))
+
+    async def scenario():
+        coalescer = Coalescer(publish, delay=0.05)
+        await push(coalescer, operation(value=1))
+        # Sent right away.
+        assert [message["value"] for message in published] == [1]
+        await push(coalescer, operation(value=2))
+        await push(coalescer, operation(key="name", value="foo"))
+        await push(coalescer, operation(value=3))
+        await push(coalescer, operation(id="B", verb="delete"))
+        assert len(published) == 1
+        await asyncio.sleep(0.1)
+        assert len(published) == 2
+        batch = published[1]
+        assert batch["kind"] == "batch"
+        assert [(op["verb"], op["key"], op["value"]) for op in batch["operations"]] == [
+            ("update", "name", "foo"),
+            ("update", "geometry", 3),
+            ("delete", "geometry", None),
+        ]
+        # A lone message in a window is not wrapped in a batch.
+        await push(coalescer, operation(value=4))
+        await coalescer.close()
+        assert published[2]["kind"] == "operation"
+        assert published[2]["value"] == 4
+
+    asyncio.run(scenario())
+
+
+def test_compression_options(settings):
+    settings.WEBSOCKET_COMPRESSION = ""
+    assert compression_options() == {"compression": None}
+    settings.WEBSOCKET_COMPRESSION = "brotli"
+    with pytest.raises(ValueError):
+        compression_options()
+
+
+def test_deflate_is_negotiated_with_settings(settings):
+    settings.WEBSOCKET_COMPRESSION = "deflate"
+    settings.WEBSOCKET_DEFLATE_WINDOW_BITS = 10
+    settings.WEBSOCKET_DEFLATE_MEMORY_LEVEL = 3
+
+    async def echo(websocket):
+        async for message in websocket:
+            await websocket.send(message)
+
+    async def scenario():
+        server = await serve(echo, "localhost", 0, **compression_options())
+        port = server.sockets[0].getsockname()[1]
+        async with connect(f"ws://localhost:{port}") as websocket:
+            [extension] = websocket.extensions
+            assert extension.local_max_window_bits == 10
+            assert extension.remote_max_window_bits == 10
+            message = json.dumps({"coordinates": [[1.5, 2.5]] * 1000})
+            await websocket.send(message)
+            assert await websocket.recv() == message
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_metrics_of_a_room():
+    token = TimestampSigner().sign_object(
+        {"user": "bob", "map_id": 1234, "permissions": ["edit"]}
+    )
+    join = json.dumps({"kind": "join", "token": token})
+
+    def sample(lines, prefix):
+        [line] = [line for line in lines if line.startswith(prefix)]
+        return float(line.rsplit(" ", 1)[1])
+
+    async def scenario():
+        server = await serve(handler, "localhost", 0)
+        uri = f"ws://localhost:{server.sockets[0].getsockname()[1]}"
+        before = render(collect_metrics()).splitlines()
+        async with connect(uri) as peer1, connect(uri) as peer2:
+            await peer1.send(join)
+            await peer2.send(join)
+            await asyncio.sleep(0.05)
+            await peer1.send('{"kind": "join"}')
+            await peer1.send(operation())
+            await asyncio.wait_for(peer2.recv(), 1)
+            lines = render(collect_metrics()).splitlines()
+            assert sample(lines, 'umap_websocket_room_peers{room="1234"}') == 2
+            assert sample(lines, "umap_websocket_sent_messages_total") == (
+                sample(before, "umap_websocket_sent_messages_total") + 1
+            )
+            invalid = 'umap_websocket_invalid_messages_total{kind="operation"}'
+            assert sample(lines, invalid) >= 1
+            assert len([line for line in lines if "queue_size{" in line]) == 2
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
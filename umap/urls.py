@@ -25,7 +25,7 @@ urlpatterns = [
     re_path(r"^admin/", admin.site.urls),
     re_path("", include("social_django.urls", namespace="social")),
     re_path(r"^m/(?P<pk>\d+)/$", views.MapShortUrl.as_view(), name="map_short_url"),
-    re_path(r"^ajax-proxy/$", cache_page(180)(views.ajax_proxy), name="ajax-proxy"),
+    re_path(r"^ajax-proxy/$", views.ajax_proxy, name="ajax-proxy"),
     re_path(
         r"^change-password/",
         auth_views.PasswordChangeView.as_view(),
@@ -82,6 +82,16 @@ i18n_urls += decorated_patterns(
         views.DataLayerVersions.as_view(),
         name="datalayer_versions",
     ),
+    path(
+        "datalayer/<int:map_id>/<uuid:pk>/bbox/",
+        views.DataLayerBBox.as_view(),
+        name="datalayer_bbox",
+    ),
+    path(
+        "datalayer/<int:map_id>/<uuid:pk>/tiles/<int:z>/<int:x>/<int:y>.mvt",
+        views.DataLayerTile.as_view(),
+        name="datalayer_tile",
+    ),
     path(
         "datalayer/<int:map_id>/<uuid:pk>/<str:name>",
         views.DataLayerVersion.as_view(),
@@ -1,10 +1,37 @@
 import gzip
+import hashlib
 import json
 import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Brotli and Zstandard precompression are optional, see UMAP_PRECOMPRESS.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
 from django.urls import URLPattern, URLResolver, get_resolver
+from django.utils import translation
+
+# Templated URLs of all named patterns, by active language (which drives the
+# i18n_patterns prefix), computed once per process.
+URL_TEMPLATES = {}
 
 
 def _urls_for_js(urls=None):
@@ -12,15 +39,40 @@ def _urls_for_js(urls=None):
     Return templated URLs prepared for javascript.
     """
     if urls is None:
+        return dict(get_url_templates()["urls"])
+    urls = dict(zip(urls, [get_uri_template(url) for url in urls]))
+    urls.update(getattr(settings, "UMAP_EXTRA_URLS", {}))
+    return urls
+
+
+def get_url_templates():
+    """
+    Return the templated URLs for the active language, and a stable hash
+    of them, walking the url patterns only on first call.
+    """
+    lang = translation.get_language()
+    if lang not in URL_TEMPLATES:
         # prevent circular import
         from .urls import i18n_urls, urlpatterns
 
-        urls = [
+        names = [
             url.name for url in urlpatterns + i18n_urls if getattr(url, "name", None)
         ]
-    urls = dict(zip(urls, [get_uri_template(url) for url in urls]))
-    urls.update(getattr(settings, "UMAP_EXTRA_URLS", {}))
-    return urls
+        urls = _urls_for_js(names)
+        dumped = json.dumps(urls, sort_keys=True).encode()
+        URL_TEMPLATES[lang] = {
+            "urls": urls,
+            "hash": hashlib.md5(dumped, usedforsecurity=False).hexdigest()[:12],
+        }
+    return URL_TEMPLATES[lang]
+
+
+def get_urls_hash():
+    return get_url_templates()["hash"]
+
+
+def clear_url_templates(**kwargs):
+    URL_TEMPLATES.clear()
 
 
 def get_uri_template(urlname, args=None, prefix=""):
@@ -125,12 +177,284 @@ def decorated_patterns(func, *urls):
     return urls
 
 
-def gzip_file(from_path, to_path):
+# Extensions of the precompressed files, by content coding, in order of
+# preference when the client accepts several of them equally.
+ENCODINGS = {"zstd": ".zst", "br": ".br", "gzip": ".gz"}
+COMPRESS_CHUNK_SIZE = 2**20
+
+
+def get_encodings():
+    """Content codings to precompress the layers with, as ENCODINGS."""
+    if not settings.UMAP_GZIP:
+        return []
+    available = {"gzip": True, "br": brotli is not None, "zstd": zstandard is not None}
+    return [
+        encoding
+        for encoding in ENCODINGS
+        if encoding in settings.UMAP_PRECOMPRESS and available[encoding]
+    ]
+
+
+def negotiate_encoding(accept_encoding, encodings):
+    """
+    Return the content coding among `encodings` the client prefers, given its
+    Accept-Encoding header, or None for the identity.
+    """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, *params = [param.strip() for param in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if coding:
+            accepted[coding.lower()] = quality
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get("*", 0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress_file(from_path, to_path, encoding="gzip", level=None):
+    """
+    Compress `from_path` into `to_path` with the given content coding, with
+    the same mtime. Without `level`, use the one set in UMAP_PRECOMPRESS.
+    """
+    if level is None:
+        level = settings.UMAP_PRECOMPRESS.get(encoding)
     stat = os.stat(from_path)
-    with open(from_path, "rb") as f_in:
-        with gzip.open(to_path, "wb") as f_out:
-            f_out.writelines(f_in)
-    os.utime(to_path, ns=(stat.st_mtime_ns, stat.st_mtime_ns))
+    with atomic_write(to_path, mtime_ns=stat.st_mtime_ns) as tmp:
+        with open(from_path, "rb") as f_in:
+            if encoding == "gzip":
+                with gzip.open(
+                    tmp, "wb", compresslevel=6 if level is None else level
+                ) as f_out:
+                    shutil.copyfileobj(f_in, f_out, COMPRESS_CHUNK_SIZE)
+            elif encoding == "br":
+                compressor = brotli.Compressor(
+                    mode=brotli.MODE_TEXT, quality=4 if level is None else level
+                )
+                while chunk := f_in.read(COMPRESS_CHUNK_SIZE):
+                    tmp.write(compressor.process(chunk))
+                tmp.write(compressor.finish())
+            elif encoding == "zstd":
+                compressor = zstandard.ZstdCompressor(
+                    level=9 if level is None else level
+                )
+                compressor.copy_stream(
+                    f_in, tmp, size=stat.st_size, write_size=COMPRESS_CHUNK_SIZE
+                )
+            else:
+                raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def gzip_file(from_path, to_path):
+    """
+    Compress `from_path` into `to_path`, with the same mtime.
+    """
+    compress_file(from_path, to_path, "gzip")
+
+
+@contextmanager
+def atomic_write(path, mtime_ns=None):
+    """
+    Yield a binary file to write the content of `path` to. The file is
+    written under a temporary name then renamed, so readers never see a
+    partial file and concurrent writers do not corrupt each other.
+    """
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path) or ".",
+        prefix=f".{os.path.basename(path)}.",
+        suffix=".tmp",
+        delete=False,
+    ) as tmp:
+        try:
+            yield tmp
+            tmp.close()
+            if mtime_ns is not None:
+                os.utime(tmp.name, ns=(mtime_ns, mtime_ns))
+            # Temporary files are only readable by their owner.
+            os.chmod(tmp.name, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+            os.replace(tmp.name, path)
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on the file at `path`, waiting for other holders,
+    be they in other threads or other processes. The file is only opened for
+    reading, and is not modified.
+    """
+    with open(path, "rb") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        # Closing the file releases the lock.
+        yield
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls with the same key: the first one runs the
+    function, the ones made meanwhile in other threads wait for it and get
+    its result, or its exception.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def run(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+class ExpiringCache:
+    """
+    In memory cache bounded in size (as given when setting each value), whose
+    entries expire `ttl` seconds after being set. Least recently used entries
+    are evicted first.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires, size, value = entry
+            if expires <= time.monotonic():
+                self.discard(key)
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_size:
+            return
+        with self.lock:
+            self.discard(key)
+            now = time.monotonic()
+            for other, (expires, _, _) in list(self.entries.items()):
+                if expires <= now:
+                    self.discard(other)
+            self.entries[key] = (now + self.ttl, size, value)
+            self.size += size
+            while self.size > self.max_size:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+def json_object_chunks(path, extra=None, chunk_size=64 * 1024):
+    """
+    Yield the raw bytes of the JSON object stored at `path`, chunk by chunk,
+    with the `extra` members set, without parsing the document.
+
+    When the last member of the object is one of the `extra` keys (uMap
+    stores `_umap_options` after the features), it is replaced. Otherwise
+    `extra` members are appended, and as JSON parsers keep the last
+    occurrence of a duplicated key, they still take precedence.
+    """
+    with open(path, "rb") as f:
+        if not extra:
+            yield from iter(lambda: f.read(chunk_size), b"")
+            return
+        closing = _last_significant_byte(f, f.seek(0, os.SEEK_END))
+        if closing is None or f.read(1) != b"}":
+            raise ValueError(f"{path} does not contain a JSON object")
+        end = _trailing_member_start(f, closing, extra.keys()) or closing
+        previous = _last_significant_byte(f, end)
+        separator = f.read(1)
+        if separator == b",":
+            # Replaced member was not the only one, drop its leading comma.
+            end = previous
+        is_empty = previous is not None and separator == b"{"
+        f.seek(0)
+        remaining = end
+        while remaining:
+            chunk = f.read(min(chunk_size, remaining))
+            remaining -= len(chunk)
+            yield chunk
+    members = json_dumps(extra)[1:-1]
+    yield ("" if is_empty else ", ").encode() + members.encode() + b"}"
+
+
+def _trailing_member_start(f, closing, keys, window=64 * 1024):
+    """
+    Return the position of the last member of the object closed at `closing`
+    if its key is one of `keys`, reading only the end of the file.
+    """
+    start = max(0, closing - window)
+    f.seek(start)
+    tail = f.read(closing - start)
+    for key in keys:
+        needle = json.dumps(key).encode()
+        position = tail.rfind(needle)
+        while position != -1:
+            try:
+                # Only parses if the key starts a member closing the object.
+                member = json.loads(b"{" + tail[position:] + b"}")
+            except ValueError:
+                position = tail.rfind(needle, 0, position)
+                continue
+            if list(member) == [key]:
+                return start + position
+            break
+    return None
+
+
+def _last_significant_byte(f, end):
+    """Seek to the last non whitespace byte before `end`, and return its position."""
+    position = end
+    while position > 0:
+        position -= 1
+        f.seek(position)
+        if not f.read(1).isspace():
+            f.seek(position)
+            return position
+    return None
 
 
 def is_ajax(request):
@@ -138,7 +462,80 @@ def is_ajax(request):
 
 
 class ConflictError(ValueError):
-    pass
+    def __init__(self, conflicts=None):
+        # Ids of the features changed on both sides, when known.
+        self.conflicts = conflicts or []
+        super().__init__(self.conflicts)
+
+
+class FeatureIndex:
+    """
+    Multiset of features, answering membership in constant time.
+
+    Features are bucketed by their `id` (set by uMap on each feature), or by
+    a hashable copy of their content when they have none, then compared
+    with `==` inside the bucket, so membership is the same as for a list.
+
+    Indexes built from the same `keys` dict share the computed keys, which
+    is only valid while the features are alive and not modified.
+    """
+
+    def __init__(self, features, keys=None):
+        self.keys = {} if keys is None else keys
+        self.buckets = defaultdict(list)
+        for feature in features:
+            self.buckets[self.key(feature)].append(feature)
+
+    def key(self, feature):
+        if id(feature) not in self.keys:
+            key = None
+            if isinstance(feature, dict) and "id" in feature:
+                try:
+                    key = ("id", hash(feature["id"]))
+                except TypeError:
+                    pass
+            self.keys[id(feature)] = key or ("content", freeze(feature))
+        return self.keys[id(feature)]
+
+    def __contains__(self, feature):
+        bucket = self.buckets.get(self.key(feature), [])
+        return any(candidate == feature for candidate in bucket)
+
+    def pop(self, feature):
+        """Remove one occurrence of `feature`, return whether there was one."""
+        bucket = self.buckets.get(self.key(feature), [])
+        for index, candidate in enumerate(bucket):
+            if candidate == feature:
+                del bucket[index]
+                return True
+        return False
+
+
+def freeze(value):
+    """Return a hashable version of a JSON like value, equal to any equal value."""
+    if isinstance(value, dict):
+        return frozenset((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def index_by_id(features):
+    """
+    Map each feature `id` to its feature, or return None if some feature has
+    no usable id or if an id is used more than once.
+    """
+    index = {}
+    for feature in features:
+        if not isinstance(feature, dict):
+            return None
+        try:
+            if feature.get("id") is None or feature["id"] in index:
+                return None
+            index[feature["id"]] = feature
+        except TypeError:  # Unhashable id.
+            return None
+    return index
 
 
 def merge_features(reference: list, latest: list, incoming: list):
@@ -146,22 +543,73 @@ def merge_features(reference: list, latest: list, incoming: list):
     if latest == incoming:
         return latest
 
-    removed = [item for item in reference if item not in incoming]
-    added = [item for item in incoming if item not in reference]
+    indexes = [index_by_id(features) for features in (reference, latest, incoming)]
+    if None in indexes:
+        return merge_features_by_content(reference, latest, incoming)
+    return merge_features_by_id(*indexes)
 
-    # Ensure that items changed in the reference weren't also changed in the latest.
-    for item in removed:
-        if item not in latest:
-            raise ConflictError()
 
-    merged = latest[:]
+def merge_features_by_id(reference: dict, latest: dict, incoming: dict):
+    """
+    Three-way merge of features indexed by id: a feature only conflicts when
+    it has been changed (or deleted) differently in latest and in incoming.
+    Edited features keep their position in latest, new ones are appended in
+    incoming order.
+    """
+    merged = {}
+    conflicts = []
+    for id_, feature in latest.items():
+        reference_feature = reference.get(id_)
+        incoming_feature = incoming.get(id_)
+        if incoming_feature == reference_feature or incoming_feature == feature:
+            # Untouched by incoming (or changed the same way).
+            merged[id_] = feature
+        elif feature == reference_feature:
+            if incoming_feature is not None:
+                merged[id_] = incoming_feature
+            # Else deleted by incoming.
+        else:
+            conflicts.append(id_)
+    for id_, feature in incoming.items():
+        if id_ in latest:
+            continue
+        if id_ not in reference:
+            merged[id_] = feature
+        elif feature != reference[id_]:
+            # Changed by incoming, deleted in latest.
+            conflicts.append(id_)
+    if conflicts:
+        raise ConflictError(conflicts)
+    return list(merged.values())
+
+
+def merge_features_by_content(reference: list, latest: list, incoming: list):
+    """
+    Merge features as opaque values: a change is a removal plus an addition,
+    so any removed feature missing from latest is a conflict.
+    """
+    keys = {}
+    reference_index = FeatureIndex(reference, keys)
+    incoming_index = FeatureIndex(incoming, keys)
+    removed = [item for item in reference if item not in incoming_index]
+    added = [item for item in incoming if item not in reference_index]
 
-    # Reapply the changes on top of the latest.
-    for item in removed:
-        merged.remove(item)
+    # Ensure that items changed in the reference weren't also changed in the latest.
+    latest_index = FeatureIndex(latest, keys)
+    conflicts = [item for item in removed if item not in latest_index]
+    if conflicts:
+        raise ConflictError(
+            [
+                item["id"]
+                for item in conflicts
+                if isinstance(item, dict) and "id" in item
+            ]
+        )
 
-    for item in added:
-        merged.append(item)
+    # Reapply the changes on top of the latest.
+    removed_index = FeatureIndex(removed, keys)
+    merged = [item for item in latest if not removed_index.pop(item)]
+    merged.extend(added)
 
     return merged
 
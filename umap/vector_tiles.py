@@ -0,0 +1,342 @@
+"""Mapbox Vector Tiles (version 2.1) of a datalayer, in pure Python.
+
+Features are picked from the spatial index of the layer, projected to Web
+Mercator, clipped to the tile (plus a buffer, so strokes do not show seams)
+and quantized to its extent. Only the protobuf messages of the
+specification are needed, so they are written by hand:
+https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+"""
+
+import json
+import math
+import struct
+
+EXTENT = 4096
+BUFFER = 64
+MAX_ZOOM = 24
+MAX_LATITUDE = 85.0511287798066
+CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+
+POINT, LINESTRING, POLYGON = 1, 2, 3
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+
+
+# Protobuf encoding.
+
+
+def varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field_varint(number, value):
+    return varint(number << 3) + varint(value)
+
+
+def field_bytes(number, value):
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def field_double(number, value):
+    return varint(number << 3 | 1) + struct.pack("<d", value)
+
+
+def field_packed(number, values):
+    return field_bytes(number, b"".join(varint(value) for value in values))
+
+
+def encode_value(value):
+    if isinstance(value, bool):
+        return field_varint(7, int(value))
+    if isinstance(value, int) and -(2**63) <= value < 2**64:
+        if value >= 0:
+            return field_varint(5, value)
+        return field_varint(6, zigzag(value))
+    if isinstance(value, float):
+        return field_double(3, value)
+    return field_bytes(1, str(value).encode())
+
+
+# Geometry.
+
+
+def tile_bbox(z, x, y, buffer=0):
+    """Return [west, south, east, north] of the tile, in degrees."""
+    size = 2**z
+    margin = buffer / EXTENT
+
+    def lng(tx):
+        return tx / size * 360 - 180
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / size))))
+
+    return [
+        lng(x - margin),
+        lat(min(y + 1 + margin, size)),
+        lng(x + 1 + margin),
+        lat(max(y - margin, 0)),
+    ]
+
+
+class Projection:
+    """Project positions (in degrees) to the coordinates of a tile."""
+
+    def __init__(self, z, x, y):
+        self.size = 2**z
+        self.x = x
+        self.y = y
+
+    def __call__(self, position):
+        lng, lat = position[0], position[1]
+        lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+        sin = math.sin(math.radians(lat))
+        tx = (lng + 180) / 360 * self.size
+        ty = (0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)) * self.size
+        return ((tx - self.x) * EXTENT, (ty - self.y) * EXTENT)
+
+
+def clip_line(points, low, high):
+    """Clip a polyline to the square [low, high], return the parts inside."""
+    parts, current = [], []
+    for start, end in zip(points, points[1:]):
+        # Liang-Barsky.
+        t0, t1 = 0, 1
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        for p, q in (
+            (-dx, start[0] - low),
+            (dx, high - start[0]),
+            (-dy, start[1] - low),
+            (dy, high - start[1]),
+        ):
+            if p == 0:
+                if q < 0:
+                    t0, t1 = 1, 0
+                    break
+            elif p < 0:
+                t0 = max(t0, q / p)
+            else:
+                t1 = min(t1, q / p)
+        if t0 > t1:
+            if current:
+                parts.append(current)
+                current = []
+            continue
+        a = (start[0] + t0 * dx, start[1] + t0 * dy)
+        b = (start[0] + t1 * dx, start[1] + t1 * dy)
+        if current and (t0 > 0 or current[-1] != a):
+            parts.append(current)
+            current = []
+        if not current:
+            current.append(a)
+        current.append(b)
+        if t1 < 1:
+            parts.append(current)
+            current = []
+    if current:
+        parts.append(current)
+    return parts
+
+
+def clip_ring(points, low, high):
+    """Clip a ring to the square [low, high] (Sutherland-Hodgman)."""
+    for axis, bound, inside in (
+        (0, low, lambda value: value >= low),
+        (0, high, lambda value: value <= high),
+        (1, low, lambda value: value >= low),
+        (1, high, lambda value: value <= high),
+    ):
+        if not points:
+            break
+        clipped = []
+        for index, end in enumerate(points):
+            start = points[index - 1]
+            if inside(end[axis]):
+                if not inside(start[axis]):
+                    clipped.append(intersect(start, end, axis, bound))
+                clipped.append(end)
+            elif inside(start[axis]):
+                clipped.append(intersect(start, end, axis, bound))
+        points = clipped
+    return points
+
+
+def intersect(start, end, axis, bound):
+    t = (bound - start[axis]) / (end[axis] - start[axis])
+    other = 1 - axis
+    point = [0, 0]
+    point[axis] = bound
+    point[other] = start[other] + t * (end[other] - start[other])
+    return tuple(point)
+
+
+def quantize(points):
+    out = []
+    for point in points:
+        point = (round(point[0]), round(point[1]))
+        if not out or out[-1] != point:
+            out.append(point)
+    return out
+
+
+def ring_area(points):
+    return sum(
+        points[index - 1][0] * point[1] - point[0] * points[index - 1][1]
+        for index, point in enumerate(points)
+    )
+
+
+class GeometryEncoder:
+    """Accumulate the commands of a geometry, with coordinates as deltas."""
+
+    def __init__(self):
+        self.commands = []
+        self.cursor = (0, 0)
+
+    def command(self, command, count):
+        self.commands.append(command & 0x7 | count << 3)
+
+    def add_points(self, points):
+        for x, y in points:
+            self.commands.append(zigzag(x - self.cursor[0]))
+            self.commands.append(zigzag(y - self.cursor[1]))
+            self.cursor = (x, y)
+
+    def move_to(self, points):
+        self.command(MOVE_TO, len(points))
+        self.add_points(points)
+
+    def line_to(self, points):
+        self.command(LINE_TO, len(points))
+        self.add_points(points)
+
+    def close_path(self):
+        self.command(CLOSE_PATH, 1)
+
+
+def iter_parts(geometry, kind):
+    """Yield the coordinates of the parts of `geometry` of the given kind."""
+    geometry_type = geometry.get("type")
+    coordinates = geometry.get("coordinates") or []
+    if geometry_type == kind:
+        yield coordinates
+    elif geometry_type == f"Multi{kind}":
+        yield from coordinates
+
+
+def encode_geometry(geometry, project):
+    """Return (type, commands) of `geometry` in the tile, or None if outside."""
+    if not geometry:
+        return None
+    low, high = -BUFFER, EXTENT + BUFFER
+    encoder = GeometryEncoder()
+    kind = geometry.get("type", "").replace("Multi", "")
+    if kind == "Point":
+        points = []
+        for position in iter_parts(geometry, "Point"):
+            x, y = project(position)
+            if low <= x <= high and low <= y <= high:
+                points.append((round(x), round(y)))
+        if not points:
+            return None
+        encoder.move_to(points)
+        return POINT, encoder.commands
+    if kind == "LineString":
+        for line in iter_parts(geometry, "LineString"):
+            projected = [project(position) for position in line]
+            for part in clip_line(projected, low, high):
+                part = quantize(part)
+                if len(part) >= 2:
+                    encoder.move_to(part[:1])
+                    encoder.line_to(part[1:])
+        return (LINESTRING, encoder.commands) if encoder.commands else None
+    if kind == "Polygon":
+        for polygon in iter_parts(geometry, "Polygon"):
+            for index, ring in enumerate(polygon):
+                projected = [project(position) for position in ring]
+                ring = quantize(clip_ring(projected, low, high))
+                if len(ring) > 1 and ring[0] == ring[-1]:
+                    ring.pop()
+                area = ring_area(ring) if len(ring) >= 3 else 0
+                if not area:
+                    if index == 0:
+                        # Without its exterior ring, holes are meaningless.
+                        break
+                    continue
+                # Exterior rings have a positive area, interior ones negative.
+                if (area > 0) != (index == 0):
+                    ring.reverse()
+                encoder.move_to(ring[:1])
+                encoder.line_to(ring[1:])
+                encoder.close_path()
+        return (POLYGON, encoder.commands) if encoder.commands else None
+    # GeometryCollection has no equivalent in vector tiles.
+    return None
+
+
+class LayerEncoder:
+    def __init__(self, name):
+        self.name = name
+        self.features = []
+        self.keys = {}
+        self.values = {}
+
+    def tag(self, table, key):
+        if key not in table:
+            table[key] = len(table)
+        return table[key]
+
+    def add(self, feature_id, geometry_type, commands, properties):
+        tags = []
+        for key, value in properties.items():
+            # Nested values (like _umap_options) have no equivalent.
+            if key.startswith("_") or value is None or isinstance(value, (dict, list)):
+                continue
+            tags.append(self.tag(self.keys, key))
+            # Keep True and 1 apart, they are equal as dict keys.
+            tags.append(self.tag(self.values, (type(value), value)))
+        self.features.append(
+            field_varint(1, feature_id)
+            + field_packed(2, tags)
+            + field_varint(3, geometry_type)
+            + field_packed(4, commands)
+        )
+
+    def encode(self):
+        return (
+            field_varint(15, 2)
+            + field_bytes(1, self.name.encode())
+            + b"".join(field_bytes(2, feature) for feature in self.features)
+            + b"".join(field_bytes(3, key.encode()) for key in self.keys)
+            + b"".join(field_bytes(4, encode_value(value)) for _, value in self.values)
+            + field_varint(5, EXTENT)
+        )
+
+
+def build_tile(index, z, x, y, name):
+    """Return the tile z/x/y of the layer whose SpatialIndex is `index`.
+
+    The tile has one layer, called `name`. It is empty (zero bytes) when no
+    feature is visible in it.
+    """
+    project = Projection(z, x, y)
+    found = index.search(tile_bbox(z, x, y, BUFFER), zoom=z)
+    layer = LayerEncoder(name)
+    for feature_id, raw in zip(found, index.read_features(found)):
+        feature = json.loads(raw)
+        encoded = encode_geometry(feature.get("geometry"), project)
+        if encoded is None:
+            continue
+        # Zero is not a valid id, as it is the default value.
+        layer.add(feature_id + 1, *encoded, feature.get("properties") or {})
+    if not layer.features:
+        return b""
+    return field_bytes(3, layer.encode())
@@ -1,19 +1,16 @@
 import io
 import json
+import math
 import mimetypes
-import os
 import re
-import socket
 import zipfile
 from datetime import datetime, timedelta
-from http.client import InvalidURL
 from io import BytesIO
 from pathlib import Path
 from smtplib import SMTPException
-from urllib.error import HTTPError, URLError
 from urllib.parse import quote, quote_plus, urlparse
-from urllib.request import Request, build_opener
 
+import requests
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
@@ -21,6 +18,7 @@ from django.contrib.auth import logout as do_logout
 from django.contrib.gis.measure import D
 from django.contrib.postgres.search import SearchQuery, SearchVector
 from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core.mail import send_mail
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
@@ -34,11 +32,12 @@ from django.http import (
     HttpResponsePermanentRedirect,
     HttpResponseRedirect,
     HttpResponseServerError,
+    StreamingHttpResponse,
 )
-from django.middleware.gzip import re_accepts_gzip
 from django.shortcuts import get_object_or_404
 from django.urls import resolve, reverse, reverse_lazy
 from django.utils import translation
+from django.utils.cache import patch_response_headers, patch_vary_headers
 from django.utils.encoding import smart_bytes
 from django.utils.timezone import make_aware
 from django.utils.translation import gettext as _
@@ -50,7 +49,7 @@ from django.views.generic.detail import BaseDetailView
 from django.views.generic.edit import CreateView, DeleteView, FormView, UpdateView
 from django.views.generic.list import ListView
 
-from . import VERSION
+from . import VERSION, compact_geojson, proxy, vector_tiles
 from .forms import (
     DEFAULT_CENTER,
     DEFAULT_LATITUDE,
@@ -65,14 +64,30 @@ from .forms import (
     UpdateMapPermissionsForm,
     UserProfileForm,
 )
-from .models import DataLayer, Licence, Map, Pictogram, Star, TileLayer
+from .models import (
+    DataLayer,
+    Licence,
+    Map,
+    Pictogram,
+    Star,
+    TileLayer,
+    get_cache_version,
+)
+from .simplify import get_level_path, pick_level
+from .spatial_index import load_index
 from .utils import (
+    ENCODINGS,
     ConflictError,
+    ExpiringCache,
+    SingleFlight,
     _urls_for_js,
-    gzip_file,
+    compress_file,
+    get_encodings,
+    get_urls_hash,
     is_ajax,
     json_dumps,
     merge_features,
+    negotiate_encoding,
 )
 
 User = get_user_model()
@@ -103,6 +118,9 @@ class PaginatorMixin:
             # If page is out of range (e.g. 9999), deliver last page of
             # results.
             qs = paginator.page(paginator.num_pages)
+        # Paginated lists are maps lists.
+        qs.object_list = list(qs.object_list)
+        Map.prefetch_preview_settings(qs.object_list)
         return qs
 
     def get_context_data(self, **kwargs):
@@ -271,7 +289,8 @@ class Search(PaginatorMixin, TemplateView, PublicMapsMixin, SearchMixin):
             qs_count = qs.count()
             results = self.paginate(qs)
         else:
-            results = self.get_public_maps()[: settings.UMAP_MAPS_PER_SEARCH]
+            results = list(self.get_public_maps()[: settings.UMAP_MAPS_PER_SEARCH])
+            Map.prefetch_preview_settings(results)
         kwargs.update({"maps": results, "count": qs_count})
         return kwargs
 
@@ -317,20 +336,27 @@ class UserDownload(DetailView, SearchMixin):
         return qs.order_by("-modified_at")
 
     def render_to_response(self, context, *args, **kwargs):
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-            for map_ in self.get_maps():
-                umapjson = map_.generate_umapjson(self.request)
-                geojson_file = io.StringIO(json_dumps(umapjson))
-                file_name = f"umap_backup_{map_.slug}_{map_.pk}.umap"
-                zip_file.writestr(file_name, geojson_file.getvalue())
-
-        response = HttpResponse(zip_buffer.getvalue(), content_type="application/zip")
+        response = StreamingHttpResponse(
+            self.stream_zip(), content_type="application/zip"
+        )
         response["Content-Disposition"] = (
             'attachment; filename="umap_backup_complete.zip"'
         )
         return response
 
+    def stream_zip(self):
+        # The archive is sent as soon as it is written, so only one chunk of
+        # one datalayer is in memory at a time.
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED, False) as zip_file:
+            for map_ in self.get_maps():
+                file_name = f"umap_backup_{map_.slug}_{map_.pk}.umap"
+                with zip_file.open(file_name, "w") as umap_file:
+                    for chunk in map_.generate_umapjson(self.request):
+                        umap_file.write(chunk)
+                        yield stream.flush_chunks()
+        yield stream.flush_chunks()
+
 
 user_download = UserDownload.as_view()
 
@@ -383,9 +409,8 @@ def validate_url(request):
     assert toproxy.hostname != "localhost"
     assert toproxy.netloc != local.netloc
     try:
-        # clean this when in python 3.4
-        ipaddress = socket.gethostbyname(toproxy.hostname)
-    except:
+        ipaddress = proxy.RESOLVER.resolve(toproxy.hostname)
+    except (OSError, UnicodeError):
         raise AssertionError()
     assert not PRIVATE_IP.match(ipaddress)
     return url
@@ -410,32 +435,41 @@ class AjaxProxy(View):
 
         # You should not use this in production (use Nginx or so)
         headers = {"User-Agent": "uMapProxy +http://wiki.openstreetmap.org/wiki/UMap"}
-        request = Request(url, headers=headers)
-        opener = build_opener()
         try:
-            proxied_request = opener.open(request, timeout=10)
-        except HTTPError as e:
-            return HttpResponse(e.msg, status=e.code, content_type="text/plain")
-        except URLError:
-            return HttpResponseBadRequest("URL error")
-        except InvalidURL:
-            return HttpResponseBadRequest("Invalid URL")
-        except TimeoutError:
+            proxied = proxy.CACHE.get(url, ttl=ttl, headers=headers)
+        except proxy.HostBusy:
+            return HttpResponse(
+                "Too many requests to this host", status=503, content_type="text/plain"
+            )
+        except requests.Timeout:
             return HttpResponseBadRequest("Timeout")
-        else:
-            status_code = proxied_request.code
-            content_type = proxied_request.headers.get("Content-Type")
-            if not content_type:
-                content_type, encoding = mimetypes.guess_type(url)
-            content = proxied_request.read()
-            # Quick hack to prevent Django from adding a Vary: Cookie header
-            self.request.session.accessed = False
-            response = HttpResponse(
-                content, status=status_code, content_type=content_type
+        except (requests.exceptions.InvalidURL, requests.exceptions.InvalidSchema):
+            return HttpResponseBadRequest("Invalid URL")
+        except requests.RequestException:
+            return HttpResponseBadRequest("URL error")
+        if isinstance(proxied, proxy.Entry):
+            content_type = proxied.content_type
+            response = HttpResponse(proxied.body)
+            expires_in = proxied.expires_in(ttl)
+        elif proxied.status_code >= 400:
+            proxied.close()
+            return HttpResponse(
+                proxied.reason, status=proxied.status_code, content_type="text/plain"
             )
-            if ttl:
-                response["X-Accel-Expires"] = ttl
-            return response
+        else:
+            content_type = proxied.headers.get("Content-Type")
+            response = StreamingHttpResponse(proxied, status=proxied.status_code)
+            expires_in = ttl or proxy.get_max_age(proxied.headers) or 0
+        if not content_type:
+            content_type, encoding = mimetypes.guess_type(url)
+        response["Content-Type"] = content_type
+        # Let the browser cache it for as long as we do.
+        patch_response_headers(response, cache_timeout=max(0, int(expires_in)))
+        # Quick hack to prevent Django from adding a Vary: Cookie header
+        self.request.session.accessed = False
+        if ttl:
+            response["X-Accel-Expires"] = ttl
+        return response
 
 
 ajax_proxy = AjaxProxy.as_view()
@@ -450,6 +484,28 @@ def simple_json_response(**kwargs):
     return HttpResponse(json_dumps(kwargs), content_type="application/json")
 
 
+class ZipStream(io.RawIOBase):
+    """
+    Non seekable file object for ZipFile to write into, whose content is
+    consumed by a streaming response.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush_chunks(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
 # ############## #
 #      Map       #
 # ############## #
@@ -489,14 +545,15 @@ class MapDetailMixin:
                 context["preconnect_domains"] = [f"//{domain}"]
 
     def get_map_properties(self):
-        user = self.request.user
+        """
+        Properties that do not depend on the current request, see
+        `get_request_properties` for the others.
+        """
         properties = {
             "urls": _urls_for_js(),
             "tilelayers": TileLayer.get_list(),
-            "editMode": self.edit_mode,
             "schema": Map.extra_schema,
             "umap_id": self.get_umap_id(),
-            "starred": self.is_starred(),
             "licences": dict((l.name, l.json) for l in Licence.objects.all()),
             "share_statuses": [
                 (i, str(label)) for i, label in Map.SHARE_STATUS if i != Map.BLOCKED
@@ -505,6 +562,18 @@ class MapDetailMixin:
             "featuresHaveOwner": settings.UMAP_DEFAULT_FEATURES_HAVE_OWNERS,
             "websocketEnabled": settings.WEBSOCKET_ENABLED,
             "websocketURI": settings.WEBSOCKET_FRONT_URI,
+            "websocketCompactCoordinates": settings.WEBSOCKET_COMPACT_COORDINATES,
+            "compactGeoJSON": settings.UMAP_COMPACT_GEOJSON,
+        }
+        if self.get_short_url():
+            properties["shortUrl"] = self.get_short_url()
+        return properties
+
+    def get_request_properties(self):
+        user = self.request.user
+        properties = {
+            "editMode": self.edit_mode,
+            "starred": self.is_starred(),
         }
         created = bool(getattr(self, "object", None))
         if (created and self.object.owner) or (not created and not user.is_anonymous):
@@ -517,9 +586,6 @@ class MapDetailMixin:
         properties["datalayer_edit_statuses"] = [
             (i, str(label)) for i, label in datalayer_statuses
         ]
-        if self.get_short_url():
-            properties["shortUrl"] = self.get_short_url()
-
         if not user.is_anonymous:
             properties["user"] = {
                 "id": user.pk,
@@ -528,9 +594,42 @@ class MapDetailMixin:
             }
         return properties
 
+    def get_cache_key(self):
+        # Translated labels and URLs prefixes depend on the active language.
+        parts = [
+            "umap:map_properties",
+            self.__class__.__name__,
+            translation.get_language(),
+            get_urls_hash(),
+            get_cache_version(),
+        ]
+        if self.get_umap_id():
+            parts += [self.get_umap_id(), get_cache_version(self.get_umap_id())]
+        return ":".join(str(part) for part in parts)
+
+    def get_cached_geojson(self):
+        """
+        Map settings, properties and datalayers metadata that are the same
+        for every request, built once per map version.
+        """
+        if not hasattr(self, "_cached_geojson"):
+            key = self.get_cache_key()
+            geojson = cache.get(key)
+            if geojson is None:
+                geojson = self.get_geojson()
+                if "properties" not in geojson:
+                    geojson["properties"] = {}
+                geojson["properties"].update(self.get_map_properties())
+                geojson["properties"]["datalayers"] = self.get_datalayers()
+                cache.set(key, geojson)
+            self._cached_geojson = geojson
+        return self._cached_geojson
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        properties = self.get_map_properties()
+        geojson = self.get_cached_geojson()
+        properties = geojson["properties"]
+        properties.update(self.get_request_properties())
         if settings.USE_I18N:
             lang = settings.LANGUAGE_CODE
             # Check attr in case the middleware is not active
@@ -540,18 +639,17 @@ class MapDetailMixin:
             locale = translation.to_locale(lang)
             properties["locale"] = locale
             context["locale"] = locale
-        geojson = self.get_geojson()
-        if "properties" not in geojson:
-            geojson["properties"] = {}
-        geojson["properties"].update(properties)
-        geojson["properties"]["datalayers"] = self.get_datalayers()
+        self.set_datalayers_edit_mode(properties["datalayers"])
         context["map_settings"] = json_dumps(geojson, indent=settings.DEBUG)
-        self.set_preconnect(geojson["properties"], context)
+        self.set_preconnect(properties, context)
         return context
 
     def get_datalayers(self):
         return []
 
+    def set_datalayers_edit_mode(self, datalayers):
+        pass
+
     @property
     def edit_mode(self):
         return "advanced"
@@ -624,20 +722,29 @@ class MapView(MapDetailMixin, PermissionsMixin, DetailView):
         return self.object.get_absolute_url()
 
     def get_datalayers(self):
+        return [dl.metadata() for dl in self.object.datalayer_set.all()]
+
+    def get_datalayer_edit_modes(self):
+        # Only the edit status is needed to compute the edit mode, so rely on
+        # cached metadata instead of querying the datalayers again.
+        datalayers = self.get_cached_geojson()["properties"]["datalayers"]
         return [
-            dl.metadata(self.request.user, self.request)
-            for dl in self.object.datalayer_set.all()
+            DataLayer(
+                map=self.object, edit_status=metadata["permissions"]["edit_status"]
+            ).can_edit(self.request.user, self.request)
+            for metadata in datalayers
         ]
 
+    def set_datalayers_edit_mode(self, datalayers):
+        for metadata, can_edit in zip(datalayers, self.get_datalayer_edit_modes()):
+            metadata["editMode"] = "advanced" if can_edit else "disabled"
+
     @property
     def edit_mode(self):
         edit_mode = "disabled"
         if self.object.can_edit(self.request.user, self.request):
             edit_mode = "advanced"
-        elif any(
-            d.can_edit(self.request.user, self.request)
-            for d in self.object.datalayer_set.all()
-        ):
+        elif any(self.get_datalayer_edit_modes()):
             edit_mode = "simple"
         return edit_mode
 
@@ -656,9 +763,13 @@ class MapView(MapDetailMixin, PermissionsMixin, DetailView):
         if "properties" not in map_settings:
             map_settings["properties"] = {}
         map_settings["properties"]["name"] = self.object.name
-        map_settings["properties"]["permissions"] = self.get_permissions()
         return map_settings
 
+    def get_request_properties(self):
+        properties = super().get_request_properties()
+        properties["permissions"] = self.get_permissions()
+        return properties
+
     def is_starred(self):
         user = self.request.user
         if not user.is_authenticated:
@@ -674,8 +785,10 @@ class MapDownload(DetailView):
         return reverse("map_download", args=(self.object.pk,))
 
     def render_to_response(self, context, *args, **kwargs):
-        umapjson = self.object.generate_umapjson(self.request)
-        response = simple_json_response(**umapjson)
+        response = StreamingHttpResponse(
+            self.object.generate_umapjson(self.request),
+            content_type="application/json",
+        )
         response["Content-Disposition"] = (
             f'attachment; filename="umap_backup_{self.object.slug}.umap"'
         )
@@ -1000,20 +1113,30 @@ class MapAnonymousEditUrl(RedirectView):
 
 
 class GZipMixin(object):
-    EXT = ".gz"
+    """Negotiate the precompressed versions of the layer, see UMAP_PRECOMPRESS.
+
+    Named after gzip, which came first, but handles all ENCODINGS.
+    """
 
     @property
     def path(self):
         return Path(self.object.geojson.path)
 
-    @property
-    def gzip_path(self):
-        return Path(f"{self.path}{self.EXT}")
+    def get_encoded_path(self, path, encoding):
+        return Path(f"{path}{ENCODINGS[encoding]}")
 
     def read_version(self, path):
-        # Remove optional .gz, then .geojson, then return the trailing version from path.
+        # Remove optional .gz (or .br…), then .geojson, then return the trailing
+        # version from path.
         return str(path.with_suffix("").with_suffix("")).split("_")[-1]
 
+    @property
+    def encoding(self):
+        """Precompressed content coding preferred by the client, if any."""
+        return negotiate_encoding(
+            self.request.META.get("HTTP_ACCEPT_ENCODING", ""), get_encodings()
+        )
+
     @property
     def version(self):
         # Prior to 1.3.0 we did not set gzip mtime as geojson mtime,
@@ -1022,44 +1145,108 @@ class GZipMixin(object):
         # (when umap is served by nginx and X-Accel-Redirect)
         # one, so we need to compare with that value in that case.
         # cf https://github.com/umap-project/umap/issues/1212
-        path = (
-            self.gzip_path
-            if self.accepts_gzip and self.gzip_path.exists()
-            else self.path
-        )
+        # All encodings share the name, hence the version, of the flat file.
+        path = self.path
+        if self.encoding:
+            encoded_path = self.get_encoded_path(path, self.encoding)
+            if encoded_path.exists():
+                path = encoded_path
         return self.read_version(path)
 
-    @property
-    def accepts_gzip(self):
-        return settings.UMAP_GZIP and re_accepts_gzip.search(
-            self.request.META.get("HTTP_ACCEPT_ENCODING", "")
-        )
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_compact(path, compact_path, precision):
+    compact_geojson.compact_file(path, compact_path, precision)
+    for encoding in get_encodings():
+        compress_file(compact_path, f"{compact_path}{ENCODINGS[encoding]}", encoding)
+
+
+# Concurrent reads of a layer (say a popular map, right after a save) only
+# prepare it once per process, the other requests wait for it.
+DATALAYER_READS = SingleFlight()
 
 
 class DataLayerView(GZipMixin, BaseDetailView):
     model = DataLayer
 
+    def get_level_path(self):
+        """Path of the simplified level for the `zoom` query parameter, if any."""
+        zoom = self.request.GET.get("zoom", "")
+        if not zoom.isdigit() or self.path != Path(self.object.geojson.path):
+            return None
+        levels = DATALAYER_READS.run(("pyramid", str(self.path)), self.object.pyramid)
+        level = pick_level(levels, int(zoom))
+        if level is None:
+            return None
+        return Path(get_level_path(self.path, level))
+
+    @property
+    def accepts_compact(self):
+        for media_range in self.request.headers.get("Accept", "").split(","):
+            media_type, *params = [part.strip() for part in media_range.split(";")]
+            if media_type == compact_geojson.MEDIA_TYPE:
+                return not any(p.replace(" ", "") in ("q=0", "q=0.0") for p in params)
+        return False
+
+    def get_compact_path(self, path):
+        compact_path = Path(f"{path}.compact")
+        if not compact_path.exists():
+            precision = None
+            # Older versions may have been saved with another precision.
+            if self.path == Path(self.object.geojson.path):
+                precision = compact_geojson.get_precision(self.object.settings)
+            if precision is None:
+                precision = compact_geojson.DEFAULT_PRECISION
+            DATALAYER_READS.run(
+                ("compact", str(path)), write_compact, path, compact_path, precision
+            )
+        return compact_path
+
     def render_to_response(self, context, **response_kwargs):
         response = None
-        path = self.path
-        # Generate gzip if needed
-        if self.accepts_gzip:
-            if not self.gzip_path.exists():
-                gzip_file(path, self.gzip_path)
-
+        path = self.get_level_path() or self.path
+        content_type = "application/geo+json"
+        if self.accepts_compact:
+            path = self.get_compact_path(path)
+            content_type = compact_geojson.MEDIA_TYPE
+        encoding = self.encoding
         if getattr(settings, "UMAP_XSENDFILE_HEADER", None):
+            # The web server picks the precompressed version (gzip_static and
+            # the like), which are created when saving the datalayer, but
+            # layers saved before may not have them yet.
+            if (
+                encoding
+                and path == Path(self.object.geojson.path)
+                and not self.get_encoded_path(path, encoding).exists()
+            ):
+                DATALAYER_READS.run(("precompress", str(path)), self.object.precompress)
             response = HttpResponse()
+            if content_type == compact_geojson.MEDIA_TYPE:
+                response["Content-Type"] = content_type
             internal_path = str(path).replace(settings.MEDIA_ROOT, "/internal")
             response[settings.UMAP_XSENDFILE_HEADER] = internal_path
         else:
             # Do not use in production
-            # (no gzip/cache-control/If-Modified-Since/If-None-Match)
-            statobj = os.stat(path)
-            with open(path, "rb") as f:
-                # Should not be used in production!
-                response = HttpResponse(f.read(), content_type="application/geo+json")
+            # (no cache-control/If-Modified-Since/If-None-Match)
+            encoded_path = encoding and self.get_encoded_path(path, encoding)
+            if encoded_path and encoded_path.exists():
+                path = encoded_path
+            else:
+                encoding = None
+            content = DATALAYER_READS.run(("read", str(path)), read_file, path)
+            # Should not be used in production!
+            response = HttpResponse(content, content_type=content_type)
+            if encoding:
+                response["Content-Encoding"] = encoding
             response["X-Datalayer-Version"] = self.version
-            response["Content-Length"] = statobj.st_size
+            response["Content-Length"] = len(content)
+        # The plain GeoJSON, its compact encoding and their precompressed
+        # versions all share the same URL.
+        patch_vary_headers(response, ["Accept", "Accept-Encoding"])
         return response
 
 
@@ -1071,6 +1258,64 @@ class DataLayerVersion(DataLayerView):
         )
 
 
+def parse_bbox(value):
+    """Parse a "west,south,east,north" string, raise ValueError if invalid."""
+    bbox = [float(coordinate) for coordinate in value.split(",")]
+    if len(bbox) != 4 or not all(map(math.isfinite, bbox)):
+        raise ValueError(value)
+    if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ValueError(value)
+    return bbox
+
+
+class DataLayerBBox(DataLayerView):
+    """Features of the current version intersecting the `bbox` query parameter.
+
+    With a `zoom`, features smaller than a pixel at this zoom are left out.
+    This is a read only view of the layer: the client must not save it back.
+    """
+
+    def render_to_response(self, context, **response_kwargs):
+        try:
+            bbox = parse_bbox(self.request.GET["bbox"])
+            zoom = self.request.GET.get("zoom")
+            zoom = int(zoom) if zoom else None
+            if zoom is not None and not 0 <= zoom <= 30:
+                raise ValueError(zoom)
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest("Invalid bbox or zoom")
+        path = self.path
+        # Built on the first request of the current version.
+        index_path = DATALAYER_READS.run(("index", str(path)), self.object.index)
+        index = load_index(str(index_path))
+        content = index.read(index.search(bbox, zoom))
+        response = HttpResponse(content, content_type="application/geo+json")
+        response["X-Datalayer-Version"] = self.version
+        response["Content-Length"] = len(content)
+        return response
+
+
+class DataLayerTile(DataLayerView):
+    """Mapbox Vector Tile z/x/y of the current version, see DataLayer.tile."""
+
+    def render_to_response(self, context, **response_kwargs):
+        z, x, y = self.kwargs["z"], self.kwargs["x"], self.kwargs["y"]
+        if z > vector_tiles.MAX_ZOOM or x >= 2**z or y >= 2**z:
+            raise Http404("No such tile")
+        tile_path = self.object.get_tile_path(z, x, y)
+        if getattr(settings, "UMAP_XSENDFILE_HEADER", None) and tile_path.exists():
+            response = HttpResponse(content_type=vector_tiles.CONTENT_TYPE)
+            internal_path = str(tile_path).replace(settings.MEDIA_ROOT, "/internal")
+            response[settings.UMAP_XSENDFILE_HEADER] = internal_path
+        else:
+            key = ("tile", str(self.path), z, x, y)
+            content = DATALAYER_READS.run(key, self.object.tile, z, x, y)
+            response = HttpResponse(content, content_type=vector_tiles.CONTENT_TYPE)
+            response["Content-Length"] = len(content)
+        response["X-Datalayer-Version"] = self.version
+        return response
+
+
 class DataLayerCreate(FormLessEditMixin, GZipMixin, CreateView):
     model = DataLayer
     form_class = DataLayerForm
@@ -1086,6 +1331,27 @@ class DataLayerCreate(FormLessEditMixin, GZipMixin, CreateView):
         return response
 
 
+# Concurrent saves of a layer often share the same reference: keep the
+# parsed ones for the duration of such a burst, within a memory budget.
+MERGE_REFERENCES = ExpiringCache(max_size=2**25, ttl=60)
+
+
+def load_reference(path):
+    """
+    Parsed content of a version file. Version files are never modified once
+    written, and callers must not mutate the returned document.
+    """
+    key = str(path)
+    reference = MERGE_REFERENCES.get(key)
+    if reference is None:
+        with open(path, "rb") as f:
+            content = f.read()
+        reference = json.loads(content)
+        # Counted by file size, the parsed document being a few times larger.
+        MERGE_REFERENCES.set(key, reference, len(content))
+    return reference
+
+
 class DataLayerUpdate(FormLessEditMixin, GZipMixin, UpdateView):
     model = DataLayer
     form_class = DataLayerForm
@@ -1098,37 +1364,39 @@ class DataLayerUpdate(FormLessEditMixin, GZipMixin, UpdateView):
         Attempt to apply the incoming changes to the reference, and then merge it
         with the last document we have on storage.
 
-        Returns either None (if the merge failed) or the merged python GeoJSON object.
+        Returns either None (if the reference is unknown) or the merged python
+        GeoJSON object, and raises ConflictError if some features conflict.
         """
 
         # Use the provided info to find the correct version in our storage.
-        for version in self.object.versions:
-            name = version["name"]
-            path = Path(settings.MEDIA_ROOT) / self.object.get_version_path(name)
-            if reference_version == self.read_version(path):
-                with open(path) as f:
-                    reference = json.loads(f.read())
-                break
-        else:
+        name = self.object.get_version_name(reference_version)
+        if not name:
             # If the reference document is not found, we can't merge.
             return None
+        path = Path(settings.MEDIA_ROOT) / self.object.get_version_path(name)
+        try:
+            reference = load_reference(path)
+        except FileNotFoundError:
+            return None
         # New data received in the request.
         incoming = json.loads(self.request.FILES["geojson"].read())
+        # Stored versions are rounded, while the client may still hold the
+        # features it sent: round them the same way, or unchanged ones would
+        # look modified.
+        precision = compact_geojson.get_precision(self.object.settings)
+        if precision is not None:
+            incoming = compact_geojson.quantize(incoming, precision)
 
         # Latest known version of the data.
         with open(self.path) as f:
             latest = json.loads(f.read())
 
-        try:
-            merged_features = merge_features(
-                reference.get("features", []),
-                latest.get("features", []),
-                incoming.get("features", []),
-            )
-            latest["features"] = merged_features
-            return latest
-        except ConflictError:
-            return None
+        latest["features"] = merge_features(
+            reference.get("features", []),
+            latest.get("features", []),
+            incoming.get("features", []),
+        )
+        return latest
 
     def post(self, request, *args, **kwargs):
         self.object = self.get_object()
@@ -1140,7 +1408,12 @@ class DataLayerUpdate(FormLessEditMixin, GZipMixin, UpdateView):
 
         reference_version = self.request.headers.get("X-Datalayer-Reference")
         if self.has_changes_since(reference_version):
-            merged = self.merge(reference_version)
+            try:
+                merged = self.merge(reference_version)
+            except ConflictError as error:
+                response = simple_json_response(conflicts=error.conflicts)
+                response.status_code = 412
+                return response
             if not merged:
                 return HttpResponse(status=412)
 
@@ -1156,7 +1429,7 @@ class DataLayerUpdate(FormLessEditMixin, GZipMixin, UpdateView):
     def form_valid(self, form):
         self.object = form.save()
         data = {**self.object.metadata(self.request.user, self.request)}
-        if self.request.session.get("needs_reload"):
+        if self.request.session.get("needs_reload") or form.rounded:
             data["geojson"] = json.loads(self.object.geojson.read().decode())
             self.request.session["needs_reload"] = False
         response = simple_json_response(**data)
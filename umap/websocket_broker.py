@@ -0,0 +1,571 @@
+"""Share websocket rooms between several websocket server processes.
+
+Each websocket server process only knows its own connections. The backbone
+is the pub/sub layer used by the server to reach the peers of a room: the
+default one only delivers to the connections of the current process, the
+broker one also forwards messages to a broker, which relays them to the
+other server processes (on the same host or not) subscribed to the room.
+
+The broker listens either on a Unix socket ("unix:///path/to/socket") or on
+TCP ("tcp://host:port"), and speaks a minimal protocol: each frame is the
+length of the payload (4 bytes, big endian), followed by the payload, which
+is a JSON header (`[action, room, binary]`), a new line and the message.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import stat
+import struct
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import websockets
+
+from umap.websocket_metrics import Histogram
+
+FRAME_SIZE = struct.Struct(">I")
+# Same as the default max_size of websockets.
+MAX_MESSAGE_SIZE = 2**20
+# A subscriber lagging behind by more than this is disconnected.
+MAX_BUFFER_SIZE = 2**24
+
+
+def payload_size(message):
+    """Size in bytes of the message once encoded in a frame."""
+    # isascii() is constant time, encode() is not.
+    if isinstance(message, bytes) or message.isascii():
+        return len(message)
+    return len(message.encode())
+
+
+def encode_frame(action, room, message=""):
+    binary = isinstance(message, bytes)
+    body = message if binary else message.encode()
+    header = json.dumps([action, room, binary]).encode() + b"\n"
+    return [FRAME_SIZE.pack(len(header) + len(body)), header, body]
+
+
+def decode_header(payload):
+    action, room, binary = json.loads(payload[: payload.index(b"\n")])
+    return action, room, binary
+
+
+def decode_frame(payload):
+    action, room, binary = decode_header(payload)
+    body = payload[payload.index(b"\n") + 1 :]
+    return action, room, body if binary else body.decode()
+
+
+async def read_frame(reader):
+    (size,) = FRAME_SIZE.unpack(await reader.readexactly(FRAME_SIZE.size))
+    if size > MAX_MESSAGE_SIZE + 1024:
+        raise ValueError(f"Frame too large: {size}")
+    return await reader.readexactly(size)
+
+
+def write_frame(writer, action, room, message=""):
+    writer.writelines(encode_frame(action, room, message))
+
+
+def parse_url(url):
+    parsed = urlparse(url)
+    if parsed.scheme == "unix" and parsed.path:
+        return {"path": parsed.path}
+    if parsed.scheme == "tcp" and parsed.hostname and parsed.port is not None:
+        return {"host": parsed.hostname, "port": parsed.port}
+    raise ValueError(f"Invalid URL: {url!r}, expected unix:///path or tcp://host:port")
+
+
+async def start_server(handle, url):
+    address = parse_url(url)
+    if "path" in address:
+        path = address["path"]
+        # Remove the socket left by a previous run, if any.
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        return await asyncio.start_unix_server(handle, **address)
+    return await asyncio.start_server(handle, **address)
+
+
+async def open_connection(url):
+    address = parse_url(url)
+    if "path" in address:
+        return await asyncio.open_unix_connection(**address)
+    return await asyncio.open_connection(**address)
+
+
+class Broker:
+    """Relay the messages published in a room to the other subscribers."""
+
+    def __init__(self):
+        self.rooms = defaultdict(set)
+
+    async def serve(self, url):
+        return await start_server(self.handle, url)
+
+    async def handle(self, reader, writer):
+        rooms = set()
+        try:
+            while True:
+                payload = await read_frame(reader)
+                action, room, _ = decode_header(payload)
+                if action == "subscribe":
+                    self.rooms[room].add(writer)
+                    rooms.add(room)
+                elif action == "unsubscribe":
+                    self.unsubscribe(room, writer)
+                    rooms.discard(room)
+                elif action == "publish":
+                    self.publish(room, payload, writer)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            for room in rooms:
+                self.unsubscribe(room, writer)
+            writer.close()
+
+    def unsubscribe(self, room, writer):
+        self.rooms[room].discard(writer)
+        if not self.rooms[room]:
+            del self.rooms[room]
+
+    def publish(self, room, payload, sender):
+        # Relay the frame as is, no need to decode the message.
+        frame = [FRAME_SIZE.pack(len(payload)), payload]
+        for writer in list(self.rooms.get(room, ())):
+            if writer is sender or writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_BUFFER_SIZE:
+                # The server process will reconnect and subscribe again.
+                print("Disconnecting a lagging subscriber from the broker")
+                writer.close()
+                continue
+            writer.writelines(frame)
+
+
+def make_operation_key(verb, subject, metadata, key):
+    """Key of the state an operation sets: the last one with a key wins."""
+    if verb not in ("upsert", "update", "delete"):
+        return None
+    if key is not None and not isinstance(key, str):
+        return None
+    return (verb, str(subject), json.dumps(metadata, sort_keys=True), key)
+
+
+def operation_key(raw_message):
+    """Key of a serialized operation, see make_operation_key."""
+    try:
+        message = json.loads(raw_message)
+    except ValueError:
+        return None
+    if not isinstance(message, dict) or message.get("kind") != "operation":
+        return None
+    return make_operation_key(
+        message.get("verb"),
+        message.get("subject"),
+        message.get("metadata"),
+        message.get("key"),
+    )
+
+
+def to_coalescing_key(key):
+    """Coalescing key of an operation, from its operation key, or None."""
+    if key is None or key[0] != "update" or key[3] is None:
+        return None
+    return key
+
+
+def coalescing_key(raw_message):
+    """Operations with the same key only keep their last value, or None."""
+    # Avoid parsing messages that cannot be an update.
+    if not isinstance(raw_message, str) or '"update"' not in raw_message:
+        return None
+    return to_coalescing_key(operation_key(raw_message))
+
+
+def split_batch(raw_message):
+    """Serialized operations of a message, which may be a batch."""
+    if not raw_message.startswith('{"kind": "batch"'):
+        return [raw_message]
+    try:
+        operations = json.loads(raw_message)["operations"]
+    except (ValueError, KeyError, TypeError):
+        return []
+    return [json.dumps(operation) for operation in operations]
+
+
+class RoomLog:
+    """Operations relayed in a room, sent as a snapshot to late joiners.
+
+    Operations are compacted to the last one per key (see operation_key).
+    This is done lazily, as it needs to parse the messages relayed without
+    their `operations` (from other processes), so appending stays cheap.
+    Past `max_bytes`, the log is dropped, and joiners do not get a snapshot.
+
+    Once a layer is saved (its `_reference_version` is updated), its logged
+    operations are in the data joiners load from the server: they are
+    dropped. Layers upserts are never logged, as joiners may have loaded
+    the layer already.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.operations = {}
+        self.size = 0
+        self.counter = itertools.count()
+        self.overflowed = False
+
+    def append(self, raw_message, operations=None):
+        """Log `raw_message`, with its (operation key, operation) if known."""
+        if self.overflowed or not isinstance(raw_message, str):
+            return
+        self.pending.append((raw_message, operations))
+        self.size += len(raw_message)
+        if len(self.pending) > max(64, len(self.operations)):
+            self.compact()
+
+    def compact(self):
+        for raw_message, operations in self.pending:
+            if operations is None:
+                operations = [
+                    (operation_key(operation), operation)
+                    for operation in split_batch(raw_message)
+                ]
+            for key, operation in operations:
+                if key is None:
+                    key = next(self.counter)
+                elif key[1] == "datalayer" and key[0] == "upsert":
+                    continue
+                elif key[1] == "datalayer" and key[3] == "_reference_version":
+                    metadata = json.loads(key[2])
+                    if isinstance(metadata, dict):
+                        self.forget_layer(metadata.get("id"))
+                    continue
+                previous = self.operations.pop(key, None)
+                self.operations[key] = operation
+                self.size += len(operation)
+                if previous is not None:
+                    self.size -= len(previous)
+            self.size -= len(raw_message)
+        self.pending.clear()
+        if self.size > self.max_bytes:
+            print("Room log too large, late joiners will not get a snapshot")
+            self.overflowed = True
+            self.operations.clear()
+            self.size = 0
+
+    def forget_layer(self, layer_id):
+        """Drop the logged operations of the layer with this id."""
+        if layer_id is None:
+            return
+        for key in list(self.operations):
+            if not isinstance(key, tuple) or key[1] not in ("datalayer", "feature"):
+                continue
+            metadata = json.loads(key[2])
+            if not isinstance(metadata, dict):
+                continue
+            id_key = "id" if key[1] == "datalayer" else "layerId"
+            if metadata.get(id_key) == layer_id:
+                self.size -= len(self.operations.pop(key))
+
+    def snapshot(self):
+        self.compact()
+        if not self.operations:
+            return None
+        operations = ", ".join(self.operations.values())
+        return '{"kind": "snapshot", "operations": [%s]}' % operations
+
+
+class Outbox:
+    """Messages waiting to be sent to a peer which does not read fast enough.
+
+    Past `high_water` queued messages, a new update replaces the queued one
+    of the same key, if any. Past `max_size`, the peer is disconnected with
+    the RESYNC close code, so it knows it missed some messages.
+    """
+
+    RESYNC = 4001
+
+    def __init__(self, websocket, high_water, max_size, latency=None):
+        self.websocket = websocket
+        self.high_water = high_water
+        self.max_size = max_size
+        self.latency = latency
+        # Insertion ordered, keyed by coalescing key or by a counter, the
+        # values are (time of queueing, message).
+        self.queue = {}
+        self.counter = itertools.count()
+        self.ready = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+        self.coalesced = 0
+        self.overflowed = False
+        self.sent_messages = 0
+        self.sent_bytes = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, message, queued_at=None, operations=None):
+        if self.overflowed:
+            return
+        if queued_at is None:
+            queued_at = time.perf_counter()
+        key = None
+        if len(self.queue) >= self.high_water:
+            if operations is None:
+                key = coalescing_key(message)
+            elif len(operations) == 1:
+                key = to_coalescing_key(operations[0][0])
+            replaced = self.queue.pop(key, None)
+            if replaced is not None:
+                self.coalesced += 1
+                # The peer has been waiting since the replaced one.
+                queued_at = replaced[0]
+        if key is None:
+            key = next(self.counter)
+        self.queue[key] = (queued_at, message)
+        if len(self.queue) > self.max_size:
+            self.overflow()
+        self.ready.set()
+
+    def overflow(self):
+        print(f"Disconnecting a peer lagging behind by {len(self.queue)} messages")
+        self.overflowed = True
+        self.queue.clear()
+        self.task.cancel()
+        self.task = asyncio.create_task(
+            self.websocket.close(code=self.RESYNC, reason="resync")
+        )
+
+    async def run(self):
+        try:
+            while True:
+                await self.ready.wait()
+                while self.queue:
+                    key = next(iter(self.queue))
+                    queued_at, message = self.queue.pop(key)
+                    # send() waits for the peer to read when its buffer is full.
+                    await self.websocket.send(message)
+                    self.sent_messages += 1
+                    self.sent_bytes += payload_size(message)
+                    if self.latency is not None:
+                        self.latency.observe(time.perf_counter() - queued_at)
+                self.ready.clear()
+        except websockets.ConnectionClosed:
+            self.queue.clear()
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, websockets.ConnectionClosed):
+            pass
+
+
+class Backbone:
+    """Rooms local to this process: messages only reach its own connections.
+
+    Messages are written right away to peers keeping up, and queued in an
+    Outbox for the others.
+    """
+
+    # Defaults for WEBSOCKET_QUEUE_HIGH_WATER, WEBSOCKET_QUEUE_MAX_SIZE and
+    # WEBSOCKET_ROOM_LOG_SIZE.
+    HIGH_WATER = 100
+    MAX_SIZE = 1000
+    LOG_SIZE = 2**23
+
+    def __init__(self, rooms=None, high_water=None, max_size=None, log_size=None):
+        # Mapping of room (map_id) to the set of its websocket connections.
+        self.rooms = defaultdict(set) if rooms is None else rooms
+        self.outboxes = {}
+        self.logs = {}
+        self.high_water = high_water or self.HIGH_WATER
+        self.max_size = max_size or self.MAX_SIZE
+        self.log_size = log_size or self.LOG_SIZE
+        self.disconnected = 0
+        self.coalesced = 0
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.latency = Histogram(
+            "umap_websocket_delivery_seconds",
+            "Time from publishing a message to writing it to a peer.",
+        )
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def join(self, room, websocket):
+        self.rooms[room].add(websocket)
+        outbox = Outbox(websocket, self.high_water, self.max_size, self.latency)
+        self.outboxes[websocket] = outbox
+        if room not in self.logs:
+            self.logs[room] = RoomLog(self.log_size)
+        # Queued, so it is sent before the messages relayed from now on.
+        snapshot = self.logs[room].snapshot()
+        if snapshot:
+            outbox.put(snapshot)
+
+    async def leave(self, room, websocket):
+        self.rooms[room].discard(websocket)
+        if not self.rooms[room]:
+            del self.rooms[room]
+            self.logs.pop(room, None)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            self.coalesced += outbox.coalesced
+            self.disconnected += outbox.overflowed
+            self.sent_messages += outbox.sent_messages
+            self.sent_bytes += outbox.sent_bytes
+            await outbox.close()
+
+    async def publish(self, room, message, sender=None, operations=None):
+        """Deliver `message` to the room.
+
+        `operations` are the (operation key, operation) of the message, when
+        known by the caller, so it is not parsed again.
+        """
+        self.deliver(room, message, sender, operations)
+
+    def deliver(self, room, message, sender=None, operations=None):
+        published_at = time.perf_counter()
+        if room in self.logs:
+            self.logs[room].append(message, operations)
+        # Peers are read at the time of sending, so new connections get it.
+        ready = []
+        for peer in self.rooms.get(room, ()):
+            if peer is sender:
+                continue
+            outbox = self.outboxes.get(peer)
+            if outbox is None or (
+                not outbox.queue
+                and peer.transport.get_write_buffer_size() <= peer.write_limit
+            ):
+                ready.append(peer)
+            else:
+                outbox.put(message, published_at, operations)
+        if not ready:
+            return
+        # Encode the frame once for all the peers keeping up.
+        websockets.broadcast(ready, message)
+        self.sent_messages += len(ready)
+        self.sent_bytes += len(ready) * payload_size(message)
+        self.latency.observe(time.perf_counter() - published_at, len(ready))
+
+    def stats(self):
+        """Queue metrics, to size the server."""
+        outboxes = self.outboxes.values()
+        depths = [len(outbox) for outbox in outboxes]
+        return {
+            "rooms": len(self.rooms),
+            "connections": len(self.outboxes),
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "lagging_connections": sum(1 for depth in depths if depth),
+            "coalesced_messages": self.coalesced
+            + sum(outbox.coalesced for outbox in outboxes),
+            "room_logs_bytes": sum(log.size for log in self.logs.values()),
+            "resync_disconnections": self.disconnected
+            + sum(outbox.overflowed for outbox in outboxes),
+            "sent_messages": self.sent_messages
+            + sum(outbox.sent_messages for outbox in outboxes),
+            "sent_bytes": self.sent_bytes
+            + sum(outbox.sent_bytes for outbox in outboxes),
+        }
+
+
+class BrokerBackbone(Backbone):
+    """Rooms shared with the other processes connected to the same broker.
+
+    Messages published while the broker is unreachable are only delivered
+    locally; the connection is retried in the background.
+    """
+
+    RETRY_DELAY = 1
+
+    def __init__(self, url, rooms=None, **kwargs):
+        super().__init__(rooms, **kwargs)
+        parse_url(url)  # Fail early on invalid URL.
+        self.url = url
+        self.writer = None
+        self.task = None
+        self.connected = asyncio.Event()
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                reader, writer = await open_connection(self.url)
+            except OSError as error:
+                print(f"Cannot connect to broker {self.url}: {error}")
+                await asyncio.sleep(self.RETRY_DELAY)
+                continue
+            for room in self.rooms:
+                write_frame(writer, "subscribe", room)
+            self.writer = writer
+            self.connected.set()
+            try:
+                while True:
+                    action, room, message = decode_frame(await read_frame(reader))
+                    if action == "publish":
+                        self.deliver(room, message)
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                print(f"Lost connection to broker {self.url}")
+            finally:
+                self.connected.clear()
+                self.writer = None
+                writer.close()
+            await asyncio.sleep(self.RETRY_DELAY)
+
+    def send(self, action, room, message=""):
+        if self.writer is not None and not self.writer.is_closing():
+            write_frame(self.writer, action, room, message)
+
+    async def join(self, room, websocket):
+        first = not self.rooms.get(room)
+        await super().join(room, websocket)
+        if first:
+            self.send("subscribe", room)
+
+    async def leave(self, room, websocket):
+        await super().leave(room, websocket)
+        if room not in self.rooms:
+            self.send("unsubscribe", room)
+
+    async def publish(self, room, message, sender=None, operations=None):
+        self.deliver(room, message, sender, operations)
+        self.send("publish", room, message)
+
+
+def get_backbone(url=None, rooms=None, **kwargs):
+    if url:
+        return BrokerBackbone(url, rooms, **kwargs)
+    return Backbone(rooms, **kwargs)
+
+
+def run(url):
+    async def _serve():
+        server = await Broker().serve(url)
+        async with server:
+            print(f"Broker waiting for connections on {url}")
+            await server.serve_forever()
+
+    asyncio.run(_serve())
@@ -0,0 +1,151 @@
+"""Metrics of the websocket server, in the Prometheus text format.
+
+The websocket server serves them over HTTP (GET /metrics) on
+WEBSOCKET_METRICS_URL, from its own event loop: there is no other process
+to run, and the values are read where they are updated. They are those of
+the current process only, the collector is expected to sum them across the
+processes of a deployment.
+"""
+
+import asyncio
+import bisect
+from collections import defaultdict
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds (in seconds) of the latency buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"),
+        )
+        for name, value in labels
+    )
+    return "{%s}" % pairs
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        # Keyed by the sorted (name, value) pairs of the labels.
+        self.values = defaultdict(int)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+        # Not cumulative, the last one is for the values above all buckets.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value, count=1):
+        """Record `count` observations of `value`."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+        self.count += count
+
+    def samples(self):
+        cumulated = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulated += count
+            yield f"{self.name}_bucket", (("le", format_value(bound)),), cumulated
+        yield f"{self.name}_sum", (), self.sum
+        yield f"{self.name}_count", (), self.count
+
+
+def render(metrics):
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+def http_response(status, body="", content_type="text/plain; charset=utf-8"):
+    body = body.encode()
+    headers = (
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return headers.encode() + body
+
+
+class MetricsEndpoint:
+    """Minimal HTTP server answering GET /metrics with `collect()` rendered.
+
+    `collect` is called on each request, it returns the metrics to render.
+    """
+
+    TIMEOUT = 5
+
+    def __init__(self, collect):
+        self.collect = collect
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), self.TIMEOUT
+            )
+            method, path, *_ = request.decode("latin-1").split(" ", 2)
+            if method != "GET":
+                response = http_response("405 Method Not Allowed")
+            elif path.split("?")[0] != "/metrics":
+                response = http_response("404 Not Found")
+            else:
+                body = render(self.collect())
+                response = http_response("200 OK", body, CONTENT_TYPE)
+            writer.write(response)
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            asyncio.TimeoutError,
+            ConnectionError,
+            ValueError,
+        ):
+            pass
+        finally:
+            writer.close()
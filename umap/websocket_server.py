@@ -1,22 +1,56 @@
 #!/usr/bin/env python
 
 import asyncio
+import itertools
 from collections import defaultdict
 from typing import Literal, Optional
 
-import websockets
 from django.conf import settings
-from django.core.signing import TimestampSigner
+from django.core.signing import BadSignature, TimestampSigner
 from pydantic import BaseModel, ValidationError
 from websockets import WebSocketClientProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 from websockets.server import serve
 
 from umap.models import Map, User  # NOQA
+from umap.websocket_broker import (
+    Backbone,
+    get_backbone,
+    make_operation_key,
+    payload_size,
+    start_server,
+    to_coalescing_key,
+)
+from umap.websocket_metrics import Counter, Gauge, MetricsEndpoint
 
 # Contains the list of websocket connections handled by this process.
 # It's a mapping of map_id to a set of the active websocket connections
 CONNECTIONS = defaultdict(set)
 
+# Delivers the messages to the peers of a room, see websocket_broker.
+BACKBONE = Backbone(
+    CONNECTIONS,
+    high_water=settings.WEBSOCKET_QUEUE_HIGH_WATER,
+    max_size=settings.WEBSOCKET_QUEUE_MAX_SIZE,
+    log_size=settings.WEBSOCKET_ROOM_LOG_SIZE,
+)
+
+# Operations sent by a peer within this delay (in seconds) after the previous
+# one are coalesced and relayed together, see Coalescer.
+COALESCE_DELAY = 0.02
+
+RECEIVED_MESSAGES = Counter(
+    "umap_websocket_received_messages_total", "Messages received from the peers."
+)
+RECEIVED_BYTES = Counter(
+    "umap_websocket_received_bytes_total",
+    "Size of the messages received from the peers, once decompressed.",
+)
+INVALID_MESSAGES = Counter(
+    "umap_websocket_invalid_messages_total",
+    "Messages refused, by kind of message expected.",
+)
+
 
 class JoinMessage(BaseModel):
     kind: str = "join"
@@ -31,6 +65,111 @@ class OperationMessage(BaseModel):
     key: Optional[str] = None
 
 
+class BatchMessage(BaseModel):
+    """Operations relayed at once, to be applied in order."""
+
+    kind: str = "batch"
+    operations: list[OperationMessage]
+
+
+class SnapshotMessage(BatchMessage):
+    """Operations relayed in the room before joining it, see RoomLog."""
+
+    kind: str = "snapshot"
+
+
+def parse_operation(raw_message: str | bytes) -> Optional[OperationMessage]:
+    """Return the OperationMessage of `raw_message`, or None if not one.
+
+    This is the only time a relayed message is parsed: its operation key is
+    computed from the model, and published along with it.
+    """
+    if not isinstance(raw_message, str):
+        return None
+    try:
+        message = OperationMessage.model_validate_json(raw_message)
+    except ValidationError:
+        return None
+    if "kind" not in message.model_fields_set or message.kind != "operation":
+        return None
+    return message
+
+
+def get_operation_key(message: OperationMessage):
+    return make_operation_key(
+        message.verb, message.subject, message.metadata, message.key
+    )
+
+
+def batch_message(raw_messages: list[str]) -> str:
+    """Build a BatchMessage from already serialized operations."""
+    return '{"kind": "batch", "operations": [%s]}' % ", ".join(raw_messages)
+
+
+class Coalescer:
+    """Throttle the operations sent by a peer.
+
+    The first operation is published right away, the following ones are
+    held for COALESCE_DELAY, then published together in a batch, where
+    updates of the same (subject, metadata, key) only keep their last
+    value. Dragging a feature then costs one frame per peer and window,
+    instead of one per mouse move.
+    """
+
+    def __init__(self, publish, delay=None):
+        self.publish = publish
+        self.delay = COALESCE_DELAY if delay is None else delay
+        # Insertion ordered, so operations are published in order.
+        self.pending = {}
+        self.counter = itertools.count()
+        self.window = None
+        self.task = None
+
+    async def push(self, raw_message: str, key):
+        """Publish `raw_message`, whose operation key is `key`, or hold it."""
+        if self.window is None and not self.pending:
+            self.open_window()
+            await self.publish(raw_message, [(key, raw_message)])
+            return
+        coalescing = to_coalescing_key(key)
+        if coalescing is None:
+            coalescing = next(self.counter)
+        # Moving it last keeps the order right: the value it replaces has no
+        # effect on anything between them.
+        self.pending.pop(coalescing, None)
+        self.pending[coalescing] = (key, raw_message)
+        if self.window is None:
+            self.open_window()
+
+    def open_window(self):
+        loop = asyncio.get_running_loop()
+        self.window = loop.call_later(self.delay, self.close_window)
+
+    def close_window(self):
+        self.window = None
+        if self.pending:
+            self.task = asyncio.create_task(self.flush())
+            # Keep throttling while operations keep coming.
+            self.open_window()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        operations = list(self.pending.values())
+        self.pending.clear()
+        if len(operations) == 1:
+            await self.publish(operations[0][1], operations)
+        else:
+            raw_messages = [raw_message for _, raw_message in operations]
+            await self.publish(batch_message(raw_messages), operations)
+
+    async def close(self):
+        if self.window is not None:
+            self.window.cancel()
+            self.window = None
+        await self.flush()
+
+
 async def join_and_listen(
     map_id: int, permissions: list, user: str | int, websocket: WebSocketClientProtocol
 ):
@@ -39,21 +178,30 @@ async def join_and_listen(
     New messages will be broadcasted to other connected peers.
     """
     print(f"{user} joined room #{map_id}")
-    CONNECTIONS[map_id].add(websocket)
+    await BACKBONE.join(map_id, websocket)
+
+    async def publish(raw_message, operations):
+        await BACKBONE.publish(
+            map_id, raw_message, sender=websocket, operations=operations
+        )
+
+    coalescer = Coalescer(publish)
     try:
         async for raw_message in websocket:
-            # recompute the peers-list at the time of message-sending.
-            # as doing so beforehand would miss new connections
-            peers = CONNECTIONS[map_id] - {websocket}
-            # Only relay valid "operation" messages
-            try:
-                OperationMessage.model_validate_json(raw_message)
-                websockets.broadcast(peers, raw_message)
-            except ValidationError as e:
-                error = f"An error occurred when receiving this message: {raw_message}"
-                print(error, e)
+            RECEIVED_MESSAGES.inc()
+            RECEIVED_BYTES.inc(payload_size(raw_message))
+            # Only relay "operation" messages
+            message = parse_operation(raw_message)
+            if message is None:
+                INVALID_MESSAGES.inc(kind="operation")
+                print(f"Invalid message received: {raw_message[:200]!r}")
+                continue
+            # Peers (here and in other processes) are computed at the time of
+            # sending, as doing so beforehand would miss new connections.
+            await coalescer.push(raw_message, get_operation_key(message))
     finally:
-        CONNECTIONS[map_id].remove(websocket)
+        await coalescer.close()
+        await BACKBONE.leave(map_id, websocket)
 
 
 async def handler(websocket):
@@ -62,10 +210,16 @@ async def handler(websocket):
     If permissions are granted, let the peer enter a room.
     """
     raw_message = await websocket.recv()
+    RECEIVED_MESSAGES.inc()
+    RECEIVED_BYTES.inc(payload_size(raw_message))
 
     # The first event should always be 'join'
-    message: JoinMessage = JoinMessage.model_validate_json(raw_message)
-    signed = TimestampSigner().unsign_object(message.token, max_age=30)
+    try:
+        message: JoinMessage = JoinMessage.model_validate_json(raw_message)
+        signed = TimestampSigner().unsign_object(message.token, max_age=30)
+    except (ValidationError, BadSignature):
+        INVALID_MESSAGES.inc(kind="join")
+        raise
     user, map_id, permissions = signed.values()
 
     # Check if permissions for this map have been granted by the server
@@ -73,7 +227,61 @@ async def handler(websocket):
         await join_and_listen(map_id, permissions, user, websocket)
 
 
-def run(host, port):
+def collect_metrics():
+    """Metrics served on WEBSOCKET_METRICS_URL, see websocket_metrics."""
+    stats = BACKBONE.stats()
+    metrics = [RECEIVED_MESSAGES, RECEIVED_BYTES, INVALID_MESSAGES]
+    for name, kind, documentation in [
+        ("rooms", Gauge, "Rooms with at least one peer."),
+        ("connections", Gauge, "Peers connected to a room."),
+        ("lagging_connections", Gauge, "Peers with messages waiting to be sent."),
+        ("room_logs_bytes", Gauge, "Size of the operations kept for late joiners."),
+        ("sent_messages", Counter, "Messages written to the peers."),
+        ("sent_bytes", Counter, "Size of the messages written, before compression."),
+        ("coalesced_messages", Counter, "Queued updates replaced by a newer one."),
+        ("resync_disconnections", Counter, "Peers disconnected for lagging behind."),
+    ]:
+        suffix = "_total" if kind is Counter else ""
+        metric = kind(f"umap_websocket_{name}{suffix}", documentation)
+        metric.values[()] = stats[name]
+        metrics.append(metric)
+    peers = Gauge("umap_websocket_room_peers", "Peers connected to the room.")
+    queues = Gauge(
+        "umap_websocket_queue_size", "Messages waiting to be sent to the peer."
+    )
+    for room, connections in list(BACKBONE.rooms.items()):
+        peers.set(len(connections), room=room)
+        for websocket in connections:
+            outbox = BACKBONE.outboxes.get(websocket)
+            size = len(outbox) if outbox is not None else 0
+            queues.set(size, room=room, connection=websocket.id)
+    metrics.extend([peers, queues, BACKBONE.latency])
+    return metrics
+
+
+def compression_options() -> dict:
+    """Keyword arguments of `serve` for the WEBSOCKET_COMPRESSION mode.
+
+    The websockets defaults for permessage-deflate use a 4 kB window, while
+    features are sent again whole as they are edited: a window larger than
+    them lets the new frame reference the previous one, see
+    scripts/bench_websocket_bytes.py.
+    """
+    mode = settings.WEBSOCKET_COMPRESSION
+    if not mode:
+        return {"compression": None}
+    if mode != "deflate":
+        raise ValueError(f"Unknown WEBSOCKET_COMPRESSION: {mode!r}")
+    bits = settings.WEBSOCKET_DEFLATE_WINDOW_BITS
+    factory = ServerPerMessageDeflateFactory(
+        server_max_window_bits=bits,
+        client_max_window_bits=bits,
+        compress_settings={"memLevel": settings.WEBSOCKET_DEFLATE_MEMORY_LEVEL},
+    )
+    return {"compression": None, "extensions": [factory]}
+
+
+def run(host, port, broker_url=None, metrics_url=None):
     if not settings.WEBSOCKET_ENABLED:
         msg = (
             "WEBSOCKET_ENABLED should be set to True to run the WebSocket Server. "
@@ -85,8 +293,27 @@ def run(host, port):
         exit(1)
 
     async def _serve():
-        async with serve(handler, host, port):
-            print(f"Waiting for connections on {host}:{port}")
-            await asyncio.Future()  # run forever
+        global BACKBONE
+        BACKBONE = get_backbone(
+            broker_url,
+            CONNECTIONS,
+            high_water=settings.WEBSOCKET_QUEUE_HIGH_WATER,
+            max_size=settings.WEBSOCKET_QUEUE_MAX_SIZE,
+            log_size=settings.WEBSOCKET_ROOM_LOG_SIZE,
+        )
+        await BACKBONE.start()
+        metrics_server = None
+        if metrics_url:
+            endpoint = MetricsEndpoint(collect_metrics)
+            metrics_server = await start_server(endpoint.handle, metrics_url)
+            print(f"Serving metrics on {metrics_url}")
+        try:
+            async with serve(handler, host, port, **compression_options()):
+                print(f"Waiting for connections on {host}:{port}")
+                await asyncio.Future()  # run forever
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            await BACKBONE.stop()
 
     asyncio.run(_serve())